@@ -0,0 +1,295 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*
+"""SixTrack Particle Splatter Benchmark
+
+  SixTrack Particle Splatter Benchmark
+ ======================================
+  Measure the throughput of the particle generator in particleSplatter for a
+  range of particle counts and chunk sizes. Each case runs in its own process,
+  so its peak memory can be taken from the resource usage of that process.
+  The cases call the functions of particleSplatter itself, in three modes:
+
+   * chunked:  The particles are made chunk by chunk in one process, and the
+               generation of the normal distributed numbers (normalChunk), the
+               matching to the beam matrix (matchChunk) and the statistics and
+               histograms (ParticleCheck) are timed separately.
+   * stream:   streamParticles, writing to a memory mapped file.
+   * parallel: generateParticles on all cores, with the whole distribution in
+               memory, so only up to maxParallel particles.
+
+  The results are stored in a JSON file per commit of this repository. The
+  throughput of each stage and case is compared to the median of the earlier
+  commits benchmarked on the same host, and the script exits with 1 if any of
+  them dropped by more than maxDrop. Nothing is plotted, so it runs headless.
+
+  Usage:
+    benchSplatter.py [quick] [<results folder>]
+
+  The quick option only runs the cases up to 10^6 particles.
+
+"""
+
+import sys
+import json
+import time
+import socket
+import logging
+import numpy as np
+from os import path, listdir, makedirs, remove, getpid, cpu_count
+
+import particleSplatter as ps
+from buildFunctions import setupLogging, sysCall, sysRun
+from perfRegression import median
+from procMonitor import ProcMonitor
+
+logger = logging.getLogger("SixTrackTestBuild")
+
+##
+#  Settings
+##
+
+dBench = "/scratch/TestBuild/Bench"
+
+# Particle counts and chunk sizes to run. Chunks larger than the number of
+# particles are not run, as they are the same as a single chunk.
+theCounts   = [10**4, 10**5, 10**6, 10**7, 10**8]
+theChunks   = [10**4, 10**5, 10**6, 10**7]
+maxQuick    = 10**6
+maxParallel = 10**7
+
+# Regression thresholds
+maxDrop    = 0.2  # Maximum relative drop in throughput
+minHistory = 3    # Minimum number of earlier commits to compare with
+nHistory   = 10   # Number of earlier commits to take the median of
+minTime    = 0.2  # Minimum run time in seconds of a case to compare
+
+# Maximum run time in seconds of a single case
+tCase = 3600
+
+# Seed of all cases, so each commit is benchmarked on the same particles
+benchSeed = 42
+
+# The stages timed separately in each mode, in addition to the total
+theModes = {
+  "chunked"  : ["generate", "match", "stats"],
+  "stream"   : [],
+  "parallel" : [],
+}
+theStages = ["generate", "match", "stats"]
+thisFile  = path.abspath(__file__)
+
+##
+#  Cases
+##
+
+def runChunked(nPart, nChunk):
+  theBeam  = ps.beamMatrix(ps.defTwiss)
+  cholM    = np.linalg.cholesky(theBeam)
+  nDim     = cholM.shape[0]
+  theCheck = ps.ParticleCheck(nDim, np.sqrt(np.diag(theBeam)))
+  theSeqs  = np.random.SeedSequence(benchSeed).spawn((nPart + nChunk - 1)//nChunk)
+  theTimes = dict((stName, 0.0) for stName in theModes["chunked"])
+  for iStart, rngSeq in zip(range(0, nPart, nChunk), theSeqs):
+    nThis  = min(nChunk, nPart-iStart)
+    tZero  = time.perf_counter()
+    distN  = ps.normalChunk(rngSeq, nThis, nDim)
+    tOne   = time.perf_counter()
+    theChunk = ps.matchChunk(distN, cholM)
+    tTwo   = time.perf_counter()
+    theCheck.add(theChunk)
+    tThree = time.perf_counter()
+    del distN, theChunk
+    theTimes["generate"] += tOne - tZero
+    theTimes["match"]    += tTwo - tOne
+    theTimes["stats"]    += tThree - tTwo
+  theTimes["total"] = sum(theTimes.values())
+  return theTimes
+
+def runStream(nPart, nChunk, workDir):
+  np.random.seed(benchSeed)
+  outFile = path.join(workDir,"bench_%d.npy" % getpid())
+  tStart  = time.perf_counter()
+  try:
+    ps.streamParticles(outFile, nPart, nChunk)
+    tEnd = time.perf_counter()
+  finally:
+    if path.isfile(outFile):
+      remove(outFile)
+  return {"total": tEnd - tStart}
+
+def runParallel(nPart, nChunk):
+  tStart = time.perf_counter()
+  ps.generateParticles(ps.defTwiss, nPart, seedVal=benchSeed, nProc=cpu_count(), nChunk=nChunk)
+  return {"total": time.perf_counter() - tStart}
+
+def runCase(caseMode, nPart, nChunk, workDir):
+  """Run one case in this process, and print its stage times as JSON.
+  """
+  if caseMode == "chunked":
+    theTimes = runChunked(nPart, nChunk)
+  elif caseMode == "stream":
+    theTimes = runStream(nPart, nChunk, workDir)
+  else:
+    theTimes = runParallel(nPart, nChunk)
+  print(json.dumps(theTimes))
+  return
+
+def benchCase(caseMode, nPart, nChunk):
+  """Run one case in a new process. Returns the throughput of each stage and
+  of the whole case in particles per second, and the peak memory in MiB of
+  the largest process and of the whole process tree.
+  """
+  outLines = []
+  caseMon  = ProcMonitor()
+  exCode   = sysRun(
+    "%s %s case %s %d %d %s" % (sys.executable,thisFile,caseMode,nPart,nChunk,dBench), cwd=path.dirname(thisFile),
+    lineFuncs=[outLines.append], timeOut=tCase, procMon=caseMon
+  )
+  if exCode != 0 or len(outLines) == 0:
+    logger.error("Bench: Case %s %d/%d failed with exit code %d" % (caseMode,nPart,nChunk,exCode))
+    return None
+  theTimes = json.loads(outLines[-1])
+  theStats = caseMon.getStats()
+  theCase  = {
+    "mode"      : caseMode,
+    "particles" : nPart,
+    "chunk"     : nChunk,
+    "maxrss"    : theStats["maxrss"],
+    "peakrss"   : theStats["peakrss"],
+    "time"      : round(theTimes["total"], 4),
+    "rate"      : {},
+  }
+  for stName, stTime in theTimes.items():
+    theCase["rate"][stName] = round(nPart/stTime, 1) if stTime > 0.0 else 0.0
+  return theCase
+
+def caseKey(theCase):
+  return "%s %d/%d" % (theCase["mode"], theCase["particles"], theCase["chunk"])
+
+##
+#  Results
+##
+
+def loadHistory(gitHash, hostName):
+  """Load the results of earlier commits benchmarked on the same host, newest
+  first.
+  """
+  theHistory = []
+  for resFile in listdir(dBench):
+    if not (resFile.startswith("splatter_") and resFile.endswith(".json")):
+      continue
+    try:
+      with open(path.join(dBench,resFile),mode="r") as inFile:
+        theRes = json.load(inFile)
+    except Exception as e:
+      logger.warning("Bench: Cannot read %s: %s" % (resFile,str(e)))
+      continue
+    if theRes["hash"] != gitHash and theRes["host"] == hostName:
+      theHistory.append(theRes)
+  theHistory.sort(key=lambda theRes: theRes["timestamp"], reverse=True)
+  return theHistory[:nHistory]
+
+def findDrops(theCases, theHistory):
+  """Compare the throughput of each case and stage with the median of the
+  history. Returns the ones that dropped by more than maxDrop, worst first.
+  """
+  prevRates = {}
+  for theRes in theHistory:
+    for theCase in theRes["cases"]:
+      for stName, stRate in theCase["rate"].items():
+        prevRates.setdefault((caseKey(theCase), stName), []).append(stRate)
+  theDrops = []
+  for theCase in theCases:
+    if theCase["time"] < minTime:
+      continue
+    for stName, stRate in theCase["rate"].items():
+      hRates = prevRates.get((caseKey(theCase), stName), [])
+      if len(hRates) < minHistory:
+        continue
+      hMed = median(hRates)
+      if hMed <= 0.0:
+        continue
+      rDrop = 1.0 - stRate/hMed
+      if rDrop > maxDrop:
+        theDrops.append({"case": caseKey(theCase), "stage": stName, "rate": stRate, "median": hMed, "drop": rDrop})
+  theDrops.sort(key=lambda theDrop: theDrop["drop"], reverse=True)
+  return theDrops
+
+##
+#  Main
+##
+
+if __name__ == "__main__":
+
+  if len(sys.argv) == 6 and sys.argv[1] == "case":
+    runCase(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), sys.argv[5])
+    sys.exit(0)
+
+  theArgs = sys.argv[1:]
+  isQuick = "quick" in theArgs
+  if isQuick:
+    theArgs.remove("quick")
+  if len(theArgs) > 0:
+    dBench = theArgs[0]
+  makedirs(dBench, exist_ok=True)
+  setupLogging(dBench)
+
+  stdOut, stdErr, exCode = sysCall("git rev-parse HEAD", cwd=path.dirname(thisFile))
+  gitHash  = stdOut.strip() if exCode == 0 else "unknown"
+  hostName = socket.gethostname()
+
+  logger.info("*"*80)
+  logger.info("* Particle Splatter Benchmark")
+  logger.info("*"*80)
+  logger.info("Commit: %s" % gitHash)
+  logger.info("Host:   %s with %d cores" % (hostName,cpu_count()))
+  logger.info("")
+  logger.info("  %-8s  %9s  %9s  %9s  %9s  %9s  %9s  %9s" % (
+    "Mode","Particles","Chunk","Peak RSS","Generate","Match","Stats","Total"
+  ))
+  logger.info("  %-8s  %9s  %9s  %9s  %9s  %9s  %9s  %9s" % ("","","","MiB","p/s","p/s","p/s","p/s"))
+
+  theCases = []
+  nFailed  = 0
+  for caseMode in theModes:
+    for nPart in theCounts:
+      if isQuick and nPart > maxQuick:
+        continue
+      if caseMode == "parallel" and nPart > maxParallel:
+        continue
+      for nChunk in theChunks:
+        if nChunk > nPart:
+          continue
+        theCase = benchCase(caseMode, nPart, nChunk)
+        if theCase is None:
+          nFailed += 1
+          continue
+        theCases.append(theCase)
+        stRates = ["%9.3e" % theCase["rate"][stName] if stName in theCase["rate"] else "%9s" % "-" for stName in theStages]
+        logger.info("  %-8s  %9.0e  %9.0e  %9.1f  %s  %9.3e" % (
+          caseMode, nPart, nChunk, max(theCase["maxrss"], theCase["peakrss"]), "  ".join(stRates), theCase["rate"]["total"]
+        ))
+
+  theHistory = loadHistory(gitHash, hostName)
+  theDrops   = findDrops(theCases, theHistory)
+
+  resFile = path.join(dBench,"splatter_%s.json" % gitHash)
+  with open(resFile,mode="w") as outFile:
+    json.dump({
+      "hash"      : gitHash,
+      "host"      : hostName,
+      "cores"     : cpu_count(),
+      "timestamp" : time.time(),
+      "cases"     : theCases,
+    }, outFile, indent=2)
+  logger.info("")
+  logger.info("Results written to %s" % resFile)
+
+  logger.info("Compared to %d earlier commits on this host" % len(theHistory))
+  for theDrop in theDrops:
+    logger.warning("Throughput of %s for %s dropped %.1f %% to %.3e p/s from %.3e p/s" % (
+      theDrop["stage"], theDrop["case"], 100*theDrop["drop"], theDrop["rate"], theDrop["median"]
+    ))
+  if len(theDrops) > 0 or nFailed > 0:
+    sys.exit(1)
+  logger.info("No throughput regressions")
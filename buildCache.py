@@ -0,0 +1,211 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*
+"""SixTrack Build Cache
+
+  SixTrack Build Cache
+ ======================
+  Persistent cache of SixTrack build directories. A cache entry is keyed by
+  the git tree hashes of the parts of the repository that go into a build,
+  the compiler version string, the build type and the build options. A hit
+  restores the executable and the test tree instead of recompiling.
+
+  The key does not depend on where the source is checked out, so an entry can
+  be restored into another worktree. CMake writes absolute paths into the files
+  it generates, so these are rewritten to the new source folder on restore.
+
+  The cache is bounded in size, and the least recently used entries are
+  evicted when a new entry pushes it over the limit.
+
+"""
+
+import re
+import json
+import fcntl
+import shutil
+import hashlib
+import logging
+import threading
+from os import path, mkdir, remove, walk
+from time import time
+
+from buildFunctions import sysCall
+
+logger = logging.getLogger("SixTrackTestBuild")
+
+# Paths in the repository that determine the content of a build directory.
+# The test tree is included as it is copied into the build directory.
+cacheTrees = ["source","test","lib","CMakeLists.txt","cmake_six"]
+
+# Files generated by CMake that hold absolute paths of the source folder
+relocNames = ["CMakeCache.txt","Makefile"]
+relocExts  = [".cmake",".make"]
+
+def prefixFlags(srcDir, bldComp):
+  """Compiler flags for the environment of a build, mapping the source folder
+  to a relative path in the debug info and file macros, so the binaries of a
+  cached build do not refer to the worktree they were built in. Only GCC has
+  the option, the other compilers get no flags.
+  """
+  if bldComp != "gfortran":
+    return ""
+  mapFlag = "-ffile-prefix-map=%s=." % path.abspath(srcDir)
+  return "CFLAGS=%s FFLAGS=%s" % (mapFlag,mapFlag)
+
+class BuildCache:
+
+  def __init__(self, cacheDir, maxSize):
+    self.cacheDir  = cacheDir
+    self.maxSize   = maxSize
+    self.indexFile = path.join(cacheDir,"index.json")
+    self.lockFile  = path.join(cacheDir,"index.lock")
+    self.theLock   = threading.Lock()
+    if not path.isdir(cacheDir):
+      mkdir(cacheDir)
+    return
+
+  def makeKey(self, srcDir, bldComp, bldType, bldOpts):
+    """Compute the cache key for a build of the checked out HEAD in srcDir.
+    Returns None if the tree hashes cannot be determined.
+    """
+    keyData = [bldComp, bldType.lower(), " ".join(bldOpts.split())]
+    for treePath in cacheTrees:
+      stdOut, stdErr, exCode = sysCall("git rev-parse HEAD:%s" % treePath, cwd=srcDir)
+      if exCode == 0:
+        keyData.append("%s:%s" % (treePath,stdOut.strip()))
+      elif treePath == "source":
+        logger.warning("BuildCache: Cannot get tree hash of source in %s" % srcDir)
+        return None
+    return hashlib.sha1("\n".join(keyData).encode()).hexdigest()
+
+  def restore(self, theKey, srcDir):
+    """Restore a cached build directory into srcDir. Returns the path of the
+    build directory relative to srcDir, or None on a cache miss.
+    """
+    if theKey is None:
+      return None
+    with self._lockIndex() as theIndex:
+      if theKey not in theIndex:
+        return None
+      theEntry = theIndex[theKey]
+      theEntry["used"] = time()
+    tarFile = path.join(self.cacheDir,theKey+".tgz")
+    bPath   = theEntry["path"]
+    if path.isdir(path.join(srcDir,bPath)):
+      shutil.rmtree(path.join(srcDir,bPath))
+    stdOut, stdErr, exCode = sysCall("tar -xzf %s" % tarFile, cwd=srcDir)
+    if exCode != 0:
+      logger.warning("BuildCache: Failed to restore %s, dropping entry" % theKey)
+      self._dropEntry(theKey)
+      return None
+    oldSrc = theEntry.get("source",None)
+    newSrc = path.abspath(srcDir)
+    if oldSrc is not None and oldSrc != newSrc:
+      logger.debug("BuildCache: Relocating %s from %s" % (theKey,oldSrc))
+      self._relocate(path.join(srcDir,bPath),oldSrc,newSrc)
+    return bPath
+
+  def store(self, theKey, srcDir, bPath):
+    """Add a freshly built directory to the cache. The build must not have
+    been tested yet, as test output would otherwise be restored as well.
+    """
+    if theKey is None or bPath == "":
+      return
+    tarFile = path.join(self.cacheDir,theKey+".tgz")
+    tmpFile = tarFile+".tmp"
+    stdOut, stdErr, exCode = sysCall("tar -czf %s %s" % (tmpFile,bPath), cwd=srcDir)
+    if exCode != 0:
+      logger.warning("BuildCache: Failed to archive %s" % bPath)
+      if path.isfile(tmpFile):
+        remove(tmpFile)
+      return
+    tarSize = path.getsize(tmpFile)
+    if tarSize > self.maxSize:
+      logger.warning("BuildCache: Build %s is larger than the cache" % bPath)
+      remove(tmpFile)
+      return
+    shutil.move(tmpFile,tarFile)
+    with self._lockIndex() as theIndex:
+      theIndex[theKey] = {"path": bPath, "source": path.abspath(srcDir), "size": tarSize, "used": time()}
+      self._evictEntries(theIndex)
+    return
+
+  def _relocate(self, bldDir, oldSrc, newSrc):
+    # Only a full path component matches, so /a/slot1 does not match /a/slot10
+    srcRegEx = re.compile(re.escape(oldSrc.encode())+rb"(?=[/\s\"';:)]|$)", re.MULTILINE)
+    newBytes = newSrc.encode()
+    for dirPath, dirNames, fileNames in walk(bldDir):
+      for fileName in fileNames:
+        if not (fileName in relocNames or path.splitext(fileName)[1] in relocExts):
+          continue
+        filePath = path.join(dirPath,fileName)
+        with open(filePath,mode="rb") as inFile:
+          fileData = inFile.read()
+        newData = srcRegEx.sub(lambda theMatch: newBytes,fileData)
+        if newData != fileData:
+          with open(filePath,mode="wb") as outFile:
+            outFile.write(newData)
+    return
+
+  def _evictEntries(self, theIndex):
+    # Must be called with the index locked
+    totSize = sum(theEntry["size"] for theEntry in theIndex.values())
+    for theKey in sorted(theIndex, key=lambda theKey: theIndex[theKey]["used"]):
+      if totSize <= self.maxSize:
+        break
+      logger.debug("BuildCache: Evicting %s" % theKey)
+      totSize -= theIndex[theKey]["size"]
+      self._removeFile(theKey)
+      del theIndex[theKey]
+    return
+
+  def _dropEntry(self, theKey):
+    with self._lockIndex() as theIndex:
+      if theKey in theIndex:
+        del theIndex[theKey]
+    self._removeFile(theKey)
+    return
+
+  def _removeFile(self, theKey):
+    tarFile = path.join(self.cacheDir,theKey+".tgz")
+    if path.isfile(tarFile):
+      remove(tarFile)
+    return
+
+  def _lockIndex(self):
+    return _CacheIndex(self)
+
+class _CacheIndex:
+  """Context manager holding the index lock across threads and processes,
+  since the nightly and quick builds may share the same cache.
+  """
+
+  def __init__(self, theCache):
+    self.theCache = theCache
+    self.theIndex = {}
+    self.lockFd   = None
+    return
+
+  def __enter__(self):
+    self.theCache.theLock.acquire()
+    self.lockFd = open(self.theCache.lockFile,mode="w")
+    fcntl.flock(self.lockFd,fcntl.LOCK_EX)
+    if path.isfile(self.theCache.indexFile):
+      try:
+        with open(self.theCache.indexFile,mode="r") as inFile:
+          self.theIndex = json.load(inFile)
+      except Exception as e:
+        logger.error("BuildCache: Failed to read index, starting empty")
+        logger.error(str(e))
+    return self.theIndex
+
+  def __exit__(self, excType, excVal, excTrace):
+    try:
+      tmpFile = self.theCache.indexFile+".tmp"
+      with open(tmpFile,mode="w") as outFile:
+        json.dump(self.theIndex,outFile)
+      shutil.move(tmpFile,self.theCache.indexFile)
+    finally:
+      fcntl.flock(self.lockFd,fcntl.LOCK_UN)
+      self.lockFd.close()
+      self.theCache.theLock.release()
+    return False
@@ -0,0 +1,280 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*
+"""SixTrack Build Daemon
+
+  SixTrack Build Daemon
+ =======================
+  Long running service that polls the SixTrack mirror for new branch, pull
+  request and tag heads, and runs a quick build for each new commit. Pending
+  builds are kept in a queue ordered by priority, where each commit is only
+  built once, and a newer push to a ref replaces the one still waiting in the
+  queue. The builds run through a shared job pool, and the state is kept in a
+  file so the daemon can be restarted without building everything again.
+
+  Usage:
+    buildDaemon.py [quickBuild arguments]
+
+  The arguments are passed on to quickBuild.py for every build, and default
+  to a gfortran release build running the fast tests. Each build gets an
+  equal share of the cores, so the builds running at the same time do not
+  oversubscribe the host.
+
+"""
+
+import sys
+import json
+import time
+import signal
+import logging
+import threading
+from os import path, rename, makedirs, cpu_count
+from buildFunctions import *
+from buildScheduler import JobPool
+
+logger = logging.getLogger("SixTrackTestBuild")
+
+##
+#  Settings
+##
+
+dSource   = "/scratch/TestBuild/Source/Mirror"
+dLog      = "/scratch/Temp/"
+dDaemon   = "/scratch/Temp/Daemon"
+stateFile = "/scratch/Temp/Daemon/state.json"
+
+# Seconds between polls of the mirror
+tPoll = 60
+
+# Number of quick builds running at the same time. Should not be more than
+# the number of slots in the quick build worktree pool.
+nWorkers = 4
+
+# Maximum run time in seconds of a single quick build
+tQuickMax = 4*3600
+
+# Number of built commits remembered for deduplication
+maxBuilt = 5000
+
+# Refs to watch, and their priority (lower is built first)
+theRefs = [
+  ("refs/heads/master", 0),
+  ("refs/pull/",        1),
+  ("refs/heads/",       2),
+  ("refs/tags/",        3),
+]
+
+quickArgs = sys.argv[1:]
+if len(quickArgs) == 0:
+  quickArgs = ["gfortran","release","fast","quiet"]
+
+quickScript = path.join(path.dirname(path.abspath(__file__)),"quickBuild.py")
+quickCores  = max(1,cpu_count()//nWorkers)
+
+##
+#  Build Queue
+##
+
+class BuildQueue:
+  """Pending builds, one per ref. Adding a new head for a ref that is still
+  waiting replaces it, and commits that were already built or queued are not
+  added again.
+  """
+
+  def __init__(self, theState):
+    self.theState = theState
+    self.thePend  = {}
+    self.nSeq     = 0
+    return
+
+  def update(self, gitRef, gitHash):
+    refPrio = refPriority(gitRef)
+    if refPrio is None:
+      return False
+    self.theState["refs"][gitRef] = gitHash
+    if gitHash in self.theState["built"]:
+      self.thePend.pop(gitRef, None)
+      return False
+    if gitRef in self.thePend:
+      if self.thePend[gitRef]["hash"] == gitHash:
+        return False
+      logger.info("Queue: %s moved, replacing %s with %s" % (gitRef,self.thePend[gitRef]["hash"][:10],gitHash[:10]))
+    elif any(pEntry["hash"] == gitHash for pEntry in self.thePend.values()):
+      return False
+    self.thePend[gitRef] = {"ref": gitRef, "hash": gitHash, "prio": refPrio, "seq": self.nSeq}
+    self.nSeq += 1
+    return True
+
+  def drop(self, gitRef):
+    self.thePend.pop(gitRef, None)
+    return
+
+  def pop(self):
+    if len(self.thePend) == 0:
+      return None
+    gitRef = min(self.thePend, key=lambda gitRef: (self.thePend[gitRef]["prio"], self.thePend[gitRef]["seq"]))
+    return self.thePend.pop(gitRef)
+
+  def __len__(self):
+    return len(self.thePend)
+
+def refPriority(gitRef):
+  if gitRef[:10] == "refs/pull/" and gitRef[-5:] != "/head":
+    return None
+  for refPrefix, refPrio in theRefs:
+    if gitRef == refPrefix or (refPrefix[-1] == "/" and gitRef.startswith(refPrefix)):
+      return refPrio
+  return None
+
+def refArgument(gitRef):
+  if gitRef[:11] == "refs/heads/":
+    return "b:%s" % gitRef[11:]
+  if gitRef[:10] == "refs/pull/":
+    return "pr:%s" % gitRef[10:-5]
+  if gitRef[:10] == "refs/tags/":
+    return "tag:%s" % gitRef[10:]
+  return None
+
+def listRefs():
+  """Return a dictionary of all watched refs in the mirror to their commit.
+  """
+  theHeads = {}
+  stdOut, stdErr, exCode = sysCall(
+    "git for-each-ref --format='%(objectname) %(*objectname) %(refname)' refs/heads refs/pull refs/tags",
+    cwd=path.join(dSource,"SixTrack.git")
+  )
+  if exCode != 0:
+    logger.error("Failed to list refs in the mirror")
+    return theHeads
+  for refLn in stdOut.split("\n"):
+    refBits = refLn.split()
+    if len(refBits) == 3:
+      # Annotated tags point to the tag object, so use the commit it points to
+      theHeads[refBits[2]] = refBits[1]
+    elif len(refBits) == 2:
+      theHeads[refBits[1]] = refBits[0]
+  return theHeads
+
+def loadState():
+  if path.isfile(stateFile):
+    try:
+      with open(stateFile,mode="r") as inFile:
+        return json.load(inFile)
+    except Exception as e:
+      logger.error("Failed to read state file, starting over")
+      logger.error(str(e))
+  return None
+
+def saveState():
+  # Built commits are trimmed to the most recent ones
+  theBuilt = theState["built"]
+  if len(theBuilt) > maxBuilt:
+    for gitHash in sorted(theBuilt, key=lambda gitHash: theBuilt[gitHash]["time"])[:len(theBuilt)-maxBuilt]:
+      del theBuilt[gitHash]
+  tmpFile = stateFile+".tmp"
+  with open(tmpFile,mode="w") as outFile:
+    json.dump(theState,outFile,indent=2)
+  rename(tmpFile,stateFile)
+  return
+
+##
+#  Builds
+##
+
+def runQuick(qEntry):
+  """Run a quick build of one queued ref. Called from the job pool.
+  """
+  global nRunning
+
+  refArg  = refArgument(qEntry["ref"])
+  logName = "quick_%s" % qEntry["hash"]
+  # Build the queued commit even if the ref has moved since, and leave the
+  # mirror to the polling loop so two fetches never run on it at once
+  cmdStr  = "%s %s %s" % (sys.executable,quickScript," ".join([refArg,"hash:%s" % qEntry["hash"],"nofetch","ncores:%d" % quickCores]+quickArgs))
+  logger.info("Build: Starting %s at %s" % (qEntry["ref"],qEntry["hash"][:10]))
+  tStart = time.time()
+  exCode = sysRun(cmdStr, logName=logName, logPath=dDaemon, timeOut=tQuickMax)
+  tEnd = time.time() - tStart
+  if exCode == 0:
+    logger.info("Build: %s at %s passed in %.0f s" % (qEntry["ref"],qEntry["hash"][:10],tEnd))
+  else:
+    logger.warning("Build: %s at %s failed in %.0f s" % (qEntry["ref"],qEntry["hash"][:10],tEnd))
+  with stateLock:
+    theState["built"][qEntry["hash"]] = {
+      "ref"     : qEntry["ref"],
+      "passed"  : exCode == 0,
+      "excode"  : exCode,
+      "time"    : time.time(),
+      "runtime" : tEnd,
+      "log"     : path.join(dDaemon,"stdout_%s.log" % logName),
+    }
+    theRunning.discard(qEntry["hash"])
+    nRunning -= 1
+    saveState()
+  return
+
+##
+#  Main Loop
+##
+
+setupLogging(dLog)
+makedirs(dDaemon, exist_ok=True)
+
+logger.info("*"*80)
+logger.info("* Starting SixTrack Build Daemon")
+logger.info("*"*80)
+logger.info("Quick build arguments: %s" % " ".join(quickArgs))
+
+theState = loadState()
+isFirst  = theState is None
+if isFirst:
+  theState = {"refs": {}, "built": {}}
+
+runPool    = JobPool(nWorkers)
+stateLock  = threading.Lock()
+theQueue   = BuildQueue(theState)
+theRunning = set()
+nRunning   = 0
+doStop     = False
+
+def stopDaemon(sigNum, sigFrame):
+  global doStop
+  logger.info("Received signal %d, stopping after running builds" % sigNum)
+  doStop = True
+  return
+
+signal.signal(signal.SIGTERM, stopDaemon)
+signal.signal(signal.SIGINT,  stopDaemon)
+
+while not doStop:
+  mirrorRepo(dSource)
+  theHeads = listRefs()
+  with stateLock:
+    if isFirst:
+      # Don't build the whole history of refs on the first start, only master
+      for gitRef, gitHash in theHeads.items():
+        theState["refs"][gitRef] = gitHash
+        if gitRef != "refs/heads/master":
+          theState["built"][gitHash] = {"ref": gitRef, "passed": None, "time": time.time()}
+      isFirst = False
+    for gitRef, gitHash in sorted(theHeads.items()):
+      if gitHash in theRunning:
+        continue
+      if theQueue.update(gitRef, gitHash):
+        logger.info("Queue: Added %s at %s" % (gitRef,gitHash[:10]))
+    for gitRef in list(theState["refs"]):
+      if gitRef not in theHeads:
+        del theState["refs"][gitRef]
+        theQueue.drop(gitRef)
+    while nRunning < nWorkers and len(theQueue) > 0:
+      qEntry = theQueue.pop()
+      theRunning.add(qEntry["hash"])
+      nRunning += 1
+      runPool.submit(1, runQuick, qEntry)
+    saveState()
+  for tSleep in range(tPoll):
+    if doStop:
+      break
+    time.sleep(1)
+
+runPool.wait()
+logger.info("Build daemon stopped")
@@ -11,12 +11,15 @@
 
 """
 
+import re
 import json
 import logging
 import hashlib
-import requests
+import signal
+import fnmatch
+import threading
 import subprocess
-from os import path, chdir, getcwd, system
+from os import path, chdir, getcwd, system, killpg, rename
 from datetime import datetime
 
 logger = logging.getLogger("SixTrackTestBuild")
@@ -42,11 +45,79 @@ def setupLogging(dLog,fPlain=False):
   logger.setLevel(logging.DEBUG)
 
 # Wrapper function for system calls
-def sysCall(callStr):
-  sysP = subprocess.Popen([callStr], stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True)
+def sysCall(callStr, cwd=None):
+  sysP = subprocess.Popen([callStr], stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, cwd=cwd)
   stdOut, stdErr = sysP.communicate()
   return stdOut.decode("utf-8"), stdErr.decode("utf-8"), sysP.returncode
 
+# Exit code returned by sysRun when a command is killed for running too long
+sysTimeOut = 124
+
+# Streaming wrapper for long running system calls
+def sysRun(callStr, cwd=None, logName=None, logPath=".", logTag=None, lineFuncs=None, timeOut=None, procMon=None):
+  """Run a command and stream its output line by line instead of holding it
+  all in memory. If logName is set, stdout and stderr are written as they come
+  to stdout_<logName>.log and stderr_<logName>.log in logPath. Each line of
+  stdout is passed to every function in lineFuncs, and if logTag is set all
+  lines are also sent to the log. A command running longer than timeOut
+  seconds is killed together with its children, and sysTimeOut is returned.
+  If procMon is a ProcMonitor, the resources used by the command are measured.
+  """
+  if lineFuncs is None:
+    lineFuncs = []
+  sysP = subprocess.Popen(
+    [callStr], stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=True, cwd=cwd, start_new_session=True
+  )
+  if procMon is None:
+    waitFunc = sysP.wait
+  else:
+    procMon.start(sysP.pid)
+    waitFunc = lambda timeout=None: procMon.wait(sysP, timeout)
+
+  def readStream(theStream, theType, dumpName):
+    outFile = None
+    if dumpName is not None:
+      outFile = open(path.join(logPath,"%s_%s.log" % (theType,dumpName)),mode="w")
+    try:
+      for rawLn in theStream:
+        outLn = rawLn.decode("utf-8",errors="replace")
+        if outFile is not None:
+          outFile.write(outLn)
+        outLn = outLn.rstrip("\n")
+        if theType == "stdout":
+          for lineFunc in lineFuncs:
+            lineFunc(outLn)
+        if logTag is not None and outLn.strip() != "":
+          logger.debug("%s> %s" % (logTag, outLn))
+    finally:
+      if outFile is not None:
+        outFile.close()
+    return
+
+  outThread = threading.Thread(target=readStream, args=(sysP.stdout,"stdout",logName))
+  errThread = threading.Thread(target=readStream, args=(sysP.stderr,"stderr",logName))
+  outThread.start()
+  errThread.start()
+
+  try:
+    exCode = waitFunc(timeout=timeOut)
+  except subprocess.TimeoutExpired:
+    logger.error("Command timed out after %d seconds: %s" % (timeOut, callStr))
+    killpg(sysP.pid, signal.SIGTERM)
+    try:
+      waitFunc(timeout=30)
+    except subprocess.TimeoutExpired:
+      killpg(sysP.pid, signal.SIGKILL)
+      waitFunc()
+    exCode = sysTimeOut
+
+  outThread.join()
+  errThread.join()
+  sysP.stdout.close()
+  sysP.stderr.close()
+
+  return exCode
+
 # Command line output wrapper
 def logWrap(outTag, stdOut, stdErr, exCode):
   outLns = stdOut.split("\n")
@@ -73,57 +144,31 @@ def cmakeSixReturn(stdOut, stdErr):
       bPath = tmpData[-1]
   return bPath
 
-def ctestReturn(stdOut, stdErr):
-  outLns  = stdOut.split("\n")
-  tFailed = ""
-  if len(outLns) <= 2:
-    logger.debug("CTEST> %s" % outLns[-1])
-  else:
-    atSum  = False
-    atFail = False
-    for outLn in outLns:
-      outLn = outLn.strip()
-      if outLn == "":
-        atSum = True
-        continue
-      if not atSum:
-        continue
-      if not outLn == "":
-        logger.debug("CTEST> %s" % outLn.strip())
-      if outLn.strip() == "The following tests FAILED:":
-        atFail = True
-        continue
-      if atFail:
-        splFail = outLn.split()
-        if len(splFail) == 4:
-          if splFail[3] == "(Failed)":
-            tFailed += splFail[2]+", "
-    if atFail:
-      tFailed = tFailed[:-2]
-  return tFailed
-
-def ctestResult(stdOut, stdErr):
-  outLns = stdOut.split("\n")
-  nTotal = 0
-  nPass  = 0
-  nFail  = 0
-  tFail  = []
-  if len(outLns) <= 2:
-    logger.debug("CTEST> %s" % outLns[-1])
-  else:
-    for outLn in outLns:
-      outBit = outLn.strip().replace("*"," ").split()
-      if len(outBit) < 6:
-        continue
-      if outBit[1] != "Test" or outBit[2][:1] != "#":
-        continue
-      nTotal += 1
-      if outBit[5] == "Passed":
-        nPass += 1
-      if outBit[5] == "Failed":
-        nFail += 1
-        tFail.append(outBit[3])
-  return nTotal, nPass, nFail, tFail
+class CTestScanner:
+  """Collect the test results from ctest output one line at a time, so it can
+  be used as a line function for sysRun.
+  """
+
+  def __init__(self):
+    self.nTotal = 0
+    self.nPass  = 0
+    self.nFail  = 0
+    self.tFail  = []
+    return
+
+  def parseLine(self, outLn):
+    outBit = outLn.strip().replace("*"," ").split()
+    if len(outBit) < 6:
+      return
+    if outBit[1] != "Test" or outBit[2][:1] != "#":
+      return
+    self.nTotal += 1
+    if outBit[5] == "Passed":
+      self.nPass += 1
+    if outBit[5] == "Failed":
+      self.nFail += 1
+      self.tFail.append(outBit[3])
+    return
 
 def ctestCoverage(stdOut,stdErr):
   outLns = stdOut.split("\n")
@@ -147,14 +192,6 @@ def writeResults(theData, theTarget, theLabel):
     logger.error(" * Failed to write data for SixTrack website")
     logger.error(str(e))
 
-def sendData(theData):
-  stUrl = "http://sixtrack.web.cern.ch/SixTrack/build_status.php"
-  try:
-    retVal = requests.post(stUrl, data=theData)
-    logger.debug(" * Sending data: %s" % retVal.text)
-  except:
-    logger.error(" * Failed to send data to SixTrack website")
-
 def hashIt(theType, theCommand):
   return "%s_%s" % (theType, hashlib.md5(theCommand.encode()).hexdigest())
 
@@ -186,13 +223,56 @@ def getSimMeta(mPath, mValue):
         return mVal
   return "Unknown"
 
-def dumpStdFiles(stdOut,stdErr,fName):
-  with open("stdout_"+fName+".log",mode="w") as outFile:
+def getChangedFiles(dSource, fromHash, toHash):
+  """Get the list of files changed between two commits, or None if the diff
+  could not be computed.
+  """
+  stdOut, stdErr, exCode = sysCall("git diff --name-only %s %s" % (fromHash, toHash), cwd=dSource)
+  if exCode != 0:
+    logger.error("Could not compute diff %s..%s" % (fromHash, toHash))
+    return None
+  return [cFile.strip() for cFile in stdOut.split("\n") if cFile.strip() != ""]
+
+def mapChangedOptions(changedFiles, optFiles, skipFiles):
+  """Map a list of changed files to the set of build options they affect.
+  Returns None if any file may affect all builds.
+  """
+  theOpts = set()
+  for cFile in changedFiles:
+    if any(fnmatch.fnmatch(cFile, sPattern) for sPattern in skipFiles):
+      continue
+    isMapped = False
+    for theOpt in optFiles:
+      if any(fnmatch.fnmatch(cFile, oPattern) for oPattern in optFiles[theOpt]):
+        theOpts.add(theOpt)
+        isMapped = True
+    if not isMapped:
+      logger.debug("File %s affects all builds" % cFile)
+      return None
+  return theOpts
+
+def buildHasOptions(bldOpts, theOpts):
+  """Check if a build options string enables any of the given options.
+  """
+  for bOpt in bldOpts.split():
+    if bOpt in theOpts:
+      return True
+  return False
+
+def dumpStdFiles(stdOut,stdErr,fName,fPath="."):
+  with open(path.join(fPath,"stdout_"+fName+".log"),mode="w") as outFile:
     outFile.write(stdOut)
-  with open("stderr_"+fName+".log",mode="w") as outFile:
+  with open(path.join(fPath,"stderr_"+fName+".log"),mode="w") as outFile:
     outFile.write(stdErr)
   return
 
+def moveStdFiles(fromName,fromPath,toName,toPath):
+  for stdType in ("stdout","stderr"):
+    fromFile = path.join(fromPath,"%s_%s.log" % (stdType,fromName))
+    if path.isfile(fromFile):
+      rename(fromFile,path.join(toPath,"%s_%s.log" % (stdType,toName)))
+  return
+
 def getSixTrackVersion(dSource):
   stdOut, stdErr, exCode = sysCall("cat %s | grep 'version = '" % path.join(dSource,"source","version.f90"))
   tmpLn = stdOut.strip().split()
@@ -223,19 +303,28 @@ def mirrorRepo(dSource):
 
   return
 
+def isCommitHash(gitHash):
+  """Check that a string is a full commit hash, and safe to pass to git.
+  """
+  return isinstance(gitHash, str) and re.match("^[0-9a-f]{40}$", gitHash) is not None
+
 def getCommitFromRef(dSource, gitRef):
-  """Get the commit hash for a given ref
+  """Get the commit hash for a given ref, or check a given commit hash
   """
   mirrorPath = path.join(dSource,"SixTrack.git")
   workingDir = getcwd()
   chdir(mirrorPath)
 
-  stdOut, stdErr, exCode = sysCall("git show-ref %s" % gitRef)
+  if isCommitHash(gitRef):
+    stdOut, stdErr, exCode = sysCall("git cat-file -e %s^{commit}" % gitRef)
+  else:
+    stdOut, stdErr, exCode = sysCall("git show-ref %s" % gitRef)
   if exCode == 0:
-    gitHash = stdOut[0:40]
+    gitHash = gitRef if isCommitHash(gitRef) else stdOut[0:40]
   else:
     logger.error("Unknown ref '%s'" % gitRef)
-    return gitHash, "", ""
+    chdir(workingDir)
+    return "", "", ""
   stdOut, stdErr, exCode = sysCall("git show -s --format=%%ci %s | tail -n1" % gitHash)
   gitTime = stdOut.strip()
   stdOut, stdErr, exCode = sysCall("git log --format=%%B -n 1 %s | head -n1" % gitHash)
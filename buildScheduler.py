@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*
+"""SixTrack Build Scheduler
+
+  SixTrack Build Scheduler
+ ==========================
+  Run build and test jobs concurrently under a global core budget.
+  Each job states how many cores it will use, and is only started when that
+  many cores are free in the pool. Jobs are started in order of priority, and
+  in the order they were submitted for equal priority.
+
+"""
+
+import heapq
+import logging
+import threading
+from os import cpu_count
+
+logger = logging.getLogger("SixTrackTestBuild")
+
+class JobPool:
+
+  def __init__(self, nCores=None):
+    if nCores is None:
+      nCores = cpu_count()
+    self.nCores  = max(1, nCores)
+    self.nFree   = self.nCores
+    self.nActive = 0
+    self.nSeq    = 0
+    self.theJobs = []
+    self.theCond = threading.Condition()
+    return
+
+  def submit(self, nCost, jobFunc, *jobArgs, jobPrio=0):
+    """Queue a job that needs nCost cores. A job can never need more than the
+    whole pool, so the cost is capped at the pool size.
+    """
+    nCost = min(max(1, nCost), self.nCores)
+    with self.theCond:
+      heapq.heappush(self.theJobs, (jobPrio, self.nSeq, nCost, jobFunc, jobArgs))
+      self.nSeq += 1
+      self._startJobs()
+    return
+
+  def wait(self):
+    """Block until the queue is empty and all jobs have finished, including
+    jobs submitted by other jobs while waiting.
+    """
+    with self.theCond:
+      while len(self.theJobs) > 0 or self.nActive > 0:
+        self.theCond.wait()
+    return
+
+  def _startJobs(self):
+    # Must be called with the lock held. Only the head of the queue is
+    # considered so that large jobs are not starved by smaller ones.
+    while len(self.theJobs) > 0 and self.theJobs[0][2] <= self.nFree:
+      jobPrio, nSeq, nCost, jobFunc, jobArgs = heapq.heappop(self.theJobs)
+      self.nFree   -= nCost
+      self.nActive += 1
+      jobThread = threading.Thread(target=self._runJob, args=(nCost, jobFunc, jobArgs))
+      jobThread.daemon = True
+      jobThread.start()
+    return
+
+  def _runJob(self, nCost, jobFunc, jobArgs):
+    try:
+      jobFunc(*jobArgs)
+    except Exception:
+      logger.exception("Job '%s' raised an exception" % jobFunc.__name__)
+    finally:
+      with self.theCond:
+        self.nFree   += nCost
+        self.nActive -= 1
+        self._startJobs()
+        self.theCond.notify_all()
+    return
@@ -0,0 +1,140 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*
+"""SixTrack Coverage Index
+
+  SixTrack Coverage Index
+ =========================
+  Build and query a per-test coverage index, mapping each test to the source
+  files and lines it executes. The index is built from a COVERAGE build by
+  running each test separately with its own GCOV_PREFIX, so that the tests can
+  still run in parallel without mixing their gcov data.
+
+  Package Dependencies:
+   - gcovr : for reading the gcov data
+
+"""
+
+import json
+import shutil
+import logging
+from os import path, walk, makedirs
+from concurrent.futures import ThreadPoolExecutor
+
+from buildFunctions import sysCall
+
+logger = logging.getLogger("SixTrackTestBuild")
+
+def listTests(bDir, ctestArgs=""):
+  """List the names of the tests ctest would run in a build directory.
+  """
+  stdOut, stdErr, exCode = sysCall("ctest -N %s" % ctestArgs, cwd=bDir)
+  theTests = []
+  for outLn in stdOut.split("\n"):
+    outBit = outLn.split()
+    if len(outBit) == 3 and outBit[0] == "Test" and outBit[1][:1] == "#":
+      theTests.append(outBit[2])
+  return theTests
+
+def parseGcovrJson(jsonFile):
+  """Read a gcovr JSON report and return a dictionary of source file to the
+  list of lines executed at least once.
+  """
+  with open(jsonFile,mode="r") as inFile:
+    jsonData = json.load(inFile)
+  theFiles = {}
+  for fileData in jsonData.get("files",[]):
+    covLines = [lnData["line_number"] for lnData in fileData.get("lines",[]) if lnData.get("count",0) > 0]
+    if len(covLines) > 0:
+      theFiles[fileData["file"]] = sorted(covLines)
+  return theFiles
+
+def _copyGcnoFiles(bDir, prefixDir):
+  # gcov needs the notes files next to the data files
+  for dirPath, dirNames, fileNames in walk(bDir):
+    for fileName in fileNames:
+      if fileName.endswith(".gcno"):
+        dstDir = prefixDir + path.abspath(dirPath)
+        makedirs(dstDir, exist_ok=True)
+        shutil.copy2(path.join(dirPath,fileName), dstDir)
+  return
+
+def _coverTest(bDir, srcDir, tmpDir, testName):
+  prefixDir = path.join(tmpDir,testName)
+  if path.isdir(prefixDir):
+    shutil.rmtree(prefixDir)
+  makedirs(prefixDir)
+  stdOut, stdErr, exCode = sysCall(
+    "GCOV_PREFIX=%s GCOV_PREFIX_STRIP=0 ctest -R '^%s$'" % (prefixDir,testName), cwd=bDir
+  )
+  if exCode != 0:
+    logger.warning("CovIndex: Test %s failed, coverage may be incomplete" % testName)
+  _copyGcnoFiles(bDir, prefixDir)
+  jsonFile = path.join(tmpDir,testName+".json")
+  stdOut, stdErr, exCode = sysCall(
+    "gcovr -r %s --json -o %s %s" % (srcDir,jsonFile,prefixDir), cwd=bDir
+  )
+  if exCode != 0:
+    logger.error("CovIndex: gcovr failed for test %s" % testName)
+    return testName, None
+  theFiles = parseGcovrJson(jsonFile)
+  shutil.rmtree(prefixDir)
+  return testName, theFiles
+
+def buildCoverageIndex(bDir, srcDir, indexFile, gitHash, ctestArgs="", nJobs=1):
+  """Run each test of a COVERAGE build on its own and write the index of which
+  source files and lines each test covers. File names are relative to srcDir.
+  """
+  tmpDir = path.join(bDir,"covindex")
+  makedirs(tmpDir, exist_ok=True)
+  theTests = listTests(bDir, ctestArgs)
+  logger.info("CovIndex: Indexing %d tests" % len(theTests))
+
+  theIndex = {}
+  with ThreadPoolExecutor(max_workers=max(1,nJobs)) as theExec:
+    for testName, theFiles in theExec.map(lambda tName: _coverTest(bDir,srcDir,tmpDir,tName), theTests):
+      if theFiles is not None:
+        theIndex[testName] = theFiles
+
+  with open(indexFile,mode="w") as outFile:
+    json.dump({"hash": gitHash, "tests": theIndex}, outFile)
+  shutil.rmtree(tmpDir)
+  logger.info("CovIndex: Wrote index for %d tests" % len(theIndex))
+
+  return len(theIndex)
+
+def loadCoverageIndex(indexFile):
+  if not path.isfile(indexFile):
+    return None
+  try:
+    with open(indexFile,mode="r") as inFile:
+      return json.load(inFile)
+  except Exception as e:
+    logger.error("CovIndex: Failed to read %s" % indexFile)
+    logger.error(str(e))
+  return None
+
+def selectTests(covIndex, changedFiles, testPrefix="test/"):
+  """Select the tests that cover any of the changed files. A change to the
+  input or reference files in a test folder selects that test. Returns None
+  if any other changed file is not in the index, since it is then unknown
+  which tests it affects.
+  """
+  allFiles = set()
+  for theFiles in covIndex["tests"].values():
+    allFiles.update(theFiles.keys())
+
+  theTests = set()
+  for cFile in changedFiles:
+    if cFile.startswith(testPrefix):
+      testName = cFile[len(testPrefix):].split("/")[0]
+      if testName in covIndex["tests"]:
+        theTests.add(testName)
+        continue
+    if cFile not in allFiles:
+      logger.info("CovIndex: File %s is not in the index" % cFile)
+      return None
+    for testName, theFiles in covIndex["tests"].items():
+      if cFile in theFiles:
+        theTests.add(testName)
+
+  return sorted(theTests)
@@ -0,0 +1,228 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*
+"""SixTrack Coverage Report
+
+  SixTrack Coverage Report
+ ==========================
+  Incremental coverage report for the nightly COVERAGE build. The gcov data
+  is processed by gcovr on all available cores, and the per-file, per-line
+  coverage is kept in a compact store with one file per commit. The HTML
+  pages are only rendered again for source files where the coverage or the
+  content changed since the previous commit, on all available cores, and the
+  index page reports the commit and the per-file change in coverage. The file
+  pages do not name a commit, as an unchanged page is kept from an earlier
+  one.
+
+  Package Dependencies:
+   - gcovr : for reading the gcov data
+
+"""
+
+import json
+import gzip
+import html
+import hashlib
+import logging
+from os import path, listdir, remove, makedirs
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+from buildFunctions import sysCall
+
+logger = logging.getLogger("SixTrackTestBuild")
+
+covMedium = 50.0
+covHigh   = 80.0
+
+def collectCoverage(bDir, srcDir, nJobs=1):
+  """Run gcovr on a build directory, and return a dictionary of source file,
+  relative to srcDir, to its content hash and its line counts.
+  """
+  jsonFile = path.join(bDir,"coverage_all.json")
+  stdOut, stdErr, exCode = sysCall("gcovr -r %s -j %d --json -o %s ." % (srcDir,nJobs,jsonFile), cwd=bDir)
+  if exCode != 0:
+    logger.error("CovReport: gcovr failed with exit code %d" % exCode)
+    for errLn in stdErr.split("\n"):
+      if errLn.strip() != "":
+        logger.error("GCOVR> %s" % errLn)
+    return None
+
+  with open(jsonFile,mode="r") as inFile:
+    jsonData = json.load(inFile)
+  remove(jsonFile)
+
+  covFiles = {}
+  for fileData in jsonData.get("files",[]):
+    fileName = fileData["file"]
+    covLines = {}
+    for lnData in fileData.get("lines",[]):
+      if lnData.get("gcovr/noncode",False):
+        continue
+      lnNum = lnData["line_number"]
+      covLines[lnNum] = covLines.get(lnNum,0) + lnData.get("count",0)
+    covFiles[fileName] = {
+      "sha"   : fileHash(path.join(srcDir,fileName)),
+      "lines" : sorted([lnNum, lnCount] for lnNum, lnCount in covLines.items()),
+    }
+  return covFiles
+
+def fileHash(srcFile):
+  if not path.isfile(srcFile):
+    return ""
+  with open(srcFile,mode="rb") as inFile:
+    return hashlib.sha1(inFile.read()).hexdigest()
+
+def fileCoverage(fileData):
+  nLines = len(fileData["lines"])
+  nCov   = sum(1 for lnNum, lnCount in fileData["lines"] if lnCount > 0)
+  return nCov, nLines
+
+def storeFile(storeDir, gitHash):
+  return path.join(storeDir,"%s.json.gz" % gitHash)
+
+def saveCoverage(storeDir, gitHash, covFiles):
+  makedirs(storeDir, exist_ok=True)
+  with gzip.open(storeFile(storeDir,gitHash),mode="wt") as outFile:
+    json.dump({"hash": gitHash, "files": covFiles}, outFile, separators=(",",":"))
+  return
+
+def loadCoverage(storeDir, gitHash):
+  inPath = storeFile(storeDir,gitHash)
+  if gitHash is None or not path.isfile(inPath):
+    return None
+  try:
+    with gzip.open(inPath,mode="rt") as inFile:
+      return json.load(inFile)["files"]
+  except Exception as e:
+    logger.error("CovReport: Failed to read %s" % inPath)
+    logger.error(str(e))
+  return None
+
+def coverageDeltas(covFiles, prevFiles):
+  """Compute the change in coverage for each file that changed. Files that
+  are new or removed have no previous or current coverage, respectively.
+  """
+  theDeltas = []
+  for fileName in sorted(set(covFiles) | set(prevFiles)):
+    currCov = fileCoverage(covFiles[fileName]) if fileName in covFiles else None
+    prevCov = fileCoverage(prevFiles[fileName]) if fileName in prevFiles else None
+    if currCov == prevCov:
+      continue
+    currPct = 100.0*currCov[0]/currCov[1] if currCov is not None and currCov[1] > 0 else None
+    prevPct = 100.0*prevCov[0]/prevCov[1] if prevCov is not None and prevCov[1] > 0 else None
+    theDeltas.append({
+      "file"  : fileName,
+      "curr"  : currCov,
+      "prev"  : prevCov,
+      "delta" : None if currPct is None or prevPct is None else round(currPct - prevPct, 3),
+    })
+  return theDeltas
+
+def pageName(fileName):
+  return "file_%s.html" % fileName.replace("/","_").replace(".","_")
+
+def covClass(covPct):
+  if covPct >= covHigh:
+    return "high"
+  if covPct >= covMedium:
+    return "medium"
+  return "low"
+
+pageStyle = """<style>
+body {font-family: sans-serif; font-size: 13px;}
+table {border-collapse: collapse;}
+td, th {padding: 1px 8px; text-align: left;}
+pre {margin: 0;}
+.high {background: #c8f0c8;} .medium {background: #f8f0b0;} .low {background: #f8c8c8;}
+.hit {background: #e0f8e0;} .miss {background: #f8d8d8;}
+</style>"""
+
+def renderFile(htmlDir, srcDir, fileName, fileData):
+  lnCounts = dict((lnNum, lnCount) for lnNum, lnCount in fileData["lines"])
+  nCov, nLines = fileCoverage(fileData)
+  covPct = 100.0*nCov/nLines if nLines > 0 else 100.0
+  srcLines = []
+  if path.isfile(path.join(srcDir,fileName)):
+    with open(path.join(srcDir,fileName),mode="r",errors="replace") as inFile:
+      srcLines = inFile.read().split("\n")
+  with open(path.join(htmlDir,pageName(fileName)),mode="w") as outFile:
+    outFile.write("<!DOCTYPE html>\n<html><head><meta charset='utf-8'><title>SixTrack: %s</title>\n%s</head><body>\n" % (
+      html.escape(fileName), pageStyle
+    ))
+    outFile.write("<h2>%s</h2>\n<p><a href='index.html'>Index</a> &mdash; Lines: %d of %d (%.2f %%)</p>\n" % (
+      html.escape(fileName), nCov, nLines, covPct
+    ))
+    outFile.write("<table>\n")
+    for lnIdx, srcLine in enumerate(srcLines):
+      lnNum = lnIdx + 1
+      if lnNum in lnCounts:
+        lnClass = "hit" if lnCounts[lnNum] > 0 else "miss"
+        lnCount = str(lnCounts[lnNum])
+      else:
+        lnClass = ""
+        lnCount = ""
+      outFile.write("<tr class='%s'><td>%d</td><td>%s</td><td><pre>%s</pre></td></tr>\n" % (
+        lnClass, lnNum, lnCount, html.escape(srcLine)
+      ))
+    outFile.write("</table>\n</body></html>\n")
+  return
+
+def renderIndex(htmlDir, covFiles, theDeltas, gitHash, gitTime):
+  fileDelta = dict((theDelta["file"], theDelta["delta"]) for theDelta in theDeltas)
+  totCov   = sum(fileCoverage(fileData)[0] for fileData in covFiles.values())
+  totLines = sum(fileCoverage(fileData)[1] for fileData in covFiles.values())
+  totPct   = 100.0*totCov/totLines if totLines > 0 else 0.0
+  with open(path.join(htmlDir,"index.html"),mode="w") as outFile:
+    outFile.write("<!DOCTYPE html>\n<html><head><meta charset='utf-8'><title>SixTrack Coverage</title>\n%s</head><body>\n" % pageStyle)
+    outFile.write("<h2>SixTrack Coverage</h2>\n<p>Commit %s (%s) &mdash; Lines: %d of %d (%.2f %%)</p>\n" % (
+      gitHash, gitTime, totCov, totLines, totPct
+    ))
+    outFile.write("<table>\n<tr><th>File</th><th>Lines</th><th>Coverage</th><th>Change</th></tr>\n")
+    for fileName in sorted(covFiles):
+      nCov, nLines = fileCoverage(covFiles[fileName])
+      covPct = 100.0*nCov/nLines if nLines > 0 else 100.0
+      fDelta = fileDelta.get(fileName)
+      outFile.write("<tr class='%s'><td><a href='%s'>%s</a></td><td>%d / %d</td><td>%.2f %%</td><td>%s</td></tr>\n" % (
+        covClass(covPct), pageName(fileName), html.escape(fileName), nCov, nLines, covPct,
+        "" if fDelta is None or fDelta == 0.0 else "%+.2f %%" % fDelta
+      ))
+    outFile.write("</table>\n<p>Generated %s</p>\n</body></html>\n" % datetime.now().strftime("%Y-%m-%d %H:%M:%S"))
+  return
+
+def _renderJob(theJob):
+  renderFile(*theJob)
+  return
+
+def updateReport(htmlDir, srcDir, covFiles, prevFiles, gitHash, gitTime, nJobs=1):
+  """Render the pages of files that changed since prevFiles in nJobs
+  processes, remove pages of files that no longer exist, and render the
+  index. Returns the list of per-file coverage deltas and the number of pages
+  rendered.
+  """
+  makedirs(htmlDir, exist_ok=True)
+  if prevFiles is None:
+    prevFiles = {}
+
+  theJobs = []
+  for fileName, fileData in covFiles.items():
+    isSame = fileName in prevFiles and prevFiles[fileName] == fileData
+    if isSame and path.isfile(path.join(htmlDir,pageName(fileName))):
+      continue
+    theJobs.append((htmlDir, srcDir, fileName, fileData))
+  nPages = len(theJobs)
+  if nJobs > 1 and nPages > 1:
+    with ProcessPoolExecutor(max_workers=min(nJobs,nPages)) as theExec:
+      list(theExec.map(_renderJob, theJobs))
+  else:
+    for theJob in theJobs:
+      _renderJob(theJob)
+
+  keepPages = set(pageName(fileName) for fileName in covFiles)
+  for htmlFile in listdir(htmlDir):
+    if htmlFile.startswith("file_") and htmlFile not in keepPages:
+      remove(path.join(htmlDir,htmlFile))
+
+  theDeltas = coverageDeltas(covFiles, prevFiles)
+  renderIndex(htmlDir, covFiles, theDeltas, gitHash, gitTime)
+
+  return theDeltas, nPages
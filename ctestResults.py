@@ -0,0 +1,130 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*
+"""SixTrack CTest Results
+
+  SixTrack CTest Results
+ ========================
+  Read the machine readable test results written by ctest, instead of parsing
+  its console output. Supports the dashboard Test.xml written when ctest runs
+  with '-T Test', and the JUnit file written with '--output-junit'. Both are
+  parsed in a single streaming pass, and give one record per test with its
+  name, status, duration in seconds and labels.
+
+"""
+
+import logging
+import xml.etree.ElementTree as ET
+from os import path, makedirs
+
+logger = logging.getLogger("SixTrackTestBuild")
+
+# Options to add to a ctest command to get the Test.xml file
+ctestXmlOpts = "-T Test --no-compress-output"
+
+def findTestXml(bDir):
+  """Find the Test.xml file of the last '-T Test' run in a build directory.
+  """
+  tagFile = path.join(bDir,"Testing","TAG")
+  if not path.isfile(tagFile):
+    return None
+  with open(tagFile,mode="r") as inFile:
+    theTag = inFile.readline().strip()
+  xmlFile = path.join(bDir,"Testing",theTag,"Test.xml")
+  if not path.isfile(xmlFile):
+    return None
+  return xmlFile
+
+def readTestXml(xmlFile):
+  theRecords = []
+  for xmlEvent, xmlElem in ET.iterparse(xmlFile, events=("end",)):
+    # The TestList section also has Test elements, but without a status
+    if xmlElem.tag != "Test" or "Status" not in xmlElem.attrib:
+      continue
+    tDuration = None
+    for xmlMeas in xmlElem.iterfind("Results/NamedMeasurement"):
+      if xmlMeas.get("name") == "Execution Time":
+        try:
+          tDuration = float(xmlMeas.findtext("Value","").strip())
+        except ValueError:
+          pass
+    theRecords.append({
+      "name"     : xmlElem.findtext("Name","").strip(),
+      "status"   : xmlElem.get("Status"),
+      "duration" : tDuration,
+      "labels"   : [xmlLabel.text.strip() for xmlLabel in xmlElem.iterfind("Labels/Label") if xmlLabel.text],
+    })
+    xmlElem.clear()
+  return theRecords
+
+def readJUnitXml(xmlFile):
+  theRecords = []
+  for xmlEvent, xmlElem in ET.iterparse(xmlFile, events=("end",)):
+    if xmlElem.tag != "testcase":
+      continue
+    if xmlElem.find("failure") is not None or xmlElem.find("error") is not None:
+      tStatus = "failed"
+    elif xmlElem.find("skipped") is not None or xmlElem.get("status") in ("disabled","notrun"):
+      tStatus = "notrun"
+    else:
+      tStatus = "passed"
+    try:
+      tDuration = float(xmlElem.get("time"))
+    except (TypeError, ValueError):
+      tDuration = None
+    tLabels = []
+    for xmlProp in xmlElem.iterfind("properties/property"):
+      if xmlProp.get("name") == "cmake_labels":
+        tLabels = [tLabel for tLabel in xmlProp.get("value","").split(";") if tLabel != ""]
+    theRecords.append({
+      "name"     : xmlElem.get("name",""),
+      "status"   : tStatus,
+      "duration" : tDuration,
+      "labels"   : tLabels,
+    })
+    xmlElem.clear()
+  return theRecords
+
+def ingestResults(bDir, junitFile=None):
+  """Read the per-test records of the last ctest run in a build directory.
+  Returns None if no machine readable results are found.
+  """
+  try:
+    if junitFile is not None and path.isfile(junitFile):
+      return readJUnitXml(junitFile)
+    xmlFile = findTestXml(bDir)
+    if xmlFile is not None:
+      return readTestXml(xmlFile)
+  except ET.ParseError as e:
+    logger.error("Failed to parse ctest results in %s" % bDir)
+    logger.error(str(e))
+  return None
+
+def writeCostData(bDir, theCosts):
+  """Write the CTestCostData.txt file ctest uses to start the most expensive
+  tests first when running in parallel. theCosts is a dictionary of test name
+  to (number of runs, average cost in seconds). Tests without history are
+  left to ctest, which then starts them first.
+  """
+  tmpDir = path.join(bDir,"Testing","Temporary")
+  makedirs(tmpDir, exist_ok=True)
+  with open(path.join(tmpDir,"CTestCostData.txt"),mode="w") as outFile:
+    for tName in sorted(theCosts):
+      nRuns, tCost = theCosts[tName]
+      outFile.write("%s %d %.6f\n" % (tName, nRuns, tCost))
+    outFile.write("---\n")
+  return
+
+def summariseResults(theRecords):
+  """Count the records the same way as CTestScanner does for console output.
+  """
+  nTotal = len(theRecords)
+  nPass  = 0
+  nFail  = 0
+  tFail  = []
+  for tRecord in theRecords:
+    if tRecord["status"] == "passed":
+      nPass += 1
+    elif tRecord["status"] == "failed":
+      nFail += 1
+      tFail.append(tRecord["name"])
+  return nTotal, nPass, nFail, tFail
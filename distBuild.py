@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*
+"""SixTrack Distributed Builds
+
+  SixTrack Distributed Builds
+ =============================
+  Run entries of the nightly build matrix on worker processes on other hosts.
+  A worker listens on a TCP port, and the nightly connects to it once for each
+  entry it may run at the same time. Messages are JSON objects, one per line.
+
+  Each matrix entry is a build command and an optional ctest command. The
+  worker checks out the requested commit in its own SixTrack clone, builds,
+  runs the tests, and sends back the build and test results together with the
+  collected simulation data. The nightly writes these to its own Results,
+  Timing and database outputs as if the entry had run locally.
+
+  Entries are claimed one at a time, by either a remote connection or the
+  local job pool, so faster hosts take more of them. If a worker drops out,
+  its entry is run locally instead.
+
+  A job only carries the fields of its matrix entry, and the worker makes the
+  cmake_six and ctest commands from them after checking each field, so no
+  shell command is ever taken from the connection. Each connection must also
+  prove it knows the secret in the key file shared by the nightly and the
+  workers, by answering a random challenge with its HMAC.
+
+  Usage:
+    distBuild.py worker <address> <port> <SixTrack clone> <key file>
+
+  The clone of a worker must have its libraries built with buildLibraries.sh,
+  the same way as the source folder of the nightly. The key file should only
+  be readable by the build user.
+
+"""
+
+import re
+import sys
+import hmac
+import json
+import time
+import shlex
+import socket
+import shutil
+import secrets
+import hashlib
+import logging
+import threading
+import socketserver
+from collections import deque
+from os import path, cpu_count
+
+from buildFunctions import setupLogging, sysCall, sysRun, cmakeSixReturn, moveStdFiles, isCommitHash, CTestScanner
+from ctestResults import ctestXmlOpts, ingestResults, writeCostData
+from simData import collectSimData
+from procMonitor import ProcMonitor
+
+logger = logging.getLogger("SixTrackTestBuild")
+
+# Allowed values of the matrix fields of a job
+validComps = ("gfortran","ifort","nagfor")
+validTypes = ("release","debug")
+validTests = ("-L","-E","-R")
+validOpt   = re.compile(r"^-?[A-Z0-9_]+$")
+
+def readSecret(keyFile):
+  with open(keyFile,mode="rb") as inFile:
+    theSecret = inFile.read().strip()
+  if len(theSecret) < 16:
+    raise ValueError("The key in %s is too short" % keyFile)
+  return theSecret
+
+def makeMac(theSecret, theNonce):
+  return hmac.new(theSecret, theNonce.encode("utf-8"), hashlib.sha256).hexdigest()
+
+def sendMsg(sockFile, theMsg):
+  sockFile.write((json.dumps(theMsg, separators=(",",":"))+"\n").encode("utf-8"))
+  sockFile.flush()
+  return
+
+def recvMsg(sockFile):
+  msgLine = sockFile.readline()
+  if not msgLine:
+    return None
+  return json.loads(msgLine.decode("utf-8"))
+
+##
+#  Coordinator
+##
+
+class RemoteWorkers:
+  """Hand matrix entries to remote workers. theWorkers is a list of (host,
+  port, number of concurrent entries), and theSecret the shared key. makeJob
+  turns an entry into the job message sent to a worker, and is called with
+  the entry and the worker host. doneFunc is called with the entry, the
+  result message and the worker host when it comes back. failFunc is called
+  with an entry that could not be completed remotely.
+  """
+
+  def __init__(self, theWorkers, theSecret, makeJob, doneFunc, failFunc, timeOut=None):
+    self.theWorkers = theWorkers
+    self.theSecret  = theSecret
+    self.makeJob    = makeJob
+    self.doneFunc   = doneFunc
+    self.failFunc   = failFunc
+    self.timeOut    = timeOut
+    self.theEntries = deque()
+    self.isClosed   = False
+    self.theCond    = threading.Condition()
+    self.theThreads = []
+    for wHost, wPort, nConn in theWorkers:
+      for iConn in range(nConn):
+        wThread = threading.Thread(target=self._runConnection, args=(wHost, wPort))
+        wThread.daemon = True
+        wThread.start()
+        self.theThreads.append(wThread)
+    return
+
+  def add(self, theEntry):
+    theEntry["claimed"] = False
+    with self.theCond:
+      self.theEntries.append(theEntry)
+      self.theCond.notify()
+    return
+
+  def claim(self, theEntry):
+    """Claim an entry. Returns False if it has already been claimed.
+    """
+    with self.theCond:
+      if theEntry.get("claimed",False):
+        return False
+      theEntry["claimed"] = True
+    return True
+
+  def close(self):
+    """No more entries will be added.
+    """
+    with self.theCond:
+      self.isClosed = True
+      self.theCond.notify_all()
+    return
+
+  def wait(self):
+    for wThread in self.theThreads:
+      wThread.join()
+    return
+
+  def _nextEntry(self):
+    with self.theCond:
+      while True:
+        while len(self.theEntries) > 0:
+          theEntry = self.theEntries.popleft()
+          if not theEntry["claimed"]:
+            theEntry["claimed"] = True
+            return theEntry
+        if self.isClosed:
+          return None
+        self.theCond.wait()
+
+  def _runConnection(self, wHost, wPort):
+    wTag = "Worker %s:%d" % (wHost, wPort)
+    try:
+      wSock = socket.create_connection((wHost, wPort), timeout=30)
+      wSock.settimeout(self.timeOut)
+      wFile = wSock.makefile(mode="rwb")
+      wHello = recvMsg(wFile)
+      sendMsg(wFile, {"type": "auth", "mac": makeMac(self.theSecret, wHello["nonce"])})
+    except Exception as e:
+      logger.error("%s: Cannot connect: %s" % (wTag, str(e)))
+      return
+    logger.info("%s: Connected to %s with %s cores" % (wTag, wHello["host"], wHello["cores"]))
+
+    while True:
+      theEntry = self._nextEntry()
+      if theEntry is None:
+        break
+      try:
+        sendMsg(wFile, self.makeJob(theEntry, wHello["host"]))
+        theResult = recvMsg(wFile)
+        if theResult is None:
+          raise ConnectionError("Connection closed by worker")
+      except Exception as e:
+        logger.error("%s: Lost connection: %s" % (wTag, str(e)))
+        self.failFunc(theEntry)
+        break
+      if "error" in theResult:
+        # Something is wrong with the worker rather than the build, so stop
+        # using it and run the entry locally
+        logger.error("%s: Job failed on the worker: %s" % (wTag, theResult["error"]))
+        self.failFunc(theEntry)
+        break
+      self.doneFunc(theEntry, theResult, wHello["host"])
+
+    try:
+      wSock.close()
+    except Exception:
+      pass
+    return
+
+##
+#  Worker
+##
+
+class BuildWorker:
+  """Run the jobs sent by the coordinator in a SixTrack clone. All jobs must
+  be for the same commit, so a new commit is only checked out when no jobs are
+  running.
+  """
+
+  def __init__(self, srcDir):
+    self.srcDir   = srcDir
+    self.currHash = None
+    self.nActive  = 0
+    self.theCond  = threading.Condition()
+    return
+
+  def runJob(self, theJob):
+    # Check the whole job before touching the clone
+    if not isCommitHash(theJob.get("hash")):
+      raise ValueError("Invalid commit hash")
+    bldCmd  = buildCommand(theJob)
+    testCmd = testCommand(theJob)
+    self._startJob(theJob["hash"])
+    try:
+      return self._runJob(theJob, bldCmd, testCmd)
+    finally:
+      with self.theCond:
+        self.nActive -= 1
+        self.theCond.notify_all()
+
+  def _startJob(self, gitHash):
+    with self.theCond:
+      while self.currHash != gitHash and self.nActive > 0:
+        self.theCond.wait()
+      if self.currHash != gitHash:
+        stdOut, stdErr, exCode = sysCall("git cat-file -e %s^{commit}" % gitHash, cwd=self.srcDir)
+        if exCode != 0:
+          sysCall("git fetch origin", cwd=self.srcDir)
+        stdOut, stdErr, exCode = sysCall("git checkout --force --detach %s" % gitHash, cwd=self.srcDir)
+        if exCode != 0:
+          self.currHash = None
+          raise RuntimeError("Failed to check out %s" % gitHash)
+        logger.info("Worker: Checked out %s" % gitHash)
+        self.currHash = gitHash
+      self.nActive += 1
+    return
+
+  def _runJob(self, theJob, bldCmd, testCmd):
+    buildNo = int(theJob["buildno"])
+    nBld    = int(theJob["nbld"])
+    bTag    = "Build %03d" % buildNo
+    bldName = "build_%03d" % buildNo
+    logger.info("%s: %s" % (bTag, bldCmd))
+
+    tStart  = time.time()
+    bldTail = deque(maxlen=1)
+    bldMon  = ProcMonitor()
+    exCode  = sysRun(
+      "MAKEFLAGS=-j%d %s" % (nBld,bldCmd), cwd=self.srcDir, logName=bldName,
+      logPath=self.srcDir, lineFuncs=[bldTail.append], timeOut=float(theJob["tbuild"]), procMon=bldMon
+    )
+    theResult = {
+      "type"      : "result",
+      "success"   : exCode == 0,
+      "buildtime" : time.time() - tStart,
+      "buildres"  : bldMon.getStats(),
+      "path"      : "",
+    }
+    if exCode != 0:
+      logger.warning("%s: Build Failed!" % bTag)
+      return theResult
+
+    bPath = cmakeSixReturn("\n".join(bldTail)+"\n","")
+    if bPath == "":
+      logger.warning("%s: Cannot find the build folder" % bTag)
+      theResult["success"] = False
+      return theResult
+    tPath = path.join(self.srcDir,bPath)
+    moveStdFiles(bldName,self.srcDir,"build",tPath)
+    theResult["path"] = bPath
+    logger.info("%s: Build Successful!" % bTag)
+    if testCmd is None:
+      shutil.rmtree(tPath, ignore_errors=True)
+      return theResult
+
+    writeCostData(tPath,theJob["costs"])
+    tStamp = time.time()
+    ctScan = CTestScanner()
+    tstMon = ProcMonitor()
+    exCode = sysRun(
+      testCmd, cwd=tPath, logName="test", logPath=tPath, lineFuncs=[ctScan.parseLine],
+      timeOut=float(theJob["ttest"]), procMon=tstMon
+    )
+    theResult["test"] = {
+      "timestamp" : tStamp,
+      "testtime"  : time.time() - tStamp,
+      "testres"   : tstMon.getStats(),
+      "passtests" : exCode == 0,
+      "records"   : ingestResults(tPath),
+      "console"   : [ctScan.nTotal, ctScan.nPass, ctScan.nFail, ctScan.tFail],
+    }
+    theResult["simdata"] = collectSimData(path.join(tPath,"test"),nBld)
+    if exCode == 0:
+      logger.info("%s: Tests Passed!" % bTag)
+      shutil.rmtree(tPath, ignore_errors=True)
+    else:
+      logger.warning("%s: Tests Failed!" % bTag)
+    return theResult
+
+def buildCommand(theJob):
+  """Make the cmake_six command of a job from its compiler, type and options.
+  """
+  if theJob["compiler"] not in validComps:
+    raise ValueError("Invalid compiler")
+  if theJob["buildtype"] not in validTypes:
+    raise ValueError("Invalid build type")
+  if not isinstance(theJob["options"], list):
+    raise ValueError("Invalid build options")
+  for bOpt in theJob["options"]:
+    if not isinstance(bOpt, str) or validOpt.match(bOpt) is None:
+      raise ValueError("Invalid build option")
+  return " ".join(["./cmake_six", theJob["compiler"], theJob["buildtype"]] + theJob["options"])
+
+def testCommand(theJob):
+  """Make the ctest command of a job from its list of test selection flags
+  and their values, or return None if it has no tests.
+  """
+  if theJob["tests"] is None:
+    return None
+  theTests = theJob["tests"]
+  if not isinstance(theTests, list) or len(theTests) % 2 != 0:
+    raise ValueError("Invalid test selection")
+  ctArgs = []
+  for tFlag, tValue in zip(theTests[0::2], theTests[1::2]):
+    if tFlag not in validTests or not isinstance(tValue, str):
+      raise ValueError("Invalid test selection")
+    ctArgs.append("%s %s" % (tFlag, shlex.quote(tValue)))
+  return "ctest %s %s -j%d" % (ctestXmlOpts, " ".join(ctArgs), int(theJob["ntest"]))
+
+class _WorkerHandler(socketserver.StreamRequestHandler):
+
+  def handle(self):
+    logger.info("Worker: Connection from %s" % self.client_address[0])
+    theNonce = secrets.token_hex(32)
+    try:
+      self.request.settimeout(30)
+      sendMsg(self.wfile, {"type": "hello", "host": socket.gethostname(), "cores": cpu_count(), "nonce": theNonce})
+      theAuth = recvMsg(self.rfile)
+      self.request.settimeout(None)
+    except Exception as e:
+      logger.warning("Worker: Handshake with %s failed: %s" % (self.client_address[0], str(e)))
+      return
+    if not isinstance(theAuth, dict) or not isinstance(theAuth.get("mac"), str) or \
+      not hmac.compare_digest(theAuth["mac"], makeMac(self.server.theSecret, theNonce)):
+      logger.warning("Worker: Rejected %s, wrong key" % self.client_address[0])
+      return
+    while True:
+      theJob = recvMsg(self.rfile)
+      if theJob is None:
+        break
+      try:
+        theResult = self.server.theWorker.runJob(theJob)
+      except Exception as e:
+        logger.exception("Worker: Job failed")
+        theResult = {"type": "result", "success": False, "buildtime": -1, "path": "", "error": str(e)}
+      sendMsg(self.wfile, theResult)
+    return
+
+def runWorker(wAddr, wPort, srcDir, keyFile):
+  socketserver.ThreadingTCPServer.allow_reuse_address = True
+  theServer = socketserver.ThreadingTCPServer((wAddr, wPort), _WorkerHandler)
+  theServer.daemon_threads = True
+  theServer.theWorker = BuildWorker(path.abspath(srcDir))
+  theServer.theSecret = readSecret(keyFile)
+  logger.info("Worker: Listening on %s:%d with %s" % (wAddr, wPort, srcDir))
+  theServer.serve_forever()
+  return
+
+if __name__ == "__main__":
+  if len(sys.argv) >= 6 and sys.argv[1] == "worker":
+    setupLogging(".",True)
+    runWorker(sys.argv[2], int(sys.argv[3]), sys.argv[4], sys.argv[5])
+  else:
+    print(__doc__)
@@ -10,16 +10,32 @@
       Geneva, Switzerland
 
   Package Dependencies:
-   - gcovr : for generating the coverage report in html
+   - gcovr : for processing the coverage data
 
 """
 
 import sys
+import json
 import time
+import shlex
 import logging
-from os import path, chdir, mkdir, listdir, system
+import threading
+from collections import deque
+from os import path, chdir, mkdir, listdir, system, cpu_count
 from datetime import datetime
 from buildFunctions import *
+from buildScheduler import JobPool
+from buildCache import BuildCache, prefixFlags
+from coverageIndex import buildCoverageIndex
+from coverageReport import collectCoverage, saveCoverage, loadCoverage, updateReport
+from ctestResults import ctestXmlOpts, ingestResults, summariseResults, writeCostData
+from timingStore import TimingStore
+from perfRegression import findRegressions
+from simData import collectSimData, parseValue, writeSimTable
+from resultsPublisher import ResultsPublisher
+from distBuild import RemoteWorkers, readSecret
+from procMonitor import ProcMonitor, summariseUsage
+from testProfiler import findProfiler, findExecutable, profFlags, profileTest, profileChanges
 
 logger = logging.getLogger("SixTrackTestBuild")
 
@@ -31,13 +47,44 @@ dRoot    = "/scratch/TestBuild"
 dLog     = "/scratch/TestBuild/Logs"
 dSource  = "/scratch/TestBuild/Source/SixTrack"
 dResults = "/scratch/TestBuild/Results"
+dSpool   = "/scratch/TestBuild/Spool"
 testTime = "/scratch/TestBuild/Timing"
+timDB    = "/scratch/TestBuild/Timing.db"
+dSimData = "/scratch/TestBuild/SimData"
 testCov  = "/scratch/TestBuild/Coverage"
+covStore = "/scratch/TestBuild/Coverage/store"
+dCache   = "/scratch/TestBuild/Cache"
+covIndex = "/scratch/TestBuild/CoverageIndex.json"
 
 nBld  = 8
 nTest = 10
 nCov  = 14
 
+# Maximum run time in seconds of a single build and a single ctest run
+tBuildMax = 2*3600
+tTestMax  = 6*3600
+
+# Number of commits of timing history used to detect performance regressions
+nPerfHist = 30
+
+# Tests run in the profiling build, and the number of functions stored per test
+profTests = ["thin4d","thin6d","thick4","thick6dblocks","fma"]
+nProfTop  = 50
+
+# Maximum size of the build cache in bytes
+maxCache = 200*1024**3
+
+# Where result bundles are sent
+stUrl = "http://sixtrack.web.cern.ch/SixTrack/build_status.php"
+
+# Total number of cores shared by all concurrent build and test jobs
+nCores = cpu_count()
+
+# Remote workers as (host, port, concurrent entries), see distBuild.py, and
+# the file with the key shared with them
+theWorkers = []
+workerKey  = "/scratch/TestBuild/WorkerKey"
+
 theCompilers = {
   "g" : {"exec" : "gfortran", "enabled" : True, "version": "--version"},
   "i" : {"exec" : "ifort",    "enabled" : True, "version": "--version"},
@@ -50,6 +97,9 @@ ctFM = "-L 'fast|medium|error'"
 ctNS = "-E 'prob'"
 ctNE = "-E 'prob|error'"
 
+# Test status written to the Timing logs for each ctest status
+ctestStatus = {"passed" : "Passed", "failed" : "Failed", "notrun" : "NotRun"}
+
 theBuilds = {
   # Label                 Compilers      Options                             Tests (rel/dbg)
   "Standard Single"    : [["g","i","n"], "32BITM -64BITM -CRLIBM -DISTLIB",  [None,None]],
@@ -75,6 +125,21 @@ theBuilds = {
 #   "Standard Double" : [["g"], "", [ctFF,ctFF]],
 # }
 
+# Incremental mode: only rebuild the entries of theBuilds affected by the changes
+# since the previous run, and carry the previous results forward for the rest.
+# Files not matched by either list below affect all builds.
+doIncr = "incremental" in sys.argv[1:]
+
+theOptFiles = {
+  "HDF5"          : ["source/*hdf5*", "lib/hdf5*"],
+  "PYTHIA"        : ["source/*pythia*", "lib/pythia*"],
+  "BEAMGAS"       : ["source/*beamgas*"],
+  "G4COLLIMATION" : ["source/*g4collimation*", "source/*geant4*"],
+  "CR"            : ["source/*checkpoint*", "source/*_cr.f90", "source/cr_*"],
+  "BOINC"         : ["source/*boinc*", "lib/boinc*"],
+}
+theSkipFiles = ["doc/*", "*.md", "LICENSE*", ".gitignore", ".github/*", ".travis.yml"]
+
 setupLogging(dLog)
 
 logger.info("*"*80)
@@ -139,6 +204,16 @@ if gitHash == prevHash:
   logger.info("")
   exit(0)
 
+affOpts = None
+if doIncr and prevHash != "None":
+  changedFiles = getChangedFiles(dSource, prevHash, gitHash)
+  if changedFiles is not None:
+    affOpts = mapChangedOptions(changedFiles, theOptFiles, theSkipFiles)
+  if affOpts is None:
+    logger.info("Incremental: Changes affect all builds")
+  else:
+    logger.info("Incremental: Changes affect options: %s" % (", ".join(sorted(affOpts)) or "None"))
+
 # We're Running This!
 
 # Stop BOINC
@@ -157,6 +232,17 @@ for bBuild in theBuilds:
   if theBuilds[bBuild][2][0] is not None or theBuilds[bBuild][2][1] is not None:
     tJobs.append(bBuild)
 
+# Results are written to the Results folder for the website, and added to the
+# bundle sent by the publisher at the end of the run. Bundles left over from
+# earlier runs are sent first.
+resPub = ResultsPublisher(dSpool, stUrl, "%s_%d" % (gitHash[:12], int(time.time())))
+resPub.flushSpool()
+
+def postResults(theData, theLabel):
+  writeResults(theData, dResults, theLabel)
+  resPub.add(theData, theLabel)
+  return
+
 theMeta = {
   "action"    : "meta",
   "runtime"   : time.time(),
@@ -173,7 +259,13 @@ theMeta = {
   "ncovloc"   : 0,
   "totloc"    : 0,
   "prevcov"   : "",
+  "perfregs"  : [],
+  "covdelta"  : [],
+  "resources" : {},
+  "profregs"  : [],
 }
+# The website shows the run as in progress until the final meta record, which
+# is the only one added to the bundle
 writeResults(theMeta, dResults, "meta")
 
 ##
@@ -202,150 +294,227 @@ else:
 #  Builds
 ##
 
-logger.info("Executing build queue ...")
-bCount   = 0
-cTests   = []
-cCleanup = []
-theTypes = ["Release","Debug"]
-for bComp in theCompilers.keys():
-  for iType in range(2):
-    for bBuild in theBuilds.keys():
-
-      bldExec = theCompilers[bComp]["exec"]
-      bldType = theTypes[iType]
-      bldComp = theBuilds[bBuild][0]
-      bldOpts = theBuilds[bBuild][1]
-      testCmd = theBuilds[bBuild][2][iType]
-      bCount += 1
-
-      # Build Command
-      sysCmd = "./cmake_six %s %s %s" % (bldExec,bldType.lower(),bldOpts)
-      sysCmd = sysCmd.strip()
-      if testCmd is not None:
-        sysCmd += " BUILD_TESTING"
-
-      logger.info("Build %03d: %s" % (bCount, sysCmd))
-
-      # Results Record
-      bStatus = {
-        "action"    : "build",
-        "timestamp" : time.time(),
-        "hash"      : gitHash,
-        "compiler"  : bldExec,
-        "type"      : bldType,
-        "build"     : False,
-        "flag"      : bBuild,
-        "command"   : sysCmd,
-        "buildno"   : bCount,
-        "success"   : False,
-        "path"      : "",
-        "testcmd"   : "",
-        "buildtime" : -1,
-      }
-
-      # Check if Should Be Built
-      if bComp in bldComp and theCompilers[bComp]["enabled"]:
+def addUsage(theStatus, theStage, theStats):
+  """Add the resources used by a build or test job to its record, and to the
+  list for the summary of the run.
+  """
+  if theStats is None:
+    return
+  theStatus[theStage+"res"] = theStats
+  with runLock:
+    cUsage.append({"flag": theStatus["flag"], "stage": theStage, "stats": theStats, "remote": "worker" in theStatus})
+  logger.info("%s %s: CPU %.0f s, parallel %.1f, peak RSS %.0f MiB, I/O %.0f/%.0f MiB" % (
+    theStatus["flag"], theStage, theStats["cputime"], theStats["parallel"], theStats["peakrss"],
+    theStats["ioread"], theStats["iowrite"]
+  ))
+  return
+
+def testCommand(testCmd):
+  return "ctest %s %s -j%d" % (ctestXmlOpts,testCmd,nTest)
+
+def runBuild(bStatus, testCmd, cacheKey):
+  """Run a single build job. Called from the job pool, so it must not change
+  the working directory. A successful build with tests is handed straight on
+  to the test queue.
+  """
+  bTag    = "Build %03d" % bStatus["buildno"]
+  bldName = "build_%03d" % bStatus["buildno"]
+  tStart  = time.time()
+  bPath  = bldCache.restore(cacheKey,dSource)
+  if bPath is None:
+    bldTail = deque(maxlen=1)
+    bldMon  = ProcMonitor()
+    exCode  = sysRun(
+      "MAKEFLAGS=-j%d %s %s" % (nBld,prefixFlags(dSource,bStatus["compiler"]),bStatus["command"]), cwd=dSource, logName=bldName, logPath=dSource,
+      lineFuncs=[bldTail.append], timeOut=tBuildMax, procMon=bldMon
+    )
+    addUsage(bStatus, "build", bldMon.getStats())
+  else:
+    logger.info("%s: Restored from build cache" % bTag)
+    bStatus["cached"] = True
+    exCode = 0
+  tEnd = time.time() - tStart
 
-        # Execute Build
-        tStart = time.time()
-        stdOut, stdErr, exCode = sysCall(sysCmd)
-        dumpStdFiles(stdOut,stdErr,"build")
-        tEnd = time.time() - tStart
-
-        # Parse Results
-        if exCode == 0:
-          logger.info(" * Build Successful!")
-          bPath = cmakeSixReturn(stdOut,stdErr)
-          stdOut, stdErr, bexCode = sysCall("mv std*.log %s" % bPath)
-          logger.info(" * Executable in: %s" % bPath)
-          bStatus["success"] = True
-          bStatus["path"]    = bPath
-          if testCmd is not None:
-            bStatus["testcmd"] = "ctest %s -j%d" % (testCmd,nTest)
-            logger.info(" * Adding executable to test queue")
-            cTests.append(bStatus)
-          else:
-            cCleanup.append(bPath)
-        else:
-          logger.warning(" * Build Failed!")
-
-        bStatus["build"]     = True
-        bStatus["buildtime"] = tEnd
-  
-      else:
-        logger.info(" * Build Skipped")
+  # Parse Results
+  toTest = False
+  if exCode == 0:
+    if not bStatus["cached"]:
+      bPath = cmakeSixReturn("\n".join(bldTail)+"\n","")
+      moveStdFiles(bldName,dSource,"build",path.join(dSource,bPath))
+      bldCache.store(cacheKey,dSource,bPath)
+    logger.info("%s: Build Successful!" % bTag)
+    logger.info("%s: Executable in: %s" % (bTag,bPath))
+    bStatus["success"] = True
+    bStatus["path"]    = bPath
+    if testCmd is not None:
+      bStatus["testcmd"] = testCommand(testCmd)
+      toTest = True
+    else:
+      with runLock:
+        cCleanup.append(bPath)
+  else:
+    logger.warning("%s: Build Failed!" % bTag)
 
-      # Send Report
-      writeResults(bStatus, dResults, hashIt("build",bStatus["command"]))
+  bStatus["build"]     = True
+  bStatus["buildtime"] = tEnd
 
-logger.info("Build queue done!")
+  # Send Report
+  postResults(bStatus, hashIt("build",bStatus["command"]))
+
+  if toTest:
+    logger.info("%s: Adding executable to test queue" % bTag)
+    # Tests go ahead of queued builds so finished builds are not left waiting
+    runPool.submit(nTest, runTest, bStatus, jobPrio=-1)
+
+  return
+
+def carryResults(bStatus, testCmd):
+  """Carry the results of a build not affected by the changes forward from the
+  previous run. The build and test records are only carried as a pair made by
+  the same run for the same build command, so a newer build record is never
+  paired with an older test record. Returns False if there are no previous
+  results to carry.
+  """
+  rLabels = [hashIt("build",bStatus["command"])]
+  if testCmd is not None:
+    rLabels.append(hashIt("test",bStatus["command"]))
+  rData = []
+  for rLabel in rLabels:
+    rFile = path.join(dResults,rLabel+".json")
+    if not path.isfile(rFile):
+      return False
+    try:
+      with open(rFile,mode="r") as inFile:
+        rData.append(json.load(inFile))
+    except Exception as e:
+      logger.error(" * Failed to read previous results")
+      logger.error(str(e))
+      return False
+  rOrigin = set()
+  for rRecord in rData:
+    if rRecord.get("command") != bStatus["command"]:
+      logger.info(" * Previous results are for a different build command")
+      return False
+    rOrigin.add((rRecord.get("carried", rRecord["hash"]), rRecord.get("buildno")))
+  if len(rOrigin) != 1:
+    logger.info(" * Previous build and test results are from different runs")
+    return False
+  if testCmd is not None and rData[1].get("testcmd") != testCommand(testCmd):
+    logger.info(" * Previous test results are for a different test selection")
+    return False
+  for rLabel, rRecord in zip(rLabels, rData):
+    # Record which commit the results were actually produced for
+    rRecord["carried"] = rRecord.get("carried", rRecord["hash"])
+    rRecord["hash"]    = gitHash
+    rRecord["buildno"] = bStatus["buildno"]
+    postResults(rRecord, rLabel)
+  return True
 
 ##
 #  Tests
 ##
 
-logger.info("Executing test queue ...")
-tCount = 0
-ntTot  = 0
-ntPass = 0
-ntFail = 0
-for toRun in cTests:
-  tCount += 1
-  chdir(path.join(dSource,toRun["path"]))
-  logger.info("Test %03d: %s" % (tCount, toRun["path"]))
-  logger.info(" * Command: %s" % (toRun["testcmd"]))
+def runTest(toRun):
+  """Run the ctest command of a single build. Called from the job pool, so it
+  must not change the working directory.
+  """
+  global tCount
+
+  tPath  = path.join(dSource,toRun["path"])
+  with runLock:
+    tCount += 1
+    tNum    = tCount
+  tTag = "Test %03d" % tNum
+  logger.info("%s: %s" % (tTag, toRun["path"]))
+  logger.info("%s: Command: %s" % (tTag, toRun["testcmd"]))
   tStatus = toRun
   tStatus["action"]    = "test"
-  tStatus["testno"]    = tCount
+  tStatus["testno"]    = tNum
   tStatus["timestamp"] = time.time()
 
+  # Let ctest start the longest running tests first
+  writeCostData(tPath,timStore.getTestCosts(toRun["compiler"],toRun["type"],nPerfHist))
+
   tStart = time.time()
-  stdOut, stdErr, exCode = sysCall(toRun["testcmd"])
-  dumpStdFiles(stdOut,stdErr,"test")
+  ctScan = CTestScanner()
+  tstMon = ProcMonitor()
+  exCode = sysRun(
+    toRun["testcmd"], cwd=tPath, logName="test", logPath=tPath, lineFuncs=[ctScan.parseLine], timeOut=tTestMax,
+    procMon=tstMon
+  )
   tEnd = time.time() - tStart
+  addUsage(tStatus, "test", tstMon.getStats())
   tStatus["testtime"] = tEnd
 
-  chdir(dSource)
   if exCode == 0:
-    logger.info(" * Tests Passed!")
+    logger.info("%s: Tests Passed!" % tTag)
     tStatus["passtests"] = True
-    cCleanup.append(toRun["path"])
+    with runLock:
+      cCleanup.append(toRun["path"])
   else:
-    logger.warning(" * Tests Failed!")
+    logger.warning("%s: Tests Failed!" % tTag)
     tStatus["passtests"] = False
 
-  nTotal, nPass, nFail, tFail = ctestResult(stdOut,stdErr)
+  ctCounts = (ctScan.nTotal, ctScan.nPass, ctScan.nFail, ctScan.tFail)
+  reportTest(tStatus, tTag, ingestResults(tPath), ctCounts, collectSimData(path.join(tPath,"test"),nTest))
+
+  return
+
+def reportTest(tStatus, tTag, tRecords, ctCounts, simRows):
+  """Count and send the results of a ctest run, and log the test timings. The
+  run may have been local or on a remote worker.
+  """
+  global ntTot, ntPass, ntFail
+
+  # Prefer the structured results, and only fall back to the console output
+  if tRecords is None:
+    logger.warning("%s: No ctest XML results, using console output" % tTag)
+    tRecords = []
+    nTotal, nPass, nFail, tFail = ctCounts
+  else:
+    nTotal, nPass, nFail, tFail = summariseResults(tRecords)
+  tByName = {tRecord["name"]: tRecord for tRecord in tRecords}
   for failName in tFail:
-    logger.warning(" * Failed: %s" % failName)
+    logger.warning("%s: Failed: %s" % (tTag, failName))
 
   tStatus["failed"] = ", ".join(tFail)
   tStatus["ntotal"] = nTotal
   tStatus["npass"]  = nPass
   tStatus["nfail"]  = nFail
+  tStatus["tests"]  = tRecords
 
-  ntTot  += nTotal
-  ntPass += nPass
-  ntFail += nFail
+  with runLock:
+    ntTot  += nTotal
+    ntPass += nPass
+    ntFail += nFail
 
   # Send Report
-  writeResults(tStatus, dResults, hashIt("test",tStatus["command"]))
+  postResults(tStatus, hashIt("test",tStatus["command"]))
 
   # Log Timing
-  for tItem in listdir(path.join(toRun["path"],"test")):
+  writeSimTable(simRows,path.join(dSimData,gitHash,hashIt("test",tStatus["command"])+".json.gz"))
+  for tItem in simRows:
     if tItem[:6] == "error_":
       continue
-    tPath = path.join(toRun["path"],"test",tItem)
-    if path.isdir(tPath):
-      execTime = getExecTime(tPath)
-      if execTime is None:
-        continue
-      timPath = path.join(testTime,tItem+".log")
-      if tItem in tFail:
-        tRes = "Failed"
-      else:
-        tRes = "Passed"
+    if simRows[tItem]["sim_time"] is None:
+      continue
+    execTime = simRows[tItem]["sim_time"].get("Stamp_BeforeExit","Unknown")
+    timPath = path.join(testTime,tItem+".log")
+    if tItem in tByName:
+      tRes = ctestStatus.get(tByName[tItem]["status"],"Passed")
+    elif tItem in tFail:
+      tRes = "Failed"
+    else:
+      tRes = "Passed"
+    tStamp = datetime.fromtimestamp(tStatus["timestamp"]).strftime("%Y-%m-%d %H:%M:%S")
+    ctestTime = tByName[tItem]["duration"] if tItem in tByName else None
+    timStore.addTiming(tItem,gitHash,gitTime,tStamp,tStatus["command"][12:],parseValue(execTime),tRes,ctestTime,tStatus.get("worker"))
+    if "worker" in tStatus:
+      # The Timing logs have no host, so only the local times go there
+      continue
+    # The same test runs for many builds, so appends must not interleave
+    with runLock:
       with open(timPath,mode="a") as outFile:
-        tStamp = datetime.fromtimestamp(tStatus["timestamp"]).strftime("%Y-%m-%d %H:%M:%S")
         outFile.write("[%s]  %40s  %19s  %14s  %6s  Build: %s\n" % (
           tStamp,
           gitHash,
@@ -355,49 +524,78 @@ for toRun in cTests:
           tStatus["command"][12:]
         ))
 
-logger.info("Test queue done!")
+  return
 
 ##
-#  Coverage
+#  Coverage, Memory Usage and Profiling
 ##
 
-logger.info("Beginning coverage ...")
+def runSpecialBuild(sStatus, postFunc):
+  """Build one of the special configurations, and queue its tests. These are
+  run in the same job pool as the build matrix, and get their own records.
+  """
+  sTag    = sStatus["flag"]
+  bldName = "build_%03d" % sStatus["buildno"]
+  logger.info("%s Build: %s" % (sTag, sStatus["command"]))
+  tStart  = time.time()
+  bldTail = deque(maxlen=1)
+  bldMon  = ProcMonitor()
+  bexCode = sysRun(
+    sStatus["command"], cwd=dSource, logName=bldName, logPath=dSource,
+    lineFuncs=[bldTail.append], timeOut=tBuildMax, procMon=bldMon
+  )
+  addUsage(sStatus, "build", bldMon.getStats())
+  sStatus["build"]     = True
+  sStatus["buildtime"] = time.time() - tStart
+
+  if bexCode == 0:
+    bPath = cmakeSixReturn("\n".join(bldTail)+"\n","")
+    moveStdFiles(bldName,dSource,"build",path.join(dSource,bPath))
+    logger.info("%s: Build Successful!" % sTag)
+    logger.info("%s: Executable in: %s" % (sTag, bPath))
+    sStatus["success"] = True
+    sStatus["path"]    = bPath
+  else:
+    logger.warning("%s: Build Failed!" % sTag)
 
-chdir(dSource)
-sysCmd = "./cmake_six gfortran release BUILD_TESTING COVERAGE"
-logger.info("Coverage Build: %s" % sysCmd)
-tStart = time.time()
-stdOut, stdErr, bexCode = sysCall(sysCmd)
-dumpStdFiles(stdOut,stdErr,"build")
-tEnd = time.time() - tStart
-
-if bexCode == 0:
-  logger.info(" * Coverage Build Successful!")
-  bPath = cmakeSixReturn(stdOut,stdErr)
-  stdOut, stdErr, bexCode = sysCall("mv std*.log %s" % bPath)
-  logger.info(" * Executable in: %s" % bPath)
-
-  # Run Tests
-  chdir(path.join(dSource,bPath))
-  sysCmd = "ctest -E prob -j%d" % nCov
-# sysCmd = "ctest -R dynk -j%d" % nCov
-  logger.info("Coverage Test: %s" % sysCmd)
-  tStart = time.time()
-  stdOut, stdErr, texCode = sysCall(sysCmd)
-  dumpStdFiles(stdOut,stdErr,"test")
-  tEnd = time.time() - tStart
+  postResults(sStatus, hashIt("build",sStatus["command"]))
+
+  if bexCode == 0:
+    runPool.submit(nCov, runSpecialTest, sStatus, postFunc, jobPrio=-1)
+
+  return
+
+def runSpecialTest(sStatus, postFunc):
+  sTag = sStatus["flag"]
+  bDir = path.join(dSource,sStatus["path"])
+  logger.info("%s Test: %s" % (sTag, sStatus["testcmd"]))
+  sStatus["action"]    = "test"
+  sStatus["timestamp"] = time.time()
+  tStart  = time.time()
+  tstMon  = ProcMonitor()
+  texCode = sysRun(sStatus["testcmd"], cwd=bDir, logName="test", logPath=bDir, timeOut=tTestMax, procMon=tstMon)
+  addUsage(sStatus, "test", tstMon.getStats())
+  sStatus["testtime"]  = time.time() - tStart
+  sStatus["passtests"] = texCode == 0
 
   if texCode == 0:
-    logger.info(" * Coverage Tests Completed!")
-    # cCleanup.append(bPath)
+    logger.info("%s: Tests Completed!" % sTag)
   else:
-    logger.warning(" * Coverage Tests Failed!")
+    logger.warning("%s: Tests Failed!" % sTag)
+
+  postFunc(sStatus, bDir)
+  postResults(sStatus, hashIt("test",sStatus["command"]))
+  logger.info("%s done!" % sTag)
+
+  return
+
+def postCoverage(sStatus, bDir):
 
   # Compute Coverage w/CMake
   sysCmd = "ctest -D NightlyCoverage | tail -n4"
   logger.info("Calculating Coverage: %s" % sysCmd)
-  stdOut, stdErr, cexCode = sysCall(sysCmd)
-  dumpStdFiles(stdOut,stdErr,"coverage")
+  stdOut, stdErr, cexCode = sysCall(sysCmd,cwd=bDir)
+  dumpStdFiles(stdOut,stdErr,"coverage",bDir)
 
   nTot, cLoc, nLoc = ctestCoverage(stdOut,stdErr)
   theMeta["coverage"] = True
@@ -408,9 +606,11 @@ if bexCode == 0:
 
   logger.info(" * Coverage is: %6.2f %%" % rCov)
 
+  prevCovHash = None
   if path.isfile(path.join(dRoot,"prevCoverage.dat")):
     with open(path.join(dRoot,"prevCoverage.dat"),mode="r") as cFile:
       theMeta["prevcov"] = cFile.read()
+    prevCovHash = theMeta["prevcov"].split(";")[0]
   with open(path.join(dRoot,"prevCoverage.dat"),mode="w") as cFile:
     cFile.write("%s;%s;%s;%s" % (gitHash,nTot,cLoc,nLoc))
   with open(path.join(dRoot,"Coverage.log"),mode="a") as outFile:
@@ -418,86 +618,330 @@ if bexCode == 0:
       gitHash,gitTime,cLoc,nLoc,nTot,rCov
     ))
 
-  # Create HTML Report w/gcovr
-  chdir(path.join(dSource,bPath))
-  cPath = path.join(testCov,"html")
-  if not path.isdir(cPath):
-    mkdir(cPath)
-  stdOut, stdErr, exCode = sysCall("rm %s/*" % cPath)
-  stdOut, stdErr, exCode = sysCall("echo \"%s\" > %s/githash.txt" % (gitHash,cPath))
-  stdOut, stdErr, exCode = sysCall("echo \"%s\" >> %s/githash.txt" % (gitTime,cPath))
-  stdOut, stdErr, exCode = sysCall(
-    "gcovr -o %s/index.html -p -s --html-details --html-medium-threshold 50 --html-high-threshold 80 --html-title SixTrack" % cPath
-  )
-  if exCode == 0:
-    logger.info(" * Generated Report!")
-    logWrap("GCOVR", stdOut, stdErr, exCode)
-    chdir(testCov)
-    stdOut, stdErr, exCode = sysCall("tar -czf %s.tgz html" % gitHash)
+  # Create HTML Report, only rendering the files that changed
+  cPath    = path.join(testCov,"html")
+  covFiles = collectCoverage(bDir,dSource,nCov)
+  if covFiles is not None:
+    saveCoverage(covStore,gitHash,covFiles)
+    prevFiles = loadCoverage(covStore,prevCovHash)
+    if prevFiles is None:
+      logger.info(" * No previous coverage data, rendering all pages")
+    covDeltas, nPages = updateReport(cPath,dSource,covFiles,prevFiles,gitHash,gitTime,nCov)
+    with open(path.join(cPath,"githash.txt"),mode="w") as outFile:
+      outFile.write("%s\n%s\n" % (gitHash,gitTime))
+    logger.info(" * Generated Report! Rendered %d of %d pages" % (nPages,len(covFiles)))
+    theMeta["covdelta"] = [covDelta for covDelta in covDeltas if covDelta["delta"] != 0.0]
+    for covDelta in theMeta["covdelta"]:
+      if covDelta["delta"] is None:
+        logger.info(" * Coverage: %-50s %s" % (covDelta["file"],"Removed" if covDelta["curr"] is None else "New"))
+      else:
+        logger.info(" * Coverage: %-50s %+7.2f %%" % (covDelta["file"],covDelta["delta"]))
+    stdOut, stdErr, exCode = sysCall("tar -czf %s.tgz html" % gitHash,cwd=testCov)
   else:
     logger.warning(" * Generating Report Failed!")
 
-else:
-  logger.warning(" * Coverage Build Failed!")
+  # Per-Test Coverage Index for quickBuild.py
+  logger.info("Building per-test coverage index ...")
+  nIdx = buildCoverageIndex(bDir,dSource,covIndex,gitHash,"-E prob",nCov)
+  logger.info(" * Indexed %d tests" % nIdx)
 
-chdir(dSource)
-logger.info("Coverage done!")
+  return
+
+def postProfile(sStatus, bDir):
+
+  if sStatus["passtests"]:
+    with runLock:
+      cCleanup.append(sStatus["path"])
+
+  exeFile = findExecutable(bDir)
+  if exeFile is None:
+    logger.warning(" * Cannot find the SixTrack executable in %s" % bDir)
+    return
+
+  # Profile each test, and compare to the history of the same test
+  for tName in profTests:
+    pRows = profileTest(bDir,tName,profTool,exeFile)
+    if pRows is None:
+      continue
+    timStore.addProfile(tName,gitHash,gitTime,profTool,pRows[:nProfTop])
+    logger.info(" * Profiled %s: %s" % (tName,", ".join(
+      "%s %.1f %%" % (pRow["function"],pRow["percent"]) for pRow in pRows[:3]
+    )))
+    for funcChange in profileChanges(timStore.getProfiles(tName,nPerfHist)):
+      funcChange["test"] = tName
+      theMeta["profregs"].append(funcChange)
+      logger.warning(" * Slower: %s in %s: %.3f s, up %+.1f %% from %.3f s" % (
+        funcChange["function"],tName,funcChange["selftime"],100*funcChange["rise"],funcChange["previous"]
+      ))
+
+  return
+
+def postMemUsage(sStatus, bDir):
+
+  if sStatus["passtests"]:
+    with runLock:
+      cCleanup.append(sStatus["path"])
+
+  # Compute Memory Usage
+  simRows = collectSimData(path.join(bDir,"test"),nCov)
+  writeSimTable(simRows,path.join(dSimData,gitHash,"memusage.json.gz"))
+  for tItem in simRows:
+    simMeta = simRows[tItem]["sim_meta"]
+    if simMeta is None:
+      continue
+    memHWM   = simMeta.get("Exec_VmHWM[MiB]","Unknown")
+    memPeak  = simMeta.get("Exec_VmPeak[MiB]","Unknown")
+    memAlloc = simMeta.get("PeakDynamicMemAlloc[MiB]","Unknown")
+    with open(path.join(dRoot,"MemUsage.log"),mode="a") as outFile:
+      outFile.write("%40s  %19s  %-40s  %12s  %12s  %12s\n" % (
+        gitHash,gitTime,tItem,memAlloc,memHWM,memPeak
+      ))
+
+  return
 
 ##
-#  Memory Usage
+#  Remote Workers
 ##
 
-logger.info("Beginning memory usage ...")
+def runEntry(theEntry):
+  """Run a matrix entry locally, unless a remote worker got to it first.
+  """
+  if distWork is not None and not distWork.claim(theEntry):
+    return
+  runBuild(theEntry["status"], theEntry["testcmd"], theEntry["cachekey"])
+  return
+
+def makeRemoteJob(theEntry, wHost):
+  # The worker makes the build and test commands from these fields
+  bStatus = theEntry["status"]
+  return {
+    "type"      : "job",
+    "hash"      : gitHash,
+    "buildno"   : bStatus["buildno"],
+    "compiler"  : bStatus["compiler"],
+    "buildtype" : bStatus["type"].lower(),
+    "options"   : theEntry["options"],
+    "tests"     : None if theEntry["testcmd"] is None else shlex.split(theEntry["testcmd"]),
+    "costs"     : timStore.getTestCosts(bStatus["compiler"],bStatus["type"],nPerfHist,wHost),
+    "nbld"      : nBld,
+    "ntest"     : nTest,
+    "tbuild"    : tBuildMax,
+    "ttest"     : tTestMax,
+  }
+
+def mergeRemote(theEntry, theResult, wHost):
+  """Record the results of a matrix entry that ran on a remote worker, the
+  same way as for a local build and test.
+  """
+  global tCount
+
+  bStatus = theEntry["status"]
+  bTag    = "Build %03d" % bStatus["buildno"]
+  bStatus["worker"]    = wHost
+  bStatus["build"]     = True
+  bStatus["buildtime"] = theResult["buildtime"]
+  addUsage(bStatus, "build", theResult.get("buildres"))
+  if theResult["success"]:
+    logger.info("%s: Build Successful on %s!" % (bTag,wHost))
+    bStatus["success"] = True
+    bStatus["path"]    = theResult["path"]
+    if theEntry["testcmd"] is not None:
+      bStatus["testcmd"] = testCommand(theEntry["testcmd"])
+  else:
+    logger.warning("%s: Build Failed on %s!" % (bTag,wHost))
+  postResults(bStatus, hashIt("build",bStatus["command"]))
+
+  if "test" not in theResult:
+    return
+
+  tResult = theResult["test"]
+  with runLock:
+    tCount += 1
+    tNum    = tCount
+  tTag = "Test %03d" % tNum
+  tStatus = bStatus
+  tStatus["action"]    = "test"
+  tStatus["testno"]    = tNum
+  tStatus["timestamp"] = tResult["timestamp"]
+  tStatus["testtime"]  = tResult["testtime"]
+  tStatus["passtests"] = tResult["passtests"]
+  addUsage(tStatus, "test", tResult.get("testres"))
+  if tResult["passtests"]:
+    logger.info("%s: Tests Passed on %s!" % (tTag,wHost))
+  else:
+    logger.warning("%s: Tests Failed on %s!" % (tTag,wHost))
+  reportTest(tStatus, tTag, tResult["records"], tResult["console"], theResult["simdata"])
 
-chdir(dSource)
-sysCmd = "./cmake_six gfortran release BUILD_TESTING MEMUSAGE"
-logger.info("MemUsage Build: %s" % sysCmd)
-tStart = time.time()
-stdOut, stdErr, bexCode = sysCall(sysCmd)
-dumpStdFiles(stdOut,stdErr,"build")
-tEnd = time.time() - tStart
-
-if bexCode == 0:
-  logger.info(" * Memory Usage Build Successful!")
-  bPath = cmakeSixReturn(stdOut,stdErr)
-  stdOut, stdErr, bexCode = sysCall("mv std*.log %s" % bPath)
-  logger.info(" * Executable in: %s" % bPath)
-
-  # Run Tests
-  chdir(path.join(dSource,bPath))
-  sysCmd = "ctest -E 'prob|error' -j%d" % nCov
-# sysCmd = "ctest -R dynk -j%d" % nCov
-  logger.info("Memory Usage Test: %s" % sysCmd)
-  tStart = time.time()
-  stdOut, stdErr, texCode = sysCall(sysCmd)
-  dumpStdFiles(stdOut,stdErr,"test")
-  tEnd = time.time() - tStart
+  return
 
-  if texCode == 0:
-    logger.info(" * Memory Usage Tests Completed!")
-    cCleanup.append(bPath)
-  else:
-    logger.warning(" * Memory Usage Tests Failed!")
+def failRemote(theEntry):
+  logger.warning("Build %03d: Remote worker failed, running it locally" % theEntry["status"]["buildno"])
+  runPool.submit(nBld, runBuild, theEntry["status"], theEntry["testcmd"], theEntry["cachekey"])
+  return
 
-  # Compute Memory Usage
-  for tItem in listdir("test"):
-    tPath = path.join("test",tItem)
-    if path.isdir(tPath):
-      memHWM   = getSimMeta(tPath,"Exec_VmHWM[MiB]")
-      memPeak  = getSimMeta(tPath,"Exec_VmPeak[MiB]")
-      memAlloc = getSimMeta(tPath,"PeakDynamicMemAlloc[MiB]")
-      if memHWM is None and memPeak is None and memAlloc is None:
-        continue
-      with open(path.join(dRoot,"MemUsage.log"),mode="a") as outFile:
-        outFile.write("%40s  %19s  %-40s  %12s  %12s  %12s\n" % (
-          gitHash,gitTime,tItem,memAlloc,memHWM,memPeak
-        ))
+##
+#  Build and Test Queue
+##
 
+logger.info("Executing build and test queue ...")
+bCount   = 0
+tCount   = 0
+ntTot    = 0
+ntPass   = 0
+ntFail   = 0
+cCleanup = []
+cSpecial = []
+cUsage   = []
+tQueue   = time.time()
+theTypes = ["Release","Debug"]
+runPool  = JobPool(nCores)
+runLock  = threading.Lock()
+bldCache = BuildCache(dCache,maxCache)
+timStore = TimingStore(timDB)
+distWork = None
+if len(theWorkers) > 0:
+  distWork = RemoteWorkers(theWorkers, readSecret(workerKey), makeRemoteJob, mergeRemote, failRemote, tBuildMax+tTestMax+600)
+
+theSpecial = [
+  # Label           Option      Tests              Post-processing
+  ["Coverage",      "COVERAGE", "-E prob",         postCoverage],
+  ["Memory Usage",  "MEMUSAGE", "-E 'prob|error'", postMemUsage],
+]
+
+# The special builds are the longest chains, so they are queued first. They
+# are numbered after the build matrix to keep the matrix numbering unchanged.
+nMatrix = len(theCompilers)*len(theTypes)*len(theBuilds)
+for sFlag, sOpt, sTest, postFunc in theSpecial:
+  sCmd = "./cmake_six gfortran release BUILD_TESTING %s" % sOpt
+  sStatus = {
+    "action"    : "build",
+    "timestamp" : time.time(),
+    "hash"      : gitHash,
+    "compiler"  : "gfortran",
+    "type"      : "Release",
+    "build"     : False,
+    "flag"      : sFlag,
+    "command"   : sCmd,
+    "buildno"   : nMatrix + len(cSpecial) + 1,
+    "success"   : False,
+    "path"      : "",
+    "testcmd"   : "ctest %s -j%d" % (sTest,nCov),
+    "buildtime" : -1,
+  }
+  cSpecial.append(sStatus)
+  runPool.submit(nBld, runSpecialBuild, sStatus, postFunc)
+
+# The profiling build is made with cmake directly, since it needs its own
+# compiler flags and build folder. The folder is echoed last for the parser.
+profTool = findProfiler()
+if profTool is None:
+  logger.warning("No profiler found, skipping the profiling build")
 else:
-  logger.warning(" * Memory Usage Build Failed!")
+  logger.info("Profiling with: %s" % profTool)
+  pDir = "build/SixTrack_profile_%s" % profTool
+  pCmd = "mkdir -p %s && cd %s && cmake -DCMAKE_Fortran_COMPILER=gfortran -DCMAKE_BUILD_TYPE=Release " \
+         "-DBUILD_TESTING=ON -DCMAKE_Fortran_FLAGS='%s' -DCMAKE_EXE_LINKER_FLAGS='%s' ../.. && make -j%d && " \
+         "echo Built in %s" % (pDir,pDir,profFlags[profTool][0],profFlags[profTool][1],nBld,pDir)
+  sStatus = {
+    "action"    : "build",
+    "timestamp" : time.time(),
+    "hash"      : gitHash,
+    "compiler"  : "gfortran",
+    "type"      : "Release",
+    "build"     : False,
+    "flag"      : "Profiling",
+    "command"   : pCmd,
+    "buildno"   : nMatrix + len(cSpecial) + 1,
+    "success"   : False,
+    "path"      : "",
+    "testcmd"   : "ctest -R '^(%s)$' -j%d" % ("|".join(profTests),nCov),
+    "buildtime" : -1,
+  }
+  cSpecial.append(sStatus)
+  runPool.submit(nBld, runSpecialBuild, sStatus, postProfile)
 
-chdir(dSource)
-logger.info("Memory usage done!")
+for bComp in theCompilers.keys():
+  for iType in range(2):
+    for bBuild in theBuilds.keys():
+
+      bldExec = theCompilers[bComp]["exec"]
+      bldType = theTypes[iType]
+      bldComp = theBuilds[bBuild][0]
+      bldOpts = theBuilds[bBuild][1]
+      testCmd = theBuilds[bBuild][2][iType]
+      bCount += 1
+
+      # Build Command
+      sysCmd = "./cmake_six %s %s %s" % (bldExec,bldType.lower(),bldOpts)
+      sysCmd = sysCmd.strip()
+      if testCmd is not None:
+        sysCmd += " BUILD_TESTING"
+
+      logger.info("Build %03d: %s" % (bCount, sysCmd))
+
+      # Results Record
+      bStatus = {
+        "action"    : "build",
+        "timestamp" : time.time(),
+        "hash"      : gitHash,
+        "compiler"  : bldExec,
+        "type"      : bldType,
+        "build"     : False,
+        "flag"      : bBuild,
+        "command"   : sysCmd,
+        "buildno"   : bCount,
+        "success"   : False,
+        "path"      : "",
+        "testcmd"   : "",
+        "buildtime" : -1,
+        "cached"    : False,
+      }
+
+      # Check if Should Be Built
+      if bComp in bldComp and theCompilers[bComp]["enabled"]:
+        if affOpts is not None and not buildHasOptions(bldOpts, affOpts):
+          if carryResults(bStatus, testCmd):
+            logger.info(" * Not affected by changes, results carried forward")
+            continue
+          logger.info(" * No previous results to carry forward")
+        cacheOpts = bldOpts
+        if testCmd is not None:
+          cacheOpts += " BUILD_TESTING"
+        cacheKey = bldCache.makeKey(dSource,theCompilers[bComp]["version"],bldType,cacheOpts)
+        logger.info(" * Adding to build queue")
+        theEntry = {"status": bStatus, "testcmd": testCmd, "cachekey": cacheKey, "options": cacheOpts.split()}
+        if distWork is not None:
+          distWork.add(theEntry)
+        runPool.submit(nBld, runEntry, theEntry)
+      else:
+        logger.info(" * Build Skipped")
+        postResults(bStatus, hashIt("build",bStatus["command"]))
+
+if distWork is not None:
+  distWork.close()
+  distWork.wait()
+runPool.wait()
+
+logger.info("Build and test queue done!")
+
+##
+#  Resource Usage
+##
+
+theUsage = summariseUsage(cUsage, time.time() - tQueue, nCores)
+theMeta["resources"] = theUsage
+logger.info("Resources used by the build and test queue:")
+logger.info(" * CPU time:   %.0f s" % theUsage["cputime"])
+logger.info(" * Wall time:  %.0f s" % theUsage["walltime"])
+logger.info(" * Saturation: %.1f %% of %d cores" % (100*theUsage["saturation"],nCores))
+for flagSum in theUsage["byflag"]:
+  logger.info(" * %-20s CPU %8.0f s  parallel %5.2f  peak RSS %7.0f MiB  I/O %7.0f/%7.0f MiB" % (
+    flagSum["flag"],flagSum["cputime"],flagSum["parallel"],flagSum["peakrss"],flagSum["ioread"],flagSum["iowrite"]
+  ))
+with open(path.join(dRoot,"Resources.log"),mode="a") as outFile:
+  outFile.write("%40s  %19s  %10.0f  %8.0f  %4d  %6.3f\n" % (
+    gitHash,gitTime,theUsage["cputime"],theUsage["walltime"],nCores,theUsage["saturation"]
+  ))
 
 ##
 #  Cleanup
@@ -512,12 +956,26 @@ for rPath in cCleanup:
     logger.info("Deleting: %s ... Failed" % rPath)
 logger.info("Cleanup done!")
 
+##
+#  Performance Regressions
+##
+
+logger.info("Checking for performance regressions ...")
+perfRegs = findRegressions(timStore.getRecent(nPerfHist), gitHash)
+theMeta["perfregs"] = perfRegs
+for perfReg in perfRegs:
+  logger.warning(" * Slower: %-40s %-8s %-7s %+6.1f %%  (z = %.1f, builds = %d)" % (
+    perfReg["test"],perfReg["compiler"],perfReg["type"],100*perfReg["slowdown"],perfReg["zscore"],perfReg["nbuilds"]
+  ))
+logger.info("Found %d performance regressions" % len(perfRegs))
+
 ##
 #  Finish
 ##
 
 theMeta["endtime"] = time.time()
-writeResults(theMeta, dResults, "meta")
+postResults(theMeta, "meta")
+resPub.publish()
 
 with open(path.join(dRoot,"Builds.log"),mode="a") as outFile:
   outFile.write("%40s  %19s  %-10s  %19s  %19s  %5d  %5d  %5d  %5d  %5d  %s\n" % (
@@ -1,108 +1,531 @@
 #!/usr/bin/env python3
+"""SixTrack Particle Splatter
 
+  SixTrack Particle Splatter
+ ============================
+  Generate matched Gaussian particle distributions, and check them.
+
+  As a module, generateParticles makes a 4D or 6D distribution matched to the
+  Twiss parameters and emittance of each plane, and writeDist writes one in
+  the SixTrack initial distribution format read by the DIST block. The
+  particles are generated in chunks spread over several processes. Each chunk
+  has its own random stream spawned from one seed, so the same seed and chunk
+  size always give the same particles, whatever the number of processes.
+
+  The default mode generates all particles in memory and plots them. The
+  stream mode generates them in chunks of a fixed size, and writes them
+  straight to a memory mapped .npy file with the columns X, X', Y, Y'. The
+  moments are updated chunk by chunk, so the memory used does not depend on
+  the number of particles. The check mode reads such a file chunk by chunk,
+  and the dist mode writes a 4D distribution with the Twiss parameters below
+  in both planes to a SixTrack DIST file.
+
+  The distributions are checked with ParticleCheck, which updates the
+  covariance and emittances, and histograms on a fixed grid, one chunk at a
+  time. The plots are made from these histograms, and are saved to an image
+  file instead of shown when one is given, so no display is needed.
+
+  Usage:
+    particleSplatter.py [plot <image file>]
+    particleSplatter.py stream <output file> [<particles>] [<chunk size>]
+    particleSplatter.py check <.npy file> [<image file>] [<chunk size>]
+    particleSplatter.py dist <output file> [<particles>] [<seed>]
+
+"""
+
+import io
+import sys
+import shutil
 import numpy as np
-import matplotlib.pyplot as plt
-import matplotlib.gridspec as gridspec
-from matplotlib import cm
+import multiprocessing
+from os import cpu_count, remove, path
+from numpy.lib.format import open_memmap
 
 nPart  = 10000000
+nChunk = 1000000
 emitX  = 1.0
 betaX  = 1.0
 alphaX = 0.3
-gammaX = 1+alphaX**2 / betaX
+gammaX = (1+alphaX**2)/betaX
 
 sigmX  = np.array([[betaX, -alphaX], [-alphaX, gammaX]])
 cholX  = np.linalg.cholesky(sigmX*emitX)
+sqrtB  = np.sqrt(betaX)
+
+# Twiss parameters of the dist mode. The Y plane of the demo is matched to the
+# X plane, so there are no separate Y parameters, and both planes use X.
+defTwiss = [(betaX, alphaX, emitX), (betaX, alphaX, emitX)]
+
+# Reference particle for DIST files. Momentum in GeV/c and mass in GeV/c^2
+pRef   = 450.0
+mRef   = 0.93827208816
+cLight = 299792458.0
+
+def twissMatrix(betaV, alphaV, emitV):
+  """The 2x2 beam matrix of one plane from its Twiss parameters and emittance.
+  """
+  gammaV = (1+alphaV**2)/betaV
+  return emitV*np.array([[betaV, -alphaV], [-alphaV, gammaV]])
+
+def beamMatrix(theTwiss):
+  """The block diagonal beam matrix of a 4D or 6D distribution. theTwiss is a
+  list of (beta, alpha, emittance) for each plane, in the order X, Y and
+  optionally the longitudinal plane. Lengths are in m and angles in rad. The
+  longitudinal plane is (z, delta), so its emittance is in m.
+  """
+  nDim  = 2*len(theTwiss)
+  beamM = np.zeros((nDim,nDim))
+  for iPlane, (betaV, alphaV, emitV) in enumerate(theTwiss):
+    beamM[2*iPlane:2*iPlane+2,2*iPlane:2*iPlane+2] = twissMatrix(betaV, alphaV, emitV)
+  return beamM
+
+def matchParticles(distX, nAng):
+  """Transform normal distributed numbers to the X plane, and match the Y
+  plane to it. distX has two columns, and nAng one value per particle.
+  """
+  beamX = np.dot(distX, cholX)
+  xPos  = beamX[:,1]
+  xAng  = beamX[:,0]
+  yAng  = nAng/sqrtB - alphaX/betaX*xPos
+  yPos  = (nAng - sqrtB*yAng)*sqrtB/alphaX
+  return xPos, xAng, yPos, yAng
+
+
+##
+#  Statistics
+##
+
+class RunningMoments:
+  """Mean and covariance of the columns of a data set that is added in
+  chunks. Each chunk is reduced to its mean and the sum of the products of
+  its deviations from it, which are merged into the totals with the pairwise
+  update of Chan et al. Unlike plain sums of squares, this does not lose
+  precision when the mean is large compared to the spread.
+  """
+
+  def __init__(self, nCols):
+    self.nRows   = 0
+    self.theMean = np.zeros(nCols)
+    self.theM2   = np.zeros((nCols,nCols))
+    return
+
+  def add(self, theChunk):
+    if theChunk.shape[0] == 0:
+      return
+    cMean = np.mean(theChunk, axis=0)
+    cDev  = theChunk - cMean
+    self._merge(theChunk.shape[0], cMean, np.dot(cDev.T, cDev))
+    return
+
+  def merge(self, theOther):
+    if theOther.nRows > 0:
+      self._merge(theOther.nRows, theOther.theMean, theOther.theM2)
+    return
+
+  def mean(self):
+    return self.theMean.copy()
+
+  def cov(self):
+    return self.theM2/(self.nRows-1)
+
+  def emittance(self, iCol):
+    """The emittance of the plane with the position in column iCol.
+    """
+    return np.sqrt(np.linalg.det(self.cov()[iCol:iCol+2,iCol:iCol+2]))
+
+  def _merge(self, nOther, otherMean, otherM2):
+    nTotal = self.nRows + nOther
+    dMean  = otherMean - self.theMean
+    self.theMean = self.theMean + dMean*(nOther/nTotal)
+    self.theM2   = self.theM2 + otherM2 + np.outer(dMean,dMean)*(self.nRows*nOther/nTotal)
+    self.nRows   = nTotal
+    return
+
+class GridHistogram:
+  """Histogram in one or two dimensions on a fixed grid of equal bins, filled
+  chunk by chunk. theAxes has the lower edge, upper edge and number of bins of
+  each dimension. Values outside the grid are only counted in nOut.
+  """
+
+  def __init__(self, theAxes):
+    self.theAxes   = theAxes
+    self.nBins     = tuple(nBin for aLow, aHigh, nBin in theAxes)
+    self.theCounts = np.zeros(self.nBins, dtype=np.int64)
+    self.nOut      = 0
+    return
+
+  def add(self, *theCols):
+    inGrid = np.ones(len(theCols[0]), dtype=bool)
+    theIdx = []
+    for (aLow, aHigh, nBin), theCol in zip(self.theAxes, theCols):
+      aIdx    = np.floor((theCol - aLow)*(nBin/(aHigh - aLow))).astype(np.int64)
+      inGrid &= (aIdx >= 0) & (aIdx < nBin)
+      theIdx.append(aIdx)
+    flatIdx = np.ravel_multi_index([aIdx[inGrid] for aIdx in theIdx], self.nBins)
+    self.theCounts += np.bincount(flatIdx, minlength=self.theCounts.size).reshape(self.nBins)
+    self.nOut      += len(inGrid) - np.count_nonzero(inGrid)
+    return
+
+  def merge(self, theOther):
+    self.theCounts += theOther.theCounts
+    self.nOut      += theOther.nOut
+    return
+
+  def edges(self, iDim=0):
+    aLow, aHigh, nBin = self.theAxes[iDim]
+    return np.linspace(aLow, aHigh, nBin+1)
+
+  def centres(self, iDim=0):
+    aEdges = self.edges(iDim)
+    return (aEdges[:-1] + aEdges[1:])/2
+
+  def density(self):
+    """The counts of a 1D histogram normalised to unit area on the grid.
+    """
+    aLow, aHigh, nBin = self.theAxes[0]
+    return self.theCounts/(np.sum(self.theCounts)*(aHigh - aLow)/nBin)
+
+class ParticleCheck:
+  """Moments of all columns of a distribution, the histogram of the X-X'
+  plane, and the projections on X, X', Y and Y', filled chunk by chunk. The
+  histograms cover nSigma times theSigma of each column, which defaults to 1.
+  """
+
+  def __init__(self, nCols, theSigma=None, nSigma=5.0, nBins=200):
+    if theSigma is None:
+      theSigma = np.ones(nCols)
+    self.theMom   = RunningMoments(nCols)
+    self.theAxes  = [(-nSigma*aSigma, nSigma*aSigma, nBins) for aSigma in theSigma[:4]]
+    self.beamHist = GridHistogram(self.theAxes[0:2])
+    self.projHist = [GridHistogram([theAxis]) for theAxis in self.theAxes]
+    return
+
+  def add(self, theChunk):
+    self.theMom.add(theChunk)
+    self.beamHist.add(theChunk[:,0], theChunk[:,1])
+    for iCol, pHist in enumerate(self.projHist):
+      pHist.add(theChunk[:,iCol])
+    return
+
+  def merge(self, theOther):
+    self.theMom.merge(theOther.theMom)
+    self.beamHist.merge(theOther.beamHist)
+    for pHist, oHist in zip(self.projHist, theOther.projHist):
+      pHist.merge(oHist)
+    return
+
+  def printSummary(self, theTitle):
+    theCov = self.theMom.cov()
+    for pName, iCol in (("X",0), ("Y",2), ("Z",4))[:len(theCov)//2]:
+      printSigma("%s %s" % (theTitle, pName), self.theMom.emittance(iCol), theCov[iCol:iCol+2,iCol:iCol+2])
+    return
+
+def checkParticles(theParts, nChunk=nChunk, theSigma=None):
+  """Check an array of particles, or a memory mapped file of them, one chunk
+  at a time.
+  """
+  theCheck = ParticleCheck(theParts.shape[1], theSigma)
+  for iStart in range(0, theParts.shape[0], nChunk):
+    theCheck.add(np.asarray(theParts[iStart:iStart+nChunk]))
+  return theCheck
+
+def checkFile(inFile, nChunk=nChunk):
+  """Check a .npy file of particles. Only one chunk of the file is mapped at a
+  time, like in streamParticles.
+  """
+  inData  = np.load(inFile, mmap_mode="r")
+  dOffset = inData.offset
+  nPart, nCols = inData.shape
+  del inData
+
+  theCheck = ParticleCheck(nCols)
+  for iStart in range(0, nPart, nChunk):
+    nThis   = min(nChunk, nPart-iStart)
+    inChunk = np.memmap(inFile, mode="r", dtype=np.float64, offset=dOffset+iStart*nCols*8, shape=(nThis,nCols))
+    theCheck.add(inChunk)
+    del inChunk
+  return theCheck
+
+##
+#  Streaming
+##
+
+def streamParticles(outFile, nPart, nChunk):
+  """Generate nPart particles, nChunk at a time, into a memory mapped .npy
+  file. Returns the ParticleCheck of the columns X, X', Y, Y'.
+  """
+  # Write the .npy header, then map one chunk of the file at a time so the
+  # written pages do not pile up in the resident memory of the process
+  outData = open_memmap(outFile, mode="w+", dtype=np.float64, shape=(nPart,4))
+  dOffset = outData.offset
+  del outData
+
+  theCheck = ParticleCheck(4)
+  for iStart in range(0, nPart, nChunk):
+    nThis = min(nChunk, nPart-iStart)
+    xPos, xAng, yPos, yAng = matchParticles(
+      np.random.normal(0.0, 1.0, (nThis,2)), np.random.normal(0.0, 1.0, nThis)
+    )
+    outChunk = np.memmap(outFile, mode="r+", dtype=np.float64, offset=dOffset+iStart*4*8, shape=(nThis,4))
+    outChunk[:,0] = xPos
+    outChunk[:,1] = xAng
+    outChunk[:,2] = yPos
+    outChunk[:,3] = yAng
+    theCheck.add(outChunk)
+    outChunk.flush()
+    del outChunk
+  return theCheck
+
+##
+#  Parallel Generation
+##
+
+def normalChunk(rngSeq, nThis, nDim):
+  """Draw a chunk of nThis standard normal vectors of nDim from the random
+  stream of rngSeq.
+  """
+  rngGen = np.random.default_rng(rngSeq)
+  return rngGen.standard_normal((nThis,nDim))
+
+def matchChunk(distN, cholM):
+  """Match a chunk of standard normal vectors to the beam matrix with the
+  Cholesky factor cholM.
+  """
+  # Row vectors, so x = L.z becomes X = Z.L^T for the whole chunk at once
+  return np.dot(distN, cholM.T)
+
+def _genChunk(rngSeq, nThis, cholM):
+  return matchChunk(normalChunk(rngSeq, nThis, cholM.shape[0]), cholM)
+
+def _runChunk(chunkArgs):
+  rngSeq, iStart, nThis, cholM, distArgs = chunkArgs
+  theChunk = _genChunk(rngSeq, nThis, cholM)
+  if distArgs is None:
+    return theChunk
+  # Check the chunk here too, so the statistics are also spread over the pool
+  theCheck = ParticleCheck(theChunk.shape[1], np.sqrt(np.diag(np.dot(cholM, cholM.T))))
+  theCheck.add(theChunk)
+  # The chunk is written to its own segment file, so only the path goes back
+  # to the parent process instead of the text
+  outFile, pRef, mRef, ionA, ionZ = distArgs
+  segFile = _segFile(outFile, iStart)
+  with open(segFile,mode="w") as outSeg:
+    np.savetxt(outSeg, distColumns(theChunk, iStart+1, pRef, mRef, ionA, ionZ), fmt=distFmt)
+  return segFile, theCheck
+
+def _segFile(outFile, iStart):
+  return "%s.seg%d" % (outFile, iStart)
+
+def _mapChunks(theTwiss, nPart, seedVal, nProc, nChunk, distArgs):
+  """Yield the chunks of a distribution in order, generated by a pool of
+  nProc processes. Each chunk gets its own child of the seed sequence.
+  """
+  cholM   = np.linalg.cholesky(beamMatrix(theTwiss))
+  seedSeq = np.random.SeedSequence(seedVal)
+  nChunks = (nPart + nChunk - 1)//nChunk
+  theArgs = [
+    (rngSeq, iChunk*nChunk, min(nChunk, nPart-iChunk*nChunk), cholM, distArgs)
+    for iChunk, rngSeq in enumerate(seedSeq.spawn(nChunks))
+  ]
+  if nProc is None:
+    nProc = cpu_count()
+  nProc = max(1, min(nProc, nChunks))
+  if nProc == 1:
+    for chunkArgs in theArgs:
+      yield _runChunk(chunkArgs)
+    return
+  with multiprocessing.Pool(nProc) as runPool:
+    for theResult in runPool.imap(_runChunk, theArgs):
+      yield theResult
+  return
+
+def generateParticles(theTwiss, nPart, seedVal=None, nProc=None, nChunk=nChunk):
+  """Generate a matched Gaussian distribution of nPart particles. Returns an
+  array with the columns X, X', Y, Y' and, for 6D, Z, delta. See beamMatrix
+  for theTwiss. The chunks are generated by nProc processes, all cores by
+  default.
+  """
+  theParts = np.empty((nPart,2*len(theTwiss)))
+  iStart   = 0
+  for theChunk in _mapChunks(theTwiss, nPart, seedVal, nProc, nChunk, None):
+    theParts[iStart:iStart+theChunk.shape[0]] = theChunk
+    iStart += theChunk.shape[0]
+  return theParts
+
+# The number formats of the columns of a SixTrack DIST file
+distFmt = ["%d", "%d", "%.1f"] + ["%.16e"]*6 + ["%d", "%d"] + ["%.16e"]*3
+
+def distColumns(theParts, firstId=1, pRef=pRef, mRef=mRef, ionA=1, ionZ=1):
+  """Make the columns of a SixTrack DIST file for particles. The 14 columns
+  are id, generation, weight, x, y, z, x', y', z', A, Z, mass, momentum and
+  time. The time is the delay of the particle from its longitudinal position
+  z, which, with the momentum, is only set for 6D distributions. The
+  transverse z and z' columns are not used.
+  """
+  nThis   = theParts.shape[0]
+  theCols = np.zeros((nThis,14))
+  theCols[:,0]  = np.arange(firstId, firstId+nThis)
+  theCols[:,1]  = 1
+  theCols[:,2]  = 1.0
+  theCols[:,3]  = theParts[:,0]
+  theCols[:,4]  = theParts[:,2]
+  theCols[:,6]  = theParts[:,1]
+  theCols[:,7]  = theParts[:,3]
+  theCols[:,9]  = ionA
+  theCols[:,10] = ionZ
+  theCols[:,11] = mRef
+  theCols[:,12] = pRef
+  if theParts.shape[1] == 6:
+    betaRef = pRef/np.sqrt(pRef**2 + mRef**2)
+    theCols[:,12] = pRef*(1.0 + theParts[:,5])
+    theCols[:,13] = -theParts[:,4]/(betaRef*cLight)
+  return theCols
+
+def formatDist(theParts, firstId=1, pRef=pRef, mRef=mRef, ionA=1, ionZ=1):
+  """Format particles as lines of a SixTrack DIST file. See distColumns for
+  the columns.
+  """
+  outText = io.StringIO()
+  np.savetxt(outText, distColumns(theParts, firstId, pRef, mRef, ionA, ionZ), fmt=distFmt)
+  return outText.getvalue()
+
+
+def writeDist(outFile, theTwiss, nPart, seedVal=None, nProc=None, nChunk=nChunk, pRef=pRef, mRef=mRef, ionA=1, ionZ=1):
+  """Generate a distribution like generateParticles, and write it to a
+  SixTrack DIST file. The chunks are also checked by the worker processes,
+  and each writes its chunk to a segment file, which is appended to the DIST
+  file in order. The full distribution is never held in memory. Returns the
+  ParticleCheck of the distribution.
+  """
+  theCheck = None
+  try:
+    with open(outFile,mode="wb") as outDist:
+      for segFile, chunkCheck in _mapChunks(theTwiss, nPart, seedVal, nProc, nChunk, (outFile, pRef, mRef, ionA, ionZ)):
+        with open(segFile,mode="rb") as inSeg:
+          shutil.copyfileobj(inSeg, outDist)
+        remove(segFile)
+        if theCheck is None:
+          theCheck = chunkCheck
+        else:
+          theCheck.merge(chunkCheck)
+  finally:
+    # Segments written ahead of a failure are not needed
+    for iStart in range(0, nPart, nChunk):
+      if path.isfile(_segFile(outFile, iStart)):
+        remove(_segFile(outFile, iStart))
+  return theCheck
+
+##
+#  Script Modes
+##
+
+def printSigma(theTitle, theEmit, theSigma):
+  print(theTitle)
+  print("Emittance: %13.9f" % theEmit)
+  print("Sigma:   [ %13.9f %13.9f ]" % (theSigma[0,0],theSigma[0,1]))
+  print("         [ %13.9f %13.9f ]" % (theSigma[1,0],theSigma[1,1]))
+  print("")
+  return
+
+def runStream(outFile, nPart, nChunk):
+  theCheck = streamParticles(outFile, nPart, nChunk)
+  theCheck.printSummary("Streamed Distribution")
+  theMean = theCheck.theMom.mean()
+  print("Average X-Y: %13.6e" % (theMean[0] - theMean[2]))
+  print("Written %d particles to %s" % (nPart, outFile))
+  return
+
+def runCheck(inFile, outFile, nChunk):
+  theCheck = checkFile(inFile, nChunk)
+  theCheck.printSummary("Distribution")
+  print("Checked %d particles in %s" % (theCheck.theMom.nRows, inFile))
+  plotCheck(theCheck, outFile)
+  return
+
+def runDist(outFile, nPart, seedVal):
+  if seedVal is None:
+    seedVal = np.random.SeedSequence().entropy
+  theCheck = writeDist(outFile, defTwiss, nPart, seedVal=seedVal)
+  theCheck.printSummary("Written Distribution")
+  print("Written %d particles to %s with seed %d" % (nPart, outFile, seedVal))
+  return
+
+def runDemo(nPart, outFile):
+  xPos, xAng, yPos, yAng = matchParticles(
+    np.random.normal(0.0, 1.0, (nPart,2)), np.random.normal(0.0, 1.0, nPart)
+  )
+
+  if nPart < 1001:
+    for i in range(nPart):
+      print("X: %13.6f Y: %13.6f X': %13.6f Y': %13.6f" % (xPos[i],yPos[i],xAng[i],yAng[i]))
+
+  theCheck = ParticleCheck(4)
+  for iStart in range(0, nPart, nChunk):
+    theCheck.add(np.column_stack((
+      xPos[iStart:iStart+nChunk], xAng[iStart:iStart+nChunk], yPos[iStart:iStart+nChunk], yAng[iStart:iStart+nChunk]
+    )))
+  theCheck.printSummary("Matched Distribution")
+
+  theMean = theCheck.theMom.mean()
+  print("Average X-Y: %13.6e" % (theMean[0] - theMean[2]))
+
+  plotCheck(theCheck, outFile)
+  return
+
+def plotCheck(theCheck, outFile=None):
+  """Plot the X-X' contours and the projections of a ParticleCheck. With an
+  outFile, the figure is saved there with the Agg backend instead of shown.
+  """
+  # Imported here so the module can be used without matplotlib
+  import matplotlib
+  if outFile is not None:
+    matplotlib.use("Agg")
+  import matplotlib.pyplot as plt
+  import matplotlib.gridspec as gridspec
+
+  figOne = plt.figure(1,figsize=(10, 8),dpi=100)
+  figOne.clf()
+
+  bHist = theCheck.beamHist.theCounts/max(np.max(theCheck.beamHist.theCounts),1)
+  xM, yM = np.meshgrid(theCheck.beamHist.centres(0), theCheck.beamHist.centres(1))
+
+  gOne = gridspec.GridSpec(3, 3)
+  currAx = plt.subplot(gOne[0:2, 0:2])
+  plt.contour(xM, yM, bHist, levels=[0.01, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9])
+
+  for iCol, pName, pGrid in ((0,"X",gOne[2, 0]), (1,"X'",gOne[2, 1]), (2,"Y",gOne[0, 2]), (3,"Y'",gOne[1, 2])):
+    pHist  = theCheck.projHist[iCol]
+    currAx = plt.subplot(pGrid)
+    plt.step(pHist.centres(),pHist.density(),where="mid")
+    plt.xlabel(pName)
+    plt.xlim(pHist.theAxes[0][0],pHist.theAxes[0][1])
+
+  if outFile is None:
+    plt.show(block=True)
+  else:
+    plt.savefig(outFile)
+    plt.close(figOne)
+  return
+
+if __name__ == "__main__":
+
+  printSigma("Input", emitX, sigmX)
 
-print("Input")
-print("Emittance: %13.9f" % emitX)
-print("Sigma:   [ %13.9f %13.9f ]" % (sigmX[0,0],sigmX[0,1]))
-print("         [ %13.9f %13.9f ]" % (sigmX[1,0],sigmX[1,1]))
-print("")
-
-distX  = np.random.normal(0.0, 1.0, (nPart,2))
-beamX  = np.dot(distX, cholX)
-
-xPos   = beamX[:,1]
-xAng   = beamX[:,0]
-
-yPos   = np.zeros(nPart)
-yAng   = np.zeros(nPart)
-
-xCov = np.cov(xPos,xAng)
-eX   = np.sqrt(np.linalg.det(xCov))
-print("Generated Distribution")
-print("Emittance: %13.9f" % eX)
-print("Sigma:   [ %13.9f %13.9f ]" % (xCov[0,0],xCov[0,1]))
-print("         [ %13.9f %13.9f ]" % (xCov[1,0],xCov[1,1]))
-print("")
-
-sqrtB = np.sqrt(betaX)
-nAng  = np.random.normal(0.0, 1.0, nPart)
-yAng  = nAng/sqrtB - alphaX/betaX*xPos
-
-yPos  = (nAng - sqrtB*yAng)*sqrtB/alphaX
-
-if nPart < 1001:
-  for i in range(nPart):
-    print("X: %13.6f Y: %13.6f X': %13.6f Y': %13.6f" % (xPos[i],yPos[i],xAng[i],yAng[i]))
-
-yCov = np.cov(yPos,yAng)
-eY   = np.sqrt(np.linalg.det(xCov))
-print("Matched Distribution")
-print("Emittance: %13.9f" % eY)
-print("Sigma:   [ %13.9f %13.9f ]" % (yCov[0,0],yCov[0,1]))
-print("         [ %13.9f %13.9f ]" % (yCov[1,0],yCov[1,1]))
-print("")
-
-dErr  = np.sum(yPos-xPos)/nPart
-print("Average X-Y: %13.6e" % dErr)
-
-# Plot
-figOne = plt.figure(1,figsize=(10, 8),dpi=100)
-figOne.clf()
-
-xG = np.arange(-5.0, 5.0, 0.05)
-yG = np.arange(-5.0, 5.0, 0.05)
-
-bHist, xG, yG = np.histogram2d(xPos, xAng, bins=(xG, yG))
-bHist = bHist/np.max(bHist)
-
-xC = (xG[:-1] + xG[1:])/2
-yC = (yG[:-1] + yG[1:])/2
-
-xM, yM = np.meshgrid(xC, yC)
-
-gOne = gridspec.GridSpec(3, 3)
-currAx = plt.subplot(gOne[0:2, 0:2])
-plt.contour(xM, yM, bHist, levels=[0.01, 0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9])
-
-pHist, pG = np.histogram(xPos, bins=200, density=True)
-pC = (pG[:-1] + pG[1:])/2
-currAx = plt.subplot(gOne[2, 0])
-plt.step(pC,pHist,where="mid")
-plt.xlabel("X")
-plt.xlim(-5,5)
- 
-pHist, pG = np.histogram(xAng, bins=200, density=True)
-pC = (pG[:-1] + pG[1:])/2
-currAx = plt.subplot(gOne[2, 1])
-plt.step(pC,pHist,where="mid")
-plt.xlabel("X'")
-plt.xlim(-5,5)
-
-pHist, pG = np.histogram(yPos, bins=200, density=True)
-pC = (pG[:-1] + pG[1:])/2
-currAx = plt.subplot(gOne[0, 2])
-plt.step(pC,pHist,where="mid")
-plt.xlabel("Y")
-plt.xlim(-5,5)
- 
-pHist, pG = np.histogram(yAng, bins=200, density=True)
-pC = (pG[:-1] + pG[1:])/2
-currAx = plt.subplot(gOne[1, 2])
-plt.step(pC,pHist,where="mid")
-plt.xlabel("Y'")
-plt.xlim(-5,5)
-
-plt.show(block=True)
+  if len(sys.argv) >= 3 and sys.argv[1] == "stream":
+    if len(sys.argv) > 3:
+      nPart = int(float(sys.argv[3]))
+    if len(sys.argv) > 4:
+      nChunk = int(float(sys.argv[4]))
+    runStream(sys.argv[2], nPart, nChunk)
+  elif len(sys.argv) >= 3 and sys.argv[1] == "check":
+    if len(sys.argv) > 4:
+      nChunk = int(float(sys.argv[4]))
+    runCheck(sys.argv[2], sys.argv[3] if len(sys.argv) > 3 else None, nChunk)
+  elif len(sys.argv) >= 3 and sys.argv[1] == "dist":
+    if len(sys.argv) > 3:
+      nPart = int(float(sys.argv[3]))
+    runDist(sys.argv[2], nPart, int(sys.argv[4]) if len(sys.argv) > 4 else None)
+  elif len(sys.argv) >= 3 and sys.argv[1] == "plot":
+    runDemo(nPart, sys.argv[2])
+  else:
+    runDemo(nPart, None)
@@ -0,0 +1,129 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*
+"""SixTrack Performance Regressions
+
+  SixTrack Performance Regressions
+ ==================================
+  Detect slowdowns in the test execution times introduced by a commit. The
+  execution times of each (test, compiler, build type) are compared against
+  the history in the timing store.
+
+  Since a test runs for several build commands with the same compiler and
+  type, each time is first normalised by the median of its own build command
+  over the history. The normalised times of the current commit are then
+  compared to the normalised history with a robust z-score based on the
+  median absolute deviation. When there are enough builds, a one-sided
+  Mann-Whitney U test is applied as well.
+
+"""
+
+import math
+import logging
+
+logger = logging.getLogger("SixTrackTestBuild")
+
+# Detection thresholds
+minHistory = 5     # Minimum number of earlier timings per build command
+minSlowDn  = 0.05  # Minimum relative slowdown to report
+minZScore  = 3.5   # Minimum robust z-score
+maxPValue  = 0.01  # Maximum p-value of the U test, when it can be computed
+minMadRel  = 0.01  # Floor on the relative spread, to not flag pure noise
+
+def median(theValues):
+  sValues = sorted(theValues)
+  nValues = len(sValues)
+  if nValues == 0:
+    return None
+  if nValues % 2 == 1:
+    return sValues[nValues//2]
+  return 0.5*(sValues[nValues//2-1] + sValues[nValues//2])
+
+def robustZ(theValue, theHistory):
+  hMed = median(theHistory)
+  hMad = 1.4826*median([abs(hVal - hMed) for hVal in theHistory])
+  hMad = max(hMad, minMadRel*abs(hMed))
+  if hMad == 0.0:
+    return 0.0
+  return (theValue - hMed)/hMad
+
+def mannWhitneyP(xValues, yValues):
+  """One-sided p-value for the values in xValues being larger than those in
+  yValues, using the normal approximation with average ranks for ties.
+  """
+  nX = len(xValues)
+  nY = len(yValues)
+  allVals = sorted([(xVal, 0) for xVal in xValues] + [(yVal, 1) for yVal in yValues])
+  theRanks = [0.0]*len(allVals)
+  iVal = 0
+  while iVal < len(allVals):
+    jVal = iVal
+    while jVal+1 < len(allVals) and allVals[jVal+1][0] == allVals[iVal][0]:
+      jVal += 1
+    for kVal in range(iVal, jVal+1):
+      theRanks[kVal] = 0.5*(iVal + jVal) + 1.0
+    iVal = jVal + 1
+  rSumX = sum(theRanks[kVal] for kVal in range(len(allVals)) if allVals[kVal][1] == 0)
+  uStat = rSumX - nX*(nX+1)/2.0
+  uMean = nX*nY/2.0
+  uStd  = math.sqrt(nX*nY*(nX+nY+1)/12.0)
+  if uStd == 0.0:
+    return 1.0
+  zStat = (uStat - uMean - 0.5)/uStd
+  return 0.5*math.erfc(zStat/math.sqrt(2.0))
+
+def findRegressions(theRecords, gitHash):
+  """Find significant slowdowns for gitHash in a list of timing records from
+  TimingStore.getRecent. Returns a list of dictionaries, worst first.
+  """
+  # Group the execution times by (test, compiler, type) and build command
+  theGroups = {}
+  for tRecord in theRecords:
+    if tRecord["exectime"] is None or tRecord["compiler"] is None:
+      continue
+    grpKey = (tRecord["test"], tRecord["compiler"], tRecord["type"])
+    grpBld = theGroups.setdefault(grpKey, {}).setdefault(tRecord["build"], {"curr": [], "hist": []})
+    if tRecord["hash"] == gitHash:
+      grpBld["curr"].append(tRecord["exectime"])
+    else:
+      grpBld["hist"].append(tRecord["exectime"])
+
+  theRegs = []
+  for grpKey, grpBlds in theGroups.items():
+    currRel = []
+    histRel = []
+    for bldData in grpBlds.values():
+      if len(bldData["curr"]) == 0 or len(bldData["hist"]) < minHistory:
+        continue
+      bldMed = median(bldData["hist"])
+      if bldMed is None or bldMed <= 0.0:
+        continue
+      currRel += [cVal/bldMed for cVal in bldData["curr"]]
+      histRel += [hVal/bldMed for hVal in bldData["hist"]]
+    if len(currRel) == 0:
+      continue
+
+    currMed = median(currRel)
+    slowDn  = currMed/median(histRel) - 1.0
+    zScore  = robustZ(currMed, histRel)
+    pValue  = None
+    if len(currRel) >= 3:
+      pValue = mannWhitneyP(currRel, histRel)
+
+    if slowDn < minSlowDn or zScore < minZScore:
+      continue
+    if pValue is not None and pValue > maxPValue:
+      continue
+
+    theRegs.append({
+      "test"     : grpKey[0],
+      "compiler" : grpKey[1],
+      "type"     : grpKey[2],
+      "slowdown" : round(slowDn, 4),
+      "zscore"   : round(zScore, 2),
+      "pvalue"   : pValue,
+      "nbuilds"  : len(currRel),
+      "nhistory" : len(histRel),
+    })
+
+  theRegs.sort(key=lambda theReg: theReg["slowdown"], reverse=True)
+  return theRegs
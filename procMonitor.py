@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*
+"""SixTrack Process Monitor
+
+  SixTrack Process Monitor
+ ==========================
+  Measure the resources used by a build or test command and all processes it
+  starts. While the command runs, /proc is sampled for the processes in its
+  session to find the peak resident memory of the whole process tree. When it
+  exits, the CPU time, the peak memory of the largest single process and the
+  bytes read and written to storage are taken from the resource usage
+  returned by wait4, which covers every process in the tree. The parallelism
+  achieved is the CPU time divided by the wall time.
+
+"""
+
+import os
+import time
+import logging
+import threading
+import subprocess
+
+logger = logging.getLogger("SixTrackTestBuild")
+
+pageSize = os.sysconf("SC_PAGE_SIZE")
+
+class ProcMonitor:
+
+  def __init__(self, tSample=1.0):
+    self.tSample   = tSample
+    self.rootPid   = None
+    self.tStart    = None
+    self.tEnd      = None
+    self.peakRss   = 0
+    self.maxProcs  = 0
+    self.nSamples  = 0
+    self.theUsage  = None
+    self.doStop    = threading.Event()
+    self.theThread = None
+    return
+
+  def start(self, rootPid):
+    """Start sampling the process tree of rootPid. The process must have been
+    started in a new session, as sysRun does.
+    """
+    self.rootPid   = rootPid
+    self.tStart    = time.time()
+    self.theThread = threading.Thread(target=self._runSampler)
+    self.theThread.daemon = True
+    self.theThread.start()
+    return
+
+  def wait(self, sysP, timeout=None):
+    """Wait for a Popen process like Popen.wait, but reap it with wait4 to get
+    its resource usage. Raises subprocess.TimeoutExpired on a timeout.
+    """
+    if sysP.returncode is not None:
+      return sysP.returncode
+    tLimit = None if timeout is None else time.time() + timeout
+    tSleep = 0.01
+    while True:
+      wPid, wStatus, wUsage = os.wait4(sysP.pid, os.WNOHANG)
+      if wPid == sysP.pid:
+        break
+      if tLimit is not None and time.time() > tLimit:
+        raise subprocess.TimeoutExpired(sysP.args, timeout)
+      time.sleep(tSleep)
+      tSleep = min(2*tSleep, 0.5)
+    self.tEnd     = time.time()
+    self.theUsage = wUsage
+    self.doStop.set()
+    if os.WIFSIGNALED(wStatus):
+      sysP.returncode = -os.WTERMSIG(wStatus)
+    else:
+      sysP.returncode = os.WEXITSTATUS(wStatus)
+    return sysP.returncode
+
+  def getStats(self):
+    """Return the measured resources as a dictionary. Memory and I/O are in
+    MiB, and times in seconds.
+    """
+    if self.theThread is not None:
+      self.theThread.join()
+    if self.theUsage is None or self.tStart is None:
+      return None
+    wallTime = self.tEnd - self.tStart
+    cpuTime  = self.theUsage.ru_utime + self.theUsage.ru_stime
+    return {
+      "walltime" : round(wallTime, 3),
+      "cputime"  : round(cpuTime, 3),
+      "usertime" : round(self.theUsage.ru_utime, 3),
+      "systime"  : round(self.theUsage.ru_stime, 3),
+      "parallel" : round(cpuTime/wallTime, 3) if wallTime > 0.0 else 0.0,
+      "peakrss"  : round(self.peakRss/1024**2, 1),
+      "maxrss"   : round(self.theUsage.ru_maxrss/1024, 1),
+      "ioread"   : round(self.theUsage.ru_inblock*512/1024**2, 1),
+      "iowrite"  : round(self.theUsage.ru_oublock*512/1024**2, 1),
+      "maxprocs" : self.maxProcs,
+      "nsamples" : self.nSamples,
+    }
+
+  def _runSampler(self):
+    while not self.doStop.is_set():
+      self._takeSample()
+      self.doStop.wait(self.tSample)
+    return
+
+  def _takeSample(self):
+    totRss = 0
+    nProcs = 0
+    for procDir in os.listdir("/proc"):
+      if not procDir.isdigit():
+        continue
+      try:
+        with open("/proc/%s/stat" % procDir,mode="r") as inFile:
+          procStat = inFile.read()
+      except OSError:
+        continue
+      # The command name may contain spaces, so split after its closing bracket
+      statBits = procStat[procStat.rfind(")")+2:].split()
+      if len(statBits) < 22 or int(statBits[3]) != self.rootPid:
+        continue
+      totRss += int(statBits[21])*pageSize
+      nProcs += 1
+    self.peakRss  = max(self.peakRss, totRss)
+    self.maxProcs = max(self.maxProcs, nProcs)
+    self.nSamples += 1
+    return
+
+def summariseUsage(theJobs, wallTime, nCores):
+  """Summarise the resources of all jobs of a run. theJobs is a list of
+  dictionaries with the label, stage and stats of each job, and whether it
+  ran on a remote worker. Returns the total CPU time, how much of the local
+  machine was used over the run, and the totals per label sorted by CPU time.
+  """
+  totCpu   = 0.0
+  locCpu   = 0.0
+  theFlags = {}
+  for theJob in theJobs:
+    jStats = theJob["stats"]
+    if jStats is None:
+      continue
+    totCpu += jStats["cputime"]
+    if not theJob.get("remote",False):
+      locCpu += jStats["cputime"]
+    flagSum = theFlags.setdefault(theJob["flag"], {
+      "flag": theJob["flag"], "cputime": 0.0, "walltime": 0.0, "peakrss": 0.0, "ioread": 0.0, "iowrite": 0.0, "njobs": 0
+    })
+    flagSum["cputime"]  += jStats["cputime"]
+    flagSum["walltime"] += jStats["walltime"]
+    flagSum["peakrss"]   = max(flagSum["peakrss"], jStats["peakrss"])
+    flagSum["ioread"]   += jStats["ioread"]
+    flagSum["iowrite"]  += jStats["iowrite"]
+    flagSum["njobs"]    += 1
+  for flagSum in theFlags.values():
+    flagSum["cputime"]  = round(flagSum["cputime"], 1)
+    flagSum["walltime"] = round(flagSum["walltime"], 1)
+    flagSum["parallel"] = round(flagSum["cputime"]/flagSum["walltime"], 2) if flagSum["walltime"] > 0.0 else 0.0
+  return {
+    "cputime"    : round(totCpu, 1),
+    "walltime"   : round(wallTime, 1),
+    "ncores"     : nCores,
+    "saturation" : round(locCpu/(wallTime*nCores), 3) if wallTime > 0.0 and nCores > 0 else 0.0,
+    "byflag"     : sorted(theFlags.values(), key=lambda flagSum: flagSum["cputime"], reverse=True),
+  }
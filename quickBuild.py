@@ -16,7 +16,12 @@
    * Build Types:       debug, release
    * Build Flags:       Any flag that is accepted by the CMake. BUILD_TESTING is implied.
    * Run Tests:         fast, medium, slow, fastmedium, gonuts (last one runs '-E prob')
-   * Delete Work Dir:   clean, messy (for do clean up, and don't, respectively)
+                        impact (tests covering the files changed since master)
+   * Delete Build Dir:  clean, messy (for do clean up, and don't, respectively)
+   * Commit:            hash:<commit> (build this commit of the ref instead of its head)
+   * Mirror Update:     fetch, nofetch (the latter uses the mirror as it is)
+   * Build Mode:        fresh, incremental (the latter keeps the build dirs between runs)
+   * Core Budget:       ncores:<n> (use at most n cores, default is all of them)
    * Show Build Output: buildout, nobuildout
    * Show Test Output:  testout, notestout
    * Show Output:       spammy, quiet (sets both of the above at the same time)
@@ -24,9 +29,20 @@
 """
 
 import sys
+import fcntl
+import shutil
+import hashlib
 import logging
-from os import path, chdir, mkdir,system,listdir
-from buildFucntions import *
+import threading
+from os import path, chdir, mkdir,system,listdir,cpu_count,makedirs,remove
+from collections import deque
+from buildFunctions import *
+from buildCache import BuildCache, prefixFlags
+from buildScheduler import JobPool
+from coverageIndex import loadCoverageIndex, selectTests
+from ctestResults import writeCostData
+from timingStore import TimingStore
+from worktreePool import WorktreePool
 
 logger = logging.getLogger("SixTrackTestBuild")
 
@@ -38,10 +54,29 @@ dRoot    = "/scratch/TestBuild"
 dSource  = "/scratch/TestBuild/Source/Mirror"
 dLog     = "/scratch/Temp/"
 dTemp    = "/scratch/Temp/"
+dPool    = "/scratch/Temp/Worktrees"
+dIncr    = "/scratch/Temp/Incremental"
 dLibs    = "/scratch/TestBuild/Source/SixTrack/lib"
+dCache   = "/scratch/TestBuild/Cache"
+covIndex = "/scratch/TestBuild/CoverageIndex.json"
+timDB    = "/scratch/TestBuild/Timing.db"
 
-nBld  = 8
-nTest = 14
+# Maximum size of the build cache in bytes, shared with the nightly builds
+maxCache = 200*1024**3
+
+# Maximum number of worktrees kept for quick builds
+maxSlots = 4
+
+cVersion = {
+  "gfortran" : "--version",
+  "ifort"    : "--version",
+  "nagfor"   : "-V",
+}
+
+# Builds and tests run concurrently within the total number of cores
+nBld   = 8
+nTest  = 14
+nCores = cpu_count()
 
 setupLogging(dLog,True)
 
@@ -49,8 +84,6 @@ logger.info("*"*80)
 logger.info("* Starting New Quick Build Session")
 logger.info("*"*80)
 
-mirrorRepo(dSource)
-
 # Help message
 
 theHelp = """
@@ -61,7 +94,12 @@ theHelp = """
   * Build Types:       debug, release
   * Build Flags:       Any flag that is accepted by the CMake. BUILD_TESTING is implied.
   * Run Tests:         fast, medium, slow, fastmedium, gonuts (last one runs '-E prob')
-  * Delete Work Dir:   clean, messy (for do clean up, and don't, respectively)
+                       impact (tests covering the files changed since master)
+  * Delete Build Dir:  clean, messy (for do clean up, and don't, respectively)
+  * Commit:            hash:<commit> (build this commit of the ref instead of its head)
+  * Mirror Update:     fetch, nofetch (the latter uses the mirror as it is)
+  * Build Mode:        fresh, incremental (the latter keeps the build dirs between runs)
+  * Core Budget:       ncores:<n> (use at most n cores, default is all of them)
   * Show Build Output: showbuild, hidebuild
   * Show Test Output:  showtests, hidetests
   * Show Output:       spammy, quiet (sets both of the above at the same time)
@@ -78,6 +116,9 @@ theTest  = "-L fast"
 buildOut = True
 testOut  = True
 doClean  = True
+doIncr   = False
+doFetch  = True
+chkHash  = None
 
 for inArg in sys.argv[1:]:
   if inArg[:2] == "b:":
@@ -89,6 +130,13 @@ for inArg in sys.argv[1:]:
   elif inArg[:4] == "tag:":
     chkType = "pr"
     chkRef  = "refs/tags/%s" % inArg[4:]
+  elif inArg[:5] == "hash:":
+    chkHash = inArg[5:]
+  elif inArg[:7] == "ncores:":
+    if not inArg[7:].isdigit() or int(inArg[7:]) < 1:
+      logger.error("Not a valid number of cores '%s'" % inArg[7:])
+      exit(1)
+    nCores = int(inArg[7:])
   elif inArg in ("gfortran","ifort","nagfor"):
     theComps.append(inArg)
   elif inArg in ("debug","release"):
@@ -103,6 +151,8 @@ for inArg in sys.argv[1:]:
     theTest = "-L \"fast|medium\""
   elif inArg == "gonuts":
     theTest = "all"
+  elif inArg == "impact":
+    theTest = "impact"
   elif inArg in ("showbuild","spammy"):
     buildOut = True
   elif inArg in ("hidebuild","quiet"):
@@ -115,6 +165,14 @@ for inArg in sys.argv[1:]:
     doClean = True
   elif inArg in "messy":
     doClean = False
+  elif inArg == "fetch":
+    doFetch = True
+  elif inArg == "nofetch":
+    doFetch = False
+  elif inArg == "fresh":
+    doIncr = False
+  elif inArg == "incremental":
+    doIncr = True
   elif inArg == inArg.upper():
     theFlags.append(inArg)
   elif inArg in ("help","-help","--help","-h","what","wtf","huh","why","butwhy","ffs","dafuq"):
@@ -133,16 +191,33 @@ if len(theTypes) == 0:
 
 logger.info("")
 logger.info("Arguments:")
-logger.info(" * Will checkout:     %s" % chkRef)
+logger.info(" * Will checkout:     %s" % (chkRef if chkHash is None else "%s at %s" % (chkRef,chkHash)))
+logger.info(" * Will fetch:        %s" % str(doFetch))
 logger.info(" * Will build with:   %s" % ",".join(theComps))
 logger.info(" * Will build types:  %s" % ",".join(theTypes))
 logger.info(" * Will build flags:  %s" % " ".join(theFlags))
 logger.info(" * Will test with:    %s" % theTest)
 logger.info(" * Will clean up:     %s" % str(doClean))
+logger.info(" * Will incremental:  %s" % str(doIncr))
+logger.info(" * Will use cores:    %d" % nCores)
 logger.info(" * Will build output: %s" % str(buildOut))
 logger.info(" * Will test output:  %s" % str(testOut))
 
-gitHash, gitTime, gitMsg = getCommitFromRef(dSource, chkRef)
+if chkHash is not None and not isCommitHash(chkHash):
+  logger.error("Not a full commit hash '%s'" % chkHash)
+  exit(1)
+
+# A single build or test run can not use more than the core budget
+nBld  = min(nBld,nCores)
+nTest = min(nTest,nCores)
+
+if doFetch:
+  mirrorRepo(dSource)
+
+gitHash, gitTime, gitMsg = getCommitFromRef(dSource, chkRef if chkHash is None else chkHash)
+if gitHash == "":
+  logger.error("Cannot find the commit to build")
+  exit(1)
 
 logger.info("")
 logger.info("Repository:")
@@ -155,80 +230,241 @@ logger.info(" * Git Msg:  %s" % gitMsg)
 logger.info("")
 logger.info("Checking Out SixTrack:")
 
-workDir = path.join(dTemp,gitHash)
-chdir(dTemp)
-if path.isdir(workDir):
-  stdOut, stdErr, exCode = sysCall("rm -rf %s" % gitHash)
-  if exCode == 0:
-    logger.info("Deleting folder: %s ... OK" % workDir)
-  else:
-    logger.error("Deleting folder: %s ... Failed" % workDir)
-    exit(1)
-
-mkdir(workDir)
+wtPool  = WorktreePool(path.join(dSource,"SixTrack.git"),dPool,maxSlots,dLibs)
+workDir = wtPool.lease(chkRef,gitHash)
+if workDir is None:
+  logger.error("Failed to check out %s" % gitHash)
+  exit(1)
+logger.info("Checked out %s in: %s" % (gitHash,workDir))
 chdir(workDir)
 
-exCode = system("git clone %s ." % path.join(dSource,"SixTrack.git"))
-exCode = system("git fetch origin %s:tmpbranch" % chkRef)
-exCode = system("git checkout --detach %s" % gitHash)
-exCode = system("mv lib lib.old")
-exCode = system("ln -s %s lib" % dLibs)
+# Select tests from the coverage index of the last nightly
+if theTest == "impact":
+  logger.info("")
+  logger.info("Selecting Tests:")
+  theTest = "-L fast"
+  covData = loadCoverageIndex(covIndex)
+  stdOut, stdErr, exCode = sysCall("git merge-base master %s" % gitHash)
+  if covData is None:
+    logger.warning(" * No coverage index found, falling back to '%s'" % theTest)
+  elif exCode != 0:
+    logger.warning(" * No merge base with master, falling back to '%s'" % theTest)
+  else:
+    baseHash = stdOut.strip()
+    logger.info(" * Coverage index from: %s" % covData["hash"])
+    logger.info(" * Changes since:       %s" % baseHash)
+    changedFiles = getChangedFiles(workDir, baseHash, gitHash)
+    impTests = None
+    if changedFiles is not None:
+      impTests = selectTests(covData, changedFiles)
+    if impTests is None:
+      theTest = ""
+      logger.warning(" * Cannot map changes to tests, falling back to all tests")
+    elif len(impTests) == 0:
+      logger.info(" * No tests cover the changed files, falling back to '%s'" % theTest)
+    else:
+      theTest = "-R '^(%s)$'" % "|".join(impTests)
+      logger.info(" * Selected %d tests: %s" % (len(impTests),", ".join(impTests)))
 
 logger.info("")
-logger.info("Building SixTrack:")
+logger.info("Building and Testing SixTrack:")
+
+bldPass  = {}
+bldDirs  = {}
+tstPass  = {}
+bldLocks = {}
+bldOrder = []
+runPool  = JobPool(nCores)
+runLock  = threading.Lock()
+bldCache = BuildCache(dCache,maxCache)
+tstCosts = {}
+if path.isfile(timDB):
+  tstCosts = TimingStore(timDB).getTestCosts()
+
+def cmakeFingerprint(cmakeArgs, aComp):
+  """Hash the CMake configuration inputs of the checked out tree together with
+  the CMake arguments, the source folder, and the versions of CMake and the
+  compiler. An incremental build dir is only reused if it matches.
+  """
+  stdOut, stdErr, exCode = sysCall(
+    "git ls-files -s -- CMakeLists.txt ':(glob)**/CMakeLists.txt' ':(glob)**/*.cmake'", cwd=workDir
+  )
+  if exCode != 0:
+    return None
+  fpData = [stdOut, cmakeArgs, workDir]
+  for verCmd in ["cmake --version", "%s %s" % (aComp,cVersion[aComp])]:
+    verOut, verErr, exCode = sysCall(verCmd)
+    if exCode != 0:
+      return None
+    fpData.append((verOut+verErr).strip())
+  return hashlib.sha1("\n".join(fpData).encode()).hexdigest()
+
+def incrBuild(bName, aComp, aType):
+  """Build one compiler and type in a persistent build dir for the option set,
+  running cmake and make directly so only changed files are rebuilt. Falls
+  back to a clean build dir when the CMake inputs, the tools or the worktree
+  slot have changed. The build dir is locked until its tests have run, as
+  other quick builds may use the same option set.
+  """
+  bldName   = "SixTrack_cmakesix_%s" % "_".join(["BUILD_TESTING"]+theFlags+[aComp,aType])
+  bPath     = path.join(dIncr,bldName)
+  fpFile    = path.join(bPath,"fingerprint.dat")
+
+  makedirs(dIncr, exist_ok=True)
+  lockFd = open(bPath+".lock",mode="w")
+  try:
+    fcntl.flock(lockFd,fcntl.LOCK_EX | fcntl.LOCK_NB)
+  except OSError:
+    logger.info("Waiting for another quick build to finish with: %s" % bPath)
+    fcntl.flock(lockFd,fcntl.LOCK_EX)
+  with runLock:
+    bldLocks[bName] = lockFd
+
+  cmakeArgs = "-DCMAKE_Fortran_COMPILER=%s -DCMAKE_BUILD_TYPE=%s -DBUILD_TESTING=ON" % (aComp,aType.capitalize())
+  for aFlag in theFlags:
+    if aFlag[:1] == "-":
+      cmakeArgs += " -D%s=OFF" % aFlag[1:]
+    else:
+      cmakeArgs += " -D%s=ON" % aFlag
+
+  theFP  = cmakeFingerprint(cmakeArgs, aComp)
+  prevFP = None
+  if path.isfile(fpFile):
+    with open(fpFile,mode="r") as inFile:
+      prevFP = inFile.read().strip()
+  if theFP is None or theFP != prevFP:
+    if path.isdir(bPath):
+      logger.info("CMake inputs, tools or worktree changed, doing a clean build of: %s" % bName)
+      shutil.rmtree(bPath)
+  else:
+    logger.info("Building incrementally in: %s" % bPath)
+  makedirs(bPath, exist_ok=True)
+
+  cmdStr = "cmake %s %s" % (cmakeArgs,workDir)
+  logger.info("Running: %s" % cmdStr)
+  exCode = sysRun(
+    cmdStr, cwd=bPath, logName="cmake", logPath=bPath, logTag="CMAKE %s" % bName if buildOut else None
+  )
+  if exCode != 0:
+    # Don't trust a half configured dir on the next run
+    logger.warning("CMake failed for %s, see %s" % (bName,path.join(bPath,"stderr_cmake.log")))
+    if path.isfile(fpFile):
+      remove(fpFile)
+    return bPath, exCode
+  if theFP is not None:
+    with open(fpFile,mode="w") as outFile:
+      outFile.write(theFP+"\n")
+
+  # A failed compile keeps the configured dir, so the next run only rebuilds
+  # what changed
+  cmdStr = "make -j%d" % nBld
+  logger.info("Running: %s" % cmdStr)
+  exCode = sysRun(
+    cmdStr, cwd=bPath, logName="build", logPath=bPath, logTag="BUILD %s" % bName if buildOut else None
+  )
+  return bPath, exCode
+
+def releaseIncr(bName):
+  with runLock:
+    lockFd = bldLocks.pop(bName, None)
+  if lockFd is not None:
+    fcntl.flock(lockFd,fcntl.LOCK_UN)
+    lockFd.close()
+  return
+
+def runBuild(bName, cmdStr, cacheKey):
+  """Build one compiler and type, either with cmake_six or incrementally.
+  Called from the job pool, so it must not change the working directory. A
+  successful build goes on to the tests.
+  """
+  if doIncr:
+    aComp, aType = bName.split()
+    bPath, exCode = incrBuild(bName, aComp, aType)
+    if exCode != 0:
+      logger.warning("Build %s failed, see the logs in %s" % (bName,bPath))
+      releaseIncr(bName)
+  else:
+    bPath = bldCache.restore(cacheKey,workDir)
+    if bPath is not None:
+      logger.info("Restored from build cache: %s" % bPath)
+      exCode = 0
+    else:
+      logger.info("Running: %s" % cmdStr)
+      bldName = "build_%s" % bName.replace(" ","_")
+      bldTail = deque(maxlen=1)
+      exCode  = sysRun(
+        "MAKEFLAGS=-j%d %s %s" % (nBld,prefixFlags(workDir,bName.split()[0]),cmdStr), cwd=workDir, logName=bldName, logPath=workDir,
+        logTag="BUILD %s" % bName if buildOut else None, lineFuncs=[bldTail.append]
+      )
+      if exCode == 0:
+        bPath = cmakeSixReturn("\n".join(bldTail)+"\n","")
+        moveStdFiles(bldName,workDir,"build",path.join(workDir,bPath))
+        bldCache.store(cacheKey,workDir,bPath)
+      else:
+        logger.warning("Build %s failed, see %s" % (bName,path.join(workDir,"stderr_%s.log" % bldName)))
+  with runLock:
+    bldPass[bName] = exCode == 0
+    if exCode == 0:
+      bldDirs[bName] = path.basename(bPath)
+  if exCode == 0:
+    runPool.submit(nTest, runTest, bName, path.join(workDir,bPath), jobPrio=-1)
+  return
+
+def runTest(bName, theBuild):
+  """Run the tests of one build. Called from the job pool.
+  """
+  writeCostData(theBuild,tstCosts)
+  cmdStr = "ctest %s -j%d" % (theTest,nTest)
+  logger.info("Running: %s in %s" % (cmdStr,theBuild))
+  exCode = sysRun(cmdStr, cwd=theBuild, logName="test", logPath=theBuild, logTag="TEST %s" % bName if testOut else None)
+  with runLock:
+    tstPass[bName] = exCode == 0
+  releaseIncr(bName)
+  return
 
-bldPass = {}
 exCode = system("rm -rf build/")
 for aComp in theComps:
+  stdOut, stdErr, exCode = sysCall("%s %s" % (aComp,cVersion[aComp]))
+  compVers = (stdOut+stdErr).split("\n")[0]
   for aType in theTypes:
-    cmdStr = "./cmake_six %s %s BUILD_TESTING %s" % (aComp,aType," ".join(theFlags))
-    if not buildOut:
-      cmdStr += " > /dev/null"
-    logger.info("Running: %s" % cmdStr)
-    exCode = system(cmdStr)
-    bldPass[aComp+" "+aType] = exCode == 0
-
-logger.info("")
-logger.info("Running Tests:")
-
-bldDir  = path.join(workDir,"build")
-tstPass = {}
-for aBuild in listdir(bldDir):
-  theBuild = path.join(bldDir,aBuild)
-  if path.isdir(theBuild):
-    logger.info("Entering in: %s" % aBuild)
-    chdir(theBuild)
-    cmdStr = "ctest %s -j%d" % (theTest,nTest)
-    if not testOut:
-      cmdStr += " > /dev/null"
-    logger.info("Running: %s" % cmdStr)
-    exCode = system(cmdStr)
-    tstPass[aBuild] = exCode == 0
+    bName    = aComp+" "+aType
+    cmdStr   = "./cmake_six %s %s BUILD_TESTING %s" % (aComp,aType," ".join(theFlags))
+    cacheKey = bldCache.makeKey(workDir,compVers,aType,"BUILD_TESTING %s" % " ".join(theFlags))
+    bldOrder.append(bName)
+    runPool.submit(nBld, runBuild, bName, cmdStr, cacheKey)
+runPool.wait()
 
 logger.info("")
 logger.info(" Summary:")
 logger.info("="*80)
 logger.info("")
-for aBuild in bldPass:
-  if aBuild:
+for aBuild in bldOrder:
+  if bldPass.get(aBuild,False):
     bRes = "   Passed"
   else:
     bRes = "***Failed"
   bDesc = "Build: %s %s" % (aBuild," ".join(theFlags))
   logger.info(" %s %s%s" % (bDesc,"."*(68-len(bDesc)),bRes))
 
-for aTest in tstPass:
-  if aTest:
+for aBuild in bldOrder:
+  if aBuild not in tstPass:
+    continue
+  if tstPass[aBuild]:
     bRes = "   Passed"
   else:
     bRes = "***Failed"
-  tDesc = "Test: %s" % (aTest[18:].replace("BUILD_TESTING","").replace("_"," ").strip())
+  tDesc = "Test: %s" % (bldDirs[aBuild][18:].replace("BUILD_TESTING","").replace("_"," ").strip())
   logger.info(" %s %s%s" % (tDesc,"."*(68-len(tDesc)),bRes))
 
 chdir(workDir)
-if path.isdir(workDir) and doClean:
-  stdOut, stdErr, exCode = sysCall("rm -rf %s" % gitHash)
+if doClean:
+  stdOut, stdErr, exCode = sysCall("rm -rf build/")
+wtPool.release(workDir)
 
 logger.info("")
 logger.info("="*80)
 logger.info("")
+
+# Exit code tells the caller, like the build daemon, if everything passed
+allPass = all(bldPass.get(aBuild,False) for aBuild in bldOrder) and all(tstPass.values())
+exit(0 if allPass else 1)
@@ -0,0 +1,209 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*
+"""SixTrack Results Publisher
+
+  SixTrack Results Publisher
+ ============================
+  Collect all result records of a run into one bundle, and send it to the
+  SixTrack website in a single request. A bundle is a file with one JSON
+  record per line (NDJSON) and an index file listing the label, action and
+  byte range of each record. Both are posted as form fields, the records as
+  "bundle" and the index as "index", together with the run ID as "bundleid".
+
+  Records are appended to the spool directory as they are added, so nothing
+  is lost if the run dies. The open bundle of a run is locked while the run
+  is alive, and bundles left open by runs that died are closed by the next
+  publisher. Bundles that could not be delivered stay in the spool, and are
+  sent first the next time the publisher runs. Requests go through one pooled
+  session that retries with exponential backoff. Each line of a bundle is of
+  the form {"label": ..., "record": ...}.
+
+  Usage:
+    resultsPublisher.py flush <spool dir> <url>
+
+"""
+
+import sys
+import json
+import fcntl
+import logging
+import threading
+import requests
+from os import path, listdir, makedirs, remove, rename, fstat, stat
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+logger = logging.getLogger("SixTrackTestBuild")
+
+class ResultsPublisher:
+
+  def __init__(self, spoolDir, stUrl, runId, maxRetry=5, backOff=2.0, timeOut=60):
+    self.spoolDir = spoolDir
+    self.stUrl    = stUrl
+    self.runId    = runId
+    self.timeOut  = timeOut
+    self.theLock  = threading.Lock()
+    self.theIndex = []
+    self.partFile = path.join(spoolDir,"%s.ndjson.part" % runId)
+    self.partFd   = None
+    makedirs(spoolDir, exist_ok=True)
+
+    retryArgs = {
+      "total"            : maxRetry,
+      "backoff_factor"   : backOff,
+      "status_forcelist" : [429,500,502,503,504],
+    }
+    try:
+      theRetry = Retry(allowed_methods=["POST"], **retryArgs)
+    except TypeError:
+      # Older versions of urllib3
+      theRetry = Retry(method_whitelist=["POST"], **retryArgs)
+    self.theSession = requests.Session()
+    self.theSession.mount("http://",  HTTPAdapter(max_retries=theRetry))
+    self.theSession.mount("https://", HTTPAdapter(max_retries=theRetry))
+    return
+
+  def add(self, theData, theLabel):
+    """Add a record to the bundle of this run.
+    """
+    theRecord = {"label": theLabel, "record": theData}
+    recLine   = (json.dumps(theRecord, separators=(",",":"))+"\n").encode("utf-8")
+    with self.theLock:
+      if self.partFd is None:
+        self.partFd = self._openPart()
+      recOffset = self.partFd.tell()
+      self.partFd.write(recLine)
+      self.partFd.flush()
+      self.theIndex.append({
+        "label"  : theLabel,
+        "action" : theData.get("action",""),
+        "offset" : recOffset,
+        "length" : len(recLine),
+      })
+    return
+
+  def publish(self):
+    """Close the bundle of this run and send all bundles in the spool.
+    """
+    with self.theLock:
+      if self.partFd is not None:
+        self._closeBundle(self.runId, self.theIndex)
+        self.partFd.close()
+        self.partFd = None
+      self.theIndex = []
+    return self.flushSpool()
+
+  def flushSpool(self):
+    """Send all closed bundles in the spool, oldest first. Bundles left open
+    by runs that died are closed first, while those of runs still going are
+    left alone. Returns the number of bundles still not delivered.
+    """
+    for spoolFile in sorted(listdir(self.spoolDir)):
+      if not spoolFile.endswith(".ndjson.part"):
+        continue
+      runId = spoolFile[:-len(".ndjson.part")]
+      if runId == self.runId:
+        continue
+      partFile = path.join(self.spoolDir,spoolFile)
+      try:
+        lockFd = open(partFile,mode="rb")
+      except FileNotFoundError:
+        continue
+      try:
+        fcntl.flock(lockFd,fcntl.LOCK_EX|fcntl.LOCK_NB)
+      except BlockingIOError:
+        logger.debug("Publisher: Bundle of run %s is still open" % runId)
+        lockFd.close()
+        continue
+      try:
+        if path.isfile(partFile):
+          logger.info("Publisher: Closing bundle of unfinished run %s" % runId)
+          self._closeBundle(runId, self._scanBundle(partFile))
+      finally:
+        lockFd.close()
+
+    nLeft = 0
+    for spoolFile in sorted(listdir(self.spoolDir)):
+      if not spoolFile.endswith(".ndjson"):
+        continue
+      runId = spoolFile[:-len(".ndjson")]
+      if self._sendBundle(runId):
+        remove(path.join(self.spoolDir,runId+".ndjson"))
+        remove(path.join(self.spoolDir,runId+".index.json"))
+      else:
+        nLeft += 1
+    if nLeft > 0:
+      logger.warning("Publisher: %d bundles left in spool %s" % (nLeft, self.spoolDir))
+    return nLeft
+
+  def _sendBundle(self, runId):
+    ndFile  = path.join(self.spoolDir,runId+".ndjson")
+    idxFile = path.join(self.spoolDir,runId+".index.json")
+    try:
+      with open(idxFile,mode="r") as inFile:
+        theIndex = json.load(inFile)
+      with open(ndFile,mode="r",encoding="utf-8") as inFile:
+        theBundle = inFile.read()
+      retVal = self.theSession.post(self.stUrl, timeout=self.timeOut, data={
+        "bundleid" : runId,
+        "bundle"   : theBundle,
+        "index"    : json.dumps(theIndex, separators=(",",":")),
+      })
+      retVal.raise_for_status()
+      logger.info("Publisher: Sent bundle %s with %d records" % (runId, len(theIndex)))
+      logger.debug("Publisher: Reply: %s" % retVal.text.strip())
+      return True
+    except Exception as e:
+      logger.error("Publisher: Failed to send bundle %s" % runId)
+      logger.error(str(e))
+    return False
+
+  def _closeBundle(self, runId, theIndex):
+    partFile = path.join(self.spoolDir,runId+".ndjson.part")
+    with open(path.join(self.spoolDir,runId+".index.json"),mode="w") as outFile:
+      json.dump(theIndex, outFile)
+    rename(partFile, path.join(self.spoolDir,runId+".ndjson"))
+    return
+
+  def _openPart(self):
+    # Open and lock the bundle of this run. Another publisher may have closed
+    # it between the open and the lock, in which case a new one is opened.
+    while True:
+      partFd = open(self.partFile,mode="ab")
+      fcntl.flock(partFd,fcntl.LOCK_EX)
+      try:
+        if fstat(partFd.fileno()).st_ino == stat(self.partFile).st_ino:
+          return partFd
+      except FileNotFoundError:
+        pass
+      partFd.close()
+
+  def _scanBundle(self, partFile):
+    # Rebuild the index of a bundle from its records, skipping a cut off line
+    theIndex  = []
+    recOffset = 0
+    goodSize  = 0
+    with open(partFile,mode="rb") as inFile:
+      for recLine in inFile:
+        try:
+          theRecord = json.loads(recLine.decode("utf-8"))
+        except ValueError:
+          break
+        theIndex.append({
+          "label"  : theRecord["label"],
+          "action" : theRecord["record"].get("action",""),
+          "offset" : recOffset,
+          "length" : len(recLine),
+        })
+        recOffset += len(recLine)
+        goodSize   = recOffset
+    with open(partFile,mode="ab") as outFile:
+      outFile.truncate(goodSize)
+    return theIndex
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.DEBUG, format="%(message)s")
+  if len(sys.argv) >= 4 and sys.argv[1] == "flush":
+    sys.exit(min(ResultsPublisher(sys.argv[2], sys.argv[3], "flush").flushSpool(), 1))
+  else:
+    print(__doc__)
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*
+"""SixTrack Simulation Data
+
+  SixTrack Simulation Data
+ ==========================
+  Collect the sim_meta.dat and sim_time.dat files written by SixTrack in all
+  test directories of a build in a single pass. The directories are scanned in
+  parallel, and every key in both files is collected. The values are kept as
+  the strings SixTrack wrote, so the legacy text logs are unchanged, and they
+  are parsed to an int, float or string when stored as one compact columnar
+  table per build.
+
+"""
+
+import gzip
+import json
+import logging
+from os import path, listdir, makedirs
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger("SixTrackTestBuild")
+
+# The files to collect, and the end column of the value in each of them
+simFiles = {
+  "sim_meta" : 50,
+  "sim_time" : 49,
+}
+
+def parseValue(theValue):
+  for valType in (int, float):
+    try:
+      return valType(theValue)
+    except ValueError:
+      pass
+  return theValue
+
+def parseSimFile(simFile, valEnd):
+  """Read all keys of a sim_*.dat file as strings. Returns None if it does not
+  exist.
+  """
+  if not path.isfile(simFile):
+    return None
+  theData = {}
+  with open(simFile,mode="r") as inFile:
+    for inLine in inFile:
+      if len(inLine) < valEnd:
+        continue
+      theName = inLine[:32].strip()
+      if theName == "" or theName[0] == "#":
+        continue
+      theData[theName] = inLine[35:valEnd].strip()
+  return theData
+
+def _readTestDir(testPath):
+  return {simName: parseSimFile(path.join(testPath,simName+".dat"), simFiles[simName]) for simName in simFiles}
+
+def collectSimData(testDir, nWorkers=8):
+  """Read the sim files of all test directories in testDir. Returns a
+  dictionary of test name to a dictionary with the content of each file, or
+  None for files that do not exist.
+  """
+  tNames = [tName for tName in sorted(listdir(testDir)) if path.isdir(path.join(testDir,tName))]
+  with ThreadPoolExecutor(max_workers=max(1,nWorkers)) as theExec:
+    tData = list(theExec.map(lambda tName: _readTestDir(path.join(testDir,tName)), tNames))
+  return dict(zip(tNames, tData))
+
+def toColumns(simRows):
+  """Convert the collected data to a table with one column per key, and the
+  type of each column. The values are parsed, and missing values are None.
+  """
+  tNames  = sorted(simRows)
+  theCols = {"test": tNames}
+  colType = {"test": "str"}
+  for tIdx, tName in enumerate(tNames):
+    for simName in simFiles:
+      simData = simRows[tName][simName]
+      if simData is None:
+        continue
+      for theKey, rawValue in simData.items():
+        theValue = parseValue(rawValue)
+        if theKey not in theCols:
+          theCols[theKey] = [None]*len(tNames)
+          colType[theKey] = type(theValue).__name__
+        elif colType[theKey] != type(theValue).__name__:
+          # Mixed types, such as an int column with a float in it
+          colType[theKey] = "float" if {colType[theKey], type(theValue).__name__} == {"int","float"} else "str"
+        theCols[theKey][tIdx] = theValue
+  return {"types": colType, "columns": theCols}
+
+def writeSimTable(simRows, outFile):
+  outDir = path.dirname(outFile)
+  if outDir != "" and not path.isdir(outDir):
+    makedirs(outDir, exist_ok=True)
+  try:
+    with gzip.open(outFile,mode="wt") as outData:
+      json.dump(toColumns(simRows), outData, separators=(",",":"))
+  except Exception as e:
+    logger.error("Failed to write simulation data to %s" % outFile)
+    logger.error(str(e))
+  return
+
+def readSimTable(inFile):
+  with gzip.open(inFile,mode="rt") as inData:
+    return json.load(inData)
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*
+"""SixTrack Test Profiler
+
+  SixTrack Test Profiler
+ ========================
+  Profile SixTrack while it runs a set of tests, and reduce the output to a
+  table of the time spent in each function. The sampling profiler perf is
+  used when it is available and allowed to run, otherwise gprof, which needs
+  SixTrack to be built with -pg. With perf, each test is run again under
+  'perf record'. With gprof, the gmon.out file each test leaves in its folder
+  is read.
+
+  Each row of a table has the function name, its share of the samples in
+  percent, its self time in seconds and, for gprof, its number of calls.
+
+"""
+
+import re
+import logging
+from os import path, listdir, access, X_OK
+
+from buildFunctions import sysCall
+
+logger = logging.getLogger("SixTrackTestBuild")
+
+# Sampling frequency for perf in Hz
+perfFreq = 999
+
+# Compiler and linker flags for a profiling build with each tool
+profFlags = {
+  "perf"  : ("-g -fno-omit-frame-pointer", ""),
+  "gprof" : ("-g -pg", "-pg"),
+}
+
+# Matches the lines of 'perf report' with the overhead, sample, dso and sym fields
+perfLine = re.compile(r"^\s*([\d.]+)%\s+(\d+)\s+(\S+)\s+\[.\]\s+(.+?)\s*$")
+
+def findProfiler():
+  """Return the profiling tool to use, or None if there is none.
+  """
+  stdOut, stdErr, exCode = sysCall("perf stat -e task-clock -o /dev/null true")
+  if exCode == 0:
+    return "perf"
+  stdOut, stdErr, exCode = sysCall("gprof --version")
+  if exCode == 0:
+    return "gprof"
+  return None
+
+def findExecutable(bDir):
+  """Find the SixTrack executable in a build folder.
+  """
+  for bFile in sorted(listdir(bDir)):
+    bPath = path.join(bDir,bFile)
+    if bFile.startswith("SixTrack") and path.isfile(bPath) and access(bPath, X_OK):
+      return bPath
+  return None
+
+def parsePerfReport(repText, exeName):
+  """Parse the output of perf report, keeping only functions in SixTrack.
+  """
+  theRows = []
+  for repLine in repText.split("\n"):
+    lnMatch = perfLine.match(repLine)
+    if lnMatch is None:
+      continue
+    pctVal, nSamples, dsoName, funcName = lnMatch.groups()
+    if dsoName != exeName:
+      continue
+    theRows.append({
+      "function" : funcName,
+      "percent"  : float(pctVal),
+      "selftime" : round(int(nSamples)/perfFreq, 3),
+      "calls"    : None,
+    })
+  return theRows
+
+def parseGprofFlat(repText):
+  """Parse the flat profile from 'gprof -b -p'. Functions that were never
+  sampled are skipped.
+  """
+  theRows = []
+  for repLine in repText.split("\n"):
+    lnBits = repLine.split()
+    if len(lnBits) < 4:
+      continue
+    try:
+      pctVal   = float(lnBits[0])
+      selfTime = float(lnBits[2])
+    except ValueError:
+      continue
+    if len(lnBits) >= 7:
+      funcName = " ".join(lnBits[6:])
+      numCalls = int(lnBits[3])
+    else:
+      funcName = " ".join(lnBits[3:])
+      numCalls = None
+    if selfTime == 0.0:
+      continue
+    theRows.append({
+      "function" : funcName,
+      "percent"  : pctVal,
+      "selftime" : selfTime,
+      "calls"    : numCalls,
+    })
+  return theRows
+
+def profileTest(bDir, tName, theTool, exeFile):
+  """Profile one test in a build folder. Returns the table of functions,
+  ordered by self time, or None if the profile could not be made.
+  """
+  if theTool == "perf":
+    perfData = path.join(bDir,"perf_%s.data" % tName)
+    stdOut, stdErr, exCode = sysCall(
+      "perf record -F %d -o %s -- ctest -R '^%s$'" % (perfFreq,perfData,tName), cwd=bDir
+    )
+    if exCode != 0:
+      logger.warning("Profiler: perf record failed for %s" % tName)
+      return None
+    stdOut, stdErr, exCode = sysCall(
+      "perf report -i %s --stdio -q --no-children --sort dso,sym --fields overhead,sample,dso,sym" % perfData
+    )
+    if exCode != 0:
+      logger.warning("Profiler: perf report failed for %s" % tName)
+      return None
+    theRows = parsePerfReport(stdOut, path.basename(exeFile))
+  elif theTool == "gprof":
+    gmonFile = path.join(bDir,"test",tName,"gmon.out")
+    if not path.isfile(gmonFile):
+      logger.warning("Profiler: No gmon.out for %s" % tName)
+      return None
+    stdOut, stdErr, exCode = sysCall("gprof -b -p %s %s" % (exeFile,gmonFile))
+    if exCode != 0:
+      logger.warning("Profiler: gprof failed for %s" % tName)
+      return None
+    theRows = parseGprofFlat(stdOut)
+  else:
+    return None
+  theRows.sort(key=lambda theRow: theRow["selftime"], reverse=True)
+  return theRows
+
+def profileChanges(theProfs, minRise=0.2, minTime=0.05):
+  """Compare the newest profile of a test from TimingStore.getProfiles with
+  the median of the ones before it. Returns the functions where the self time
+  rose by more than minRise, and by more than minTime seconds, worst first.
+  """
+  if len(theProfs) < 2:
+    return []
+  currHash, currTime, currTool, currRows = theProfs[0]
+  theChanges = []
+  for funcName, currRow in currRows.items():
+    prevTimes = sorted(
+      pRows[funcName]["selftime"] for pHash, pTime, pTool, pRows in theProfs[1:]
+      if pTool == currTool and funcName in pRows
+    )
+    if len(prevTimes) == 0:
+      continue
+    prevMed = prevTimes[len(prevTimes)//2]
+    if currRow["selftime"] - prevMed < minTime or prevMed <= 0.0:
+      continue
+    funcRise = currRow["selftime"]/prevMed - 1.0
+    if funcRise < minRise:
+      continue
+    theChanges.append({
+      "function" : funcName,
+      "selftime" : currRow["selftime"],
+      "previous" : prevMed,
+      "rise"     : round(funcRise, 3),
+    })
+  theChanges.sort(key=lambda theChange: theChange["rise"], reverse=True)
+  return theChanges
@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*
+"""SixTrack Results Publisher Tests
+
+  SixTrack Results Publisher Tests
+ ==================================
+  Send bundles to a local HTTP server, and check what arrives and what is
+  left in the spool.
+
+  Usage:
+    python3 -m pytest test_resultsPublisher.py
+
+"""
+
+import json
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+from os import path, listdir
+from urllib.parse import parse_qs
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from resultsPublisher import ResultsPublisher
+
+class BundleHandler(BaseHTTPRequestHandler):
+
+  def do_POST(self):
+    theServer = self.server
+    theBody   = self.rfile.read(int(self.headers["Content-Length"]))
+    with theServer.theLock:
+      theServer.postTimes.append(time.time())
+      retCode = theServer.retCodes.pop(0) if len(theServer.retCodes) > 0 else 200
+      if retCode == 200:
+        theServer.theBundles.append(parse_qs(theBody.decode("utf-8")))
+    self.send_response(retCode)
+    self.send_header("Content-Length","2")
+    self.end_headers()
+    self.wfile.write(b"OK")
+    return
+
+  def log_message(self, *theArgs):
+    return
+
+class TestResultsPublisher(unittest.TestCase):
+
+  def setUp(self):
+    self.spoolDir  = tempfile.mkdtemp()
+    self.theServer = HTTPServer(("127.0.0.1",0), BundleHandler)
+    self.theServer.theLock    = threading.Lock()
+    self.theServer.retCodes   = []
+    self.theServer.postTimes  = []
+    self.theServer.theBundles = []
+    self.stUrl = "http://127.0.0.1:%d/build_status.php" % self.theServer.server_port
+    self.srvThread = threading.Thread(target=self.theServer.serve_forever, daemon=True)
+    self.srvThread.start()
+    return
+
+  def tearDown(self):
+    self.theServer.shutdown()
+    self.theServer.server_close()
+    shutil.rmtree(self.spoolDir)
+    return
+
+  def makePublisher(self, runId, maxRetry=3, backOff=0.1):
+    return ResultsPublisher(self.spoolDir, self.stUrl, runId, maxRetry=maxRetry, backOff=backOff, timeOut=10)
+
+  def test_oneBundlePerPublish(self):
+    resPub = self.makePublisher("run_1")
+    resPub.add({"action": "build", "buildno": 1}, "build_a")
+    resPub.add({"action": "test", "buildno": 1}, "test_a")
+    resPub.add({"action": "meta"}, "meta")
+    self.assertEqual(resPub.publish(), 0)
+    self.assertEqual(len(self.theServer.postTimes), 1)
+
+    theBundle = self.theServer.theBundles[0]
+    self.assertEqual(theBundle["bundleid"], ["run_1"])
+    theIndex = json.loads(theBundle["index"][0])
+    theLines = theBundle["bundle"][0].encode("utf-8")
+    self.assertEqual([theEntry["label"] for theEntry in theIndex], ["build_a","test_a","meta"])
+    for theEntry in theIndex:
+      theRecord = json.loads(theLines[theEntry["offset"]:theEntry["offset"]+theEntry["length"]].decode("utf-8"))
+      self.assertEqual(theRecord["label"], theEntry["label"])
+      self.assertEqual(theRecord["record"]["action"], theEntry["action"])
+    self.assertEqual(listdir(self.spoolDir), [])
+    return
+
+  def test_retryWithBackoff(self):
+    self.theServer.retCodes = [503, 503]
+    resPub = self.makePublisher("run_1", maxRetry=3, backOff=0.2)
+    resPub.add({"action": "meta"}, "meta")
+    self.assertEqual(resPub.publish(), 0)
+    self.assertEqual(len(self.theServer.postTimes), 3)
+    self.assertEqual(len(self.theServer.theBundles), 1)
+    # The second retry waits for at least backOff*2 seconds
+    self.assertGreaterEqual(self.theServer.postTimes[2] - self.theServer.postTimes[1], 0.35)
+    return
+
+  def test_undeliveredStaysSpooled(self):
+    self.theServer.retCodes = [503]*4
+    resPub = self.makePublisher("run_1", maxRetry=1, backOff=0.0)
+    resPub.add({"action": "meta"}, "meta")
+    self.assertEqual(resPub.publish(), 1)
+    self.assertEqual(sorted(listdir(self.spoolDir)), ["run_1.index.json","run_1.ndjson"])
+    self.assertEqual(len(self.theServer.theBundles), 0)
+
+    self.theServer.retCodes = []
+    nextPub = self.makePublisher("run_2")
+    self.assertEqual(nextPub.flushSpool(), 0)
+    self.assertEqual(len(self.theServer.theBundles), 1)
+    self.assertEqual(self.theServer.theBundles[0]["bundleid"], ["run_1"])
+    self.assertEqual(listdir(self.spoolDir), [])
+    return
+
+  def test_liveBundleLeftOpen(self):
+    livePub = self.makePublisher("run_1")
+    livePub.add({"action": "build"}, "build_a")
+    nextPub = self.makePublisher("run_2")
+    self.assertEqual(nextPub.flushSpool(), 0)
+    self.assertEqual(listdir(self.spoolDir), ["run_1.ndjson.part"])
+    self.assertEqual(len(self.theServer.postTimes), 0)
+
+    # Once the run is gone, its bundle is closed and sent
+    livePub.partFd.close()
+    self.assertEqual(nextPub.flushSpool(), 0)
+    self.assertEqual(len(self.theServer.theBundles), 1)
+    self.assertEqual(listdir(self.spoolDir), [])
+    return
+
+if __name__ == "__main__":
+  unittest.main()
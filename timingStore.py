@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*
+"""SixTrack Timing Store
+
+  SixTrack Timing Store
+ =======================
+  Indexed store of the historical test execution times, kept in an SQLite
+  database next to the plain text Timing/<test>.log files. Each record is
+  keyed by test, commit, build command and time stamp. Tests run on a remote
+  build worker have its host name set, and are left out of the regression
+  and cost queries of the local host. The per-function profiles of the
+  nightly profiling build are kept in the same database.
+
+  Usage:
+    timingStore.py import <database> <timing dir>
+    timingStore.py query  <database> <test> <build command> [<commits>]
+    timingStore.py export <database> <output file>
+    timingStore.py profile <database> <test> [<commits>]
+
+"""
+
+import re
+import sys
+import gzip
+import json
+import sqlite3
+import logging
+import threading
+from os import path, listdir
+
+logger = logging.getLogger("SixTrackTestBuild")
+
+# Matches one line of the Timing/<test>.log files
+timingLine = re.compile(
+  r"^\[(\d{4}-\d\d-\d\d \d\d:\d\d:\d\d)\]\s+([0-9a-f]{40})\s+(.{19})\s+(\S+)\s+(\S+)\s+Build: (.*)$"
+)
+
+timingColumns = ["test","hash","ctime","stamp","build","compiler","type","exectime","ctesttime","result","host"]
+
+class TimingStore:
+
+  def __init__(self, dbFile):
+    self.dbFile  = dbFile
+    self.theLock = threading.Lock()
+    self.theConn = sqlite3.connect(dbFile, check_same_thread=False)
+    self.theConn.execute("PRAGMA journal_mode=WAL")
+    self.theConn.executescript("""
+      CREATE TABLE IF NOT EXISTS timing (
+        test      TEXT NOT NULL,
+        hash      TEXT NOT NULL,
+        ctime     TEXT,
+        stamp     TEXT NOT NULL,
+        build     TEXT NOT NULL,
+        compiler  TEXT,
+        type      TEXT,
+        exectime  REAL,
+        ctesttime REAL,
+        result    TEXT,
+        host      TEXT,
+        UNIQUE (test, hash, build, stamp)
+      );
+      CREATE INDEX IF NOT EXISTS timing_test_build ON timing (test, build, ctime);
+      CREATE INDEX IF NOT EXISTS timing_hash ON timing (hash);
+      CREATE INDEX IF NOT EXISTS timing_stamp ON timing (stamp);
+      CREATE TABLE IF NOT EXISTS profile (
+        test      TEXT NOT NULL,
+        hash      TEXT NOT NULL,
+        ctime     TEXT,
+        tool      TEXT NOT NULL,
+        function  TEXT NOT NULL,
+        percent   REAL,
+        selftime  REAL,
+        calls     INTEGER,
+        UNIQUE (test, hash, tool, function)
+      );
+      CREATE INDEX IF NOT EXISTS profile_test ON profile (test, ctime);
+    """)
+    # Stores made before the host column was added
+    theCols = [theRow[1] for theRow in self.theConn.execute("PRAGMA table_info(timing)")]
+    if "host" not in theCols:
+      self.theConn.execute("ALTER TABLE timing ADD COLUMN host TEXT")
+    self.theConn.commit()
+    return
+
+  def close(self):
+    with self.theLock:
+      self.theConn.close()
+    return
+
+  def addTiming(self, tName, gitHash, gitTime, tStamp, bldCmd, execTime, tRes, ctestTime=None, theHost=None):
+    """Add one timing record. bldCmd is the build command without the leading
+    './cmake_six', the same as written to the Timing logs. theHost is the
+    remote worker the test ran on, or None for the local host.
+    """
+    with self.theLock:
+      self._insertRows([(tName, gitHash, gitTime, tStamp, bldCmd, execTime, tRes, ctestTime, theHost)])
+      self.theConn.commit()
+    return
+
+  def getTimings(self, tName, bldCmd, nCommits=20):
+    """Get the timings of a test for a build command over the last nCommits
+    commits, newest first, as a list of dictionaries.
+    """
+    with self.theLock:
+      theRows = self.theConn.execute("""
+        SELECT hash, ctime, stamp, exectime, ctesttime, result, host FROM timing
+        WHERE test = ? AND build = ? AND hash IN (
+          SELECT hash FROM timing WHERE test = ? AND build = ?
+          GROUP BY hash ORDER BY MAX(ctime) DESC LIMIT ?
+        )
+        ORDER BY ctime DESC, stamp DESC
+      """, (tName, bldCmd, tName, bldCmd, nCommits)).fetchall()
+    return [dict(zip(("hash","ctime","stamp","exectime","ctesttime","result","host"), theRow)) for theRow in theRows]
+
+  def getRecent(self, nCommits=30, theHost=None):
+    """Get all passed timing records of the last nCommits commits, as a list
+    of dictionaries. Only the records of theHost are returned, which defaults
+    to the local host.
+    """
+    theCols = ("test","hash","ctime","build","compiler","type","exectime","ctesttime")
+    with self.theLock:
+      theRows = self.theConn.execute("""
+        SELECT %s FROM timing
+        WHERE result = 'Passed' AND host IS ? AND hash IN (
+          SELECT hash FROM timing GROUP BY hash ORDER BY MAX(ctime) DESC LIMIT ?
+        )
+      """ % ", ".join(theCols), (theHost, nCommits)).fetchall()
+    return [dict(zip(theCols, theRow)) for theRow in theRows]
+
+  def getTestCosts(self, theCompiler=None, theType=None, nCommits=30, theHost=None):
+    """Get the typical run time of each test over the last nCommits commits
+    on theHost, optionally for one compiler and build type only. The ctest
+    duration is used where available, otherwise the SixTrack execution time.
+    Returns a dictionary of test name to (number of runs, median time).
+    """
+    theTimes = {}
+    for tRecord in self.getRecent(nCommits, theHost):
+      if theCompiler is not None and tRecord["compiler"] != theCompiler:
+        continue
+      if theType is not None and tRecord["type"] != theType.lower():
+        continue
+      tTime = tRecord["ctesttime"] if tRecord["ctesttime"] is not None else tRecord["exectime"]
+      if tTime is not None:
+        theTimes.setdefault(tRecord["test"], []).append(tTime)
+    theCosts = {}
+    for tName, tTimes in theTimes.items():
+      tTimes.sort()
+      theCosts[tName] = (len(tTimes), tTimes[len(tTimes)//2])
+    return theCosts
+
+  def addProfile(self, tName, gitHash, gitTime, theTool, theRows):
+    """Add the per-function profile of a test, as made by testProfiler.
+    """
+    with self.theLock:
+      self.theConn.executemany("""
+        INSERT OR REPLACE INTO profile (test, hash, ctime, tool, function, percent, selftime, calls)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+      """, [(
+        tName, gitHash, gitTime, theTool, theRow["function"], theRow["percent"], theRow["selftime"], theRow["calls"]
+      ) for theRow in theRows])
+      self.theConn.commit()
+    return
+
+  def getProfiles(self, tName, nCommits=10):
+    """Get the profiles of a test over the last nCommits commits, newest
+    first, as a list of (hash, commit time, tool, {function: row}).
+    """
+    theCols = ("hash","ctime","tool","function","percent","selftime","calls")
+    with self.theLock:
+      theRows = self.theConn.execute("""
+        SELECT %s FROM profile
+        WHERE test = ? AND hash IN (
+          SELECT hash FROM profile WHERE test = ? GROUP BY hash ORDER BY MAX(ctime) DESC LIMIT ?
+        )
+        ORDER BY ctime DESC, selftime DESC
+      """ % ", ".join(theCols), (tName, tName, nCommits)).fetchall()
+    theProfs = []
+    for theRow in theRows:
+      pRow = dict(zip(theCols, theRow))
+      if len(theProfs) == 0 or theProfs[-1][0] != pRow["hash"]:
+        theProfs.append((pRow["hash"], pRow["ctime"], pRow["tool"], {}))
+      theProfs[-1][3][pRow["function"]] = pRow
+    return theProfs
+
+  def importLogs(self, timDir):
+    """Import all existing Timing/<test>.log files. Records already in the
+    store are skipped, so importing the same files again is harmless.
+    """
+    nLines = 0
+    nAdded = 0
+    for logFile in sorted(listdir(timDir)):
+      if not logFile.endswith(".log"):
+        continue
+      tName   = logFile[:-4]
+      theRows = []
+      with open(path.join(timDir,logFile),mode="r") as inFile:
+        for inLine in inFile:
+          nLines += 1
+          lnMatch = timingLine.match(inLine.rstrip("\n"))
+          if lnMatch is None:
+            logger.debug("TimingStore: Cannot parse line in %s: %s" % (logFile, inLine.strip()))
+            continue
+          tStamp, gitHash, gitTime, execTime, tRes, bldCmd = lnMatch.groups()
+          theRows.append((tName, gitHash, gitTime.strip(), tStamp, bldCmd.strip(), execTime, tRes, None, None))
+      with self.theLock:
+        nBefore = self.theConn.total_changes
+        self._insertRows(theRows)
+        self.theConn.commit()
+        nAdded += self.theConn.total_changes - nBefore
+    logger.info("TimingStore: Imported %d of %d lines" % (nAdded, nLines))
+    return nAdded
+
+  def exportColumns(self, outFile):
+    """Export the whole store as gzipped JSON with one array per column.
+    """
+    theData = {colName: [] for colName in timingColumns}
+    with self.theLock:
+      for theRow in self.theConn.execute("SELECT %s FROM timing ORDER BY test, ctime" % ", ".join(timingColumns)):
+        for colName, colVal in zip(timingColumns, theRow):
+          theData[colName].append(colVal)
+    with gzip.open(outFile,mode="wt") as outData:
+      json.dump(theData, outData)
+    return len(theData["test"])
+
+  def _insertRows(self, theRows):
+    # Must be called with the lock held
+    self.theConn.executemany("""
+      INSERT OR IGNORE INTO timing (test, hash, ctime, stamp, build, compiler, type, exectime, ctesttime, result, host)
+      VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, [(
+      tName, gitHash, gitTime, tStamp, bldCmd, *splitBuild(bldCmd), toFloat(execTime), toFloat(ctestTime), tRes, tHost
+    ) for tName, gitHash, gitTime, tStamp, bldCmd, execTime, tRes, ctestTime, tHost in theRows])
+    return
+
+def splitBuild(bldCmd):
+  """Get the compiler and build type from a build command.
+  """
+  bldBits = bldCmd.split()
+  if len(bldBits) < 2:
+    return None, None
+  return bldBits[0], bldBits[1]
+
+def toFloat(theValue):
+  try:
+    return float(theValue)
+  except (TypeError, ValueError):
+    return None
+
+if __name__ == "__main__":
+  logging.basicConfig(level=logging.INFO, format="%(message)s")
+  if len(sys.argv) >= 4 and sys.argv[1] == "import":
+    TimingStore(sys.argv[2]).importLogs(sys.argv[3])
+  elif len(sys.argv) >= 5 and sys.argv[1] == "query":
+    nCommits = int(sys.argv[5]) if len(sys.argv) > 5 else 20
+    for tRecord in TimingStore(sys.argv[2]).getTimings(sys.argv[3], sys.argv[4], nCommits):
+      print("%40s  %19s  %14s  %6s" % (tRecord["hash"], tRecord["ctime"], tRecord["exectime"], tRecord["result"]))
+  elif len(sys.argv) >= 4 and sys.argv[1] == "profile":
+    nCommits = int(sys.argv[4]) if len(sys.argv) > 4 else 5
+    theProfs = TimingStore(sys.argv[2]).getProfiles(sys.argv[3], nCommits)
+    if len(theProfs) > 0:
+      print("%-40s  %s" % ("Function", "  ".join("%10s" % pHash[:10] for pHash, pTime, pTool, pRows in theProfs)))
+      for funcName in theProfs[0][3]:
+        print("%-40s  %s" % (funcName[:40], "  ".join(
+          "%10.3f" % pRows[funcName]["selftime"] if funcName in pRows else "%10s" % "-"
+          for pHash, pTime, pTool, pRows in theProfs
+        )))
+  elif len(sys.argv) >= 4 and sys.argv[1] == "export":
+    print("Exported %d records" % TimingStore(sys.argv[2]).exportColumns(sys.argv[3]))
+  else:
+    print(__doc__)
@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*
+"""SixTrack Worktree Pool
+
+  SixTrack Worktree Pool
+ ========================
+  A bounded pool of reusable git worktrees on top of the SixTrack mirror. A
+  quick build leases a slot, which is switched to the requested commit with a
+  forced checkout and a clean, instead of cloning the full repository. Each
+  slot is locked while leased, so several quick builds can run at the same
+  time. A slot that last had the same ref checked out is preferred, as it
+  needs the fewest files changed.
+
+"""
+
+import json
+import time
+import fcntl
+import shutil
+import logging
+from os import path, makedirs, remove, rename, symlink
+
+from buildFunctions import sysCall
+
+logger = logging.getLogger("SixTrackTestBuild")
+
+class WorktreePool:
+
+  def __init__(self, mirrorPath, poolDir, maxSize=4, libPath=None):
+    self.mirrorPath = mirrorPath
+    self.poolDir    = poolDir
+    self.maxSize    = maxSize
+    self.libPath    = libPath
+    self.theLeases  = {}
+    makedirs(poolDir, exist_ok=True)
+    return
+
+  def lease(self, gitRef, gitHash, maxWait=3600):
+    """Lease a slot and check out gitHash in it. Waits for a slot to become
+    free if all are in use. A slot that cannot be set up is cleared, so it is
+    created again by the next lease, and the next slot is tried. Returns the
+    path of the worktree, or None.
+    """
+    stdOut, stdErr, exCode = sysCall("git cat-file -e %s^{commit}" % gitHash, cwd=self.mirrorPath)
+    if exCode != 0:
+      logger.error("WorktreePool: Commit %s is not in the mirror" % gitHash)
+      return None
+    tStart = time.time()
+    while True:
+      nBusy = 0
+      for slotIdx in self._slotOrder(gitRef):
+        lockFd = open(self._slotFile(slotIdx,"lock"),mode="w")
+        try:
+          fcntl.flock(lockFd,fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+          lockFd.close()
+          nBusy += 1
+          continue
+        slotDir = self._slotFile(slotIdx,None)
+        if self._resetSlot(slotDir, gitHash):
+          self._writeInfo(slotIdx, gitRef, gitHash)
+          self.theLeases[slotDir] = lockFd
+          logger.info("WorktreePool: Leased %s for %s" % (slotDir,gitRef))
+          return slotDir
+        logger.warning("WorktreePool: Failed to set up %s, clearing it and trying the next slot" % slotDir)
+        self._clearSlot(slotIdx)
+        fcntl.flock(lockFd,fcntl.LOCK_UN)
+        lockFd.close()
+      if nBusy == 0:
+        logger.error("WorktreePool: None of the %d slots could be set up" % self.maxSize)
+        return None
+      if time.time() - tStart > maxWait:
+        logger.error("WorktreePool: No free slot after %d seconds" % maxWait)
+        return None
+      logger.info("WorktreePool: %d of %d slots in use, waiting ..." % (nBusy,self.maxSize))
+      time.sleep(10)
+
+  def release(self, slotDir):
+    """Release a leased slot. The worktree is kept for the next lease.
+    """
+    lockFd = self.theLeases.pop(slotDir, None)
+    if lockFd is not None:
+      fcntl.flock(lockFd,fcntl.LOCK_UN)
+      lockFd.close()
+    return
+
+  def _slotFile(self, slotIdx, fileExt):
+    if fileExt is None:
+      return path.join(self.poolDir,"slot%02d" % slotIdx)
+    return path.join(self.poolDir,"slot%02d.%s" % (slotIdx,fileExt))
+
+  def _slotOrder(self, gitRef):
+    # Same ref first, then unused slots, then the least recently used
+    slotInfo = {}
+    for slotIdx in range(self.maxSize):
+      slotInfo[slotIdx] = {"ref": None, "used": 0.0}
+      if path.isfile(self._slotFile(slotIdx,"json")):
+        try:
+          with open(self._slotFile(slotIdx,"json"),mode="r") as inFile:
+            slotInfo[slotIdx] = json.load(inFile)
+        except Exception:
+          pass
+    return sorted(slotInfo, key=lambda slotIdx: (
+      slotInfo[slotIdx]["ref"] != gitRef, slotInfo[slotIdx]["used"]
+    ))
+
+  def _writeInfo(self, slotIdx, gitRef, gitHash):
+    with open(self._slotFile(slotIdx,"json"),mode="w") as outFile:
+      json.dump({"ref": gitRef, "hash": gitHash, "used": time.time()}, outFile)
+    return
+
+  def _clearSlot(self, slotIdx):
+    # Must be called with the slot locked
+    if path.isfile(self._slotFile(slotIdx,"json")):
+      remove(self._slotFile(slotIdx,"json"))
+    shutil.rmtree(self._slotFile(slotIdx,None), ignore_errors=True)
+    sysCall("git worktree prune", cwd=self.mirrorPath)
+    return
+
+  def _resetSlot(self, slotDir, gitHash):
+    if path.isdir(path.join(slotDir,".git")) or path.isfile(path.join(slotDir,".git")):
+      # The lib folder is replaced by a link to the shared libraries, which
+      # must be put back before git touches the tree
+      if path.islink(path.join(slotDir,"lib")):
+        remove(path.join(slotDir,"lib"))
+        if path.isdir(path.join(slotDir,"lib.old")):
+          rename(path.join(slotDir,"lib.old"),path.join(slotDir,"lib"))
+      stdOut, stdErr, exCode = sysCall("git checkout --force --detach %s" % gitHash, cwd=slotDir)
+      if exCode == 0:
+        stdOut, stdErr, exCode = sysCall("git clean -ffdxq", cwd=slotDir)
+      if exCode != 0:
+        logger.warning("WorktreePool: Failed to reset %s, creating it again" % slotDir)
+        for errLn in stdErr.split("\n"):
+          if errLn.strip() != "":
+            logger.warning("GIT> %s" % errLn)
+        shutil.rmtree(slotDir)
+    elif path.isdir(slotDir):
+      shutil.rmtree(slotDir)
+    if not path.isdir(slotDir):
+      sysCall("git worktree prune", cwd=self.mirrorPath)
+      stdOut, stdErr, exCode = sysCall("git worktree add --detach %s %s" % (slotDir,gitHash), cwd=self.mirrorPath)
+      if exCode != 0:
+        logger.error("WorktreePool: Failed to create worktree %s" % slotDir)
+        for errLn in stdErr.split("\n"):
+          if errLn.strip() != "":
+            logger.error("GIT> %s" % errLn)
+        return False
+    if self.libPath is not None and path.isdir(path.join(slotDir,"lib")):
+      rename(path.join(slotDir,"lib"),path.join(slotDir,"lib.old"))
+      symlink(self.libPath,path.join(slotDir,"lib"))
+    return True